@@ -0,0 +1,58 @@
+# encoding: utf-8
+import threading
+
+
+class GlacierClientPool(object):
+    """
+    Glacier resources of one boto3 session, created on first use so commands which never talk
+    to AWS don't even import boto3.
+
+    boto3 resources must not be shared between threads, every thread gets its own and keeps
+    reusing it (with its client and connections). They are created from the shared session
+    under a lock, as the session isn't thread safe either. max_connections is the size of the
+    connection pool of each client, max_attempts and retry_mode the botocore retry settings
+    (retry_mode 'adaptive' also backs off on throttling).
+    """
+    def __init__(self, access_key=None, secret_key=None, max_connections=10, max_attempts=5,
+                 retry_mode='adaptive'):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.max_connections = max_connections
+        self.max_attempts = max_attempts
+        self.retry_mode = retry_mode
+        self.lock = threading.Lock()
+        self.session = None
+        self.created = 0
+        self._local = threading.local()
+
+    def _new_session(self):
+        import boto3
+        if self.access_key and self.secret_key:
+            return boto3.Session(aws_access_key_id=self.access_key, aws_secret_access_key=self.secret_key)
+        return boto3.Session()
+
+    def _config(self):
+        from botocore.config import Config
+        return Config(max_pool_connections=self.max_connections,
+                      retries={'max_attempts': self.max_attempts, 'mode': self.retry_mode})
+
+    def resource(self):
+        """The Glacier resource of the calling thread"""
+        resource = getattr(self._local, 'resource', None)
+        if resource is None:
+            with self.lock:
+                if self.session is None:
+                    self.session = self._new_session()
+                resource = self.session.resource('glacier', config=self._config())
+                self.created += 1
+            self._local.resource = resource
+        return resource
+
+    def vault(self, vault_name):
+        """The Vault vault_name of the calling thread"""
+        vaults = getattr(self._local, 'vaults', None)
+        if vaults is None:
+            vaults = self._local.vaults = {}
+        if vault_name not in vaults:
+            vaults[vault_name] = self.resource().Vault('-', vault_name)
+        return vaults[vault_name]
@@ -0,0 +1,340 @@
+# encoding: utf-8
+"""
+Benchmarks of the backup and restore pipeline stages on synthetic trees, each stage on its own
+and end to end against a LocalVault:
+
+    python agbench.py -size_mb 64 -output bench.json -baseline baseline.json
+
+Results are written as JSON, with -baseline the throughput of every stage is compared to a
+stored run and the exit code is 1 if one of them regressed by more than -tolerance.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from agcompress import CompressWriter, DecompressWriter
+from agcrypt import AESCipher
+from aglacier import GlacierVault, MEGABYTE
+from aglocal import LocalVault
+from agmain import Agbackup
+
+SHAPES = ('small', 'huge', 'random')
+
+
+class CountingWriter(object):
+    """
+    File like object counting and dropping everything written to it
+    """
+    def __init__(self):
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def make_tree(folder, shape, total_bytes):
+    """
+    Writes a synthetic tree of about total_bytes into folder, returns the number of files.
+    small: many 4 KiB text files in nested folders, huge: a few large half compressible
+    files, random: medium sized incompressible files.
+    """
+    os.makedirs(folder)
+    if shape == 'small':
+        file_size, count = 4096, max(1, total_bytes // 4096)
+    elif shape == 'huge':
+        file_size, count = max(1, total_bytes // 4), 4
+    elif shape == 'random':
+        file_size, count = MEGABYTE, max(1, total_bytes // MEGABYTE)
+    else:
+        raise ValueError("unknown shape '{}', use one of {}".format(shape, ', '.join(SHAPES)))
+
+    text = b''.join(b'line %d of some compressible log text\n' % i for i in range(2000))
+    for i in range(count):
+        path = os.path.join(folder, 'd{}'.format(i % 10), 'd{}'.format(i // 10 % 10), 'f{}'.format(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            written = 0
+            while written < file_size:
+                n = min(MEGABYTE, file_size - written)
+                if shape == 'random':
+                    data = os.urandom(n)
+                elif shape == 'huge':
+                    # half random, half text
+                    data = os.urandom(n // 2) + (text * (n // len(text) + 1))[:n - n // 2]
+                else:
+                    data = (text * (n // len(text) + 1))[i % 1000:i % 1000 + n]
+                f.write(data)
+                written += len(data)
+    return count
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def current_rss():
+    """Resident set size of the process in bytes, the peak so far where it can't be read (not on Linux)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def disk_usage(folder, exclude=()):
+    """Size of the files below folder, without the folders in exclude"""
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) not in exclude]
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Sampler(object):
+    """
+    Context manager sampling the resident set size and temp_usage() every interval seconds in a
+    thread while the block runs, peak_rss and peak_disk are the largest samples
+    """
+    def __init__(self, temp_usage, interval=0.02):
+        self.temp_usage = temp_usage
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        self.peak_rss = max(self.peak_rss, current_rss())
+        self.peak_disk = max(self.peak_disk, self.temp_usage())
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop.set()
+        self.thread.join()
+        self._sample()
+
+
+class Bench(object):
+    """
+    Runs the stages for one tree and collects a result dict per stage
+    """
+    def __init__(self, work_dir, shape, total_bytes, repeat=1):
+        self.work_dir = work_dir
+        self.shape = shape
+        self.repeat = repeat
+        self.source = os.path.join(work_dir, 'src')
+        self.files = make_tree(self.source, shape, total_bytes)
+        self.size = disk_usage(self.source)
+        # neither the tree, the vaults, their catalogs nor the restored trees are temporary files
+        self.not_temp = {os.path.join(work_dir, name)
+                         for name in ('src', 'vault', 'agb_vault', 'state', 'extract', 'restore')}
+        os.makedirs(os.path.join(work_dir, 'state'))
+        self.results = []
+
+    def measure(self, stage, func, size=None, files=None):
+        """
+        Runs func repeat times and records the fastest run, size defaults to the size of the tree
+        """
+        best = None
+        with Sampler(lambda: disk_usage(self.work_dir, self.not_temp)) as sampler:
+            for i in range(self.repeat):
+                started = time.perf_counter()
+                func()
+                duration = time.perf_counter() - started
+                best = duration if best is None else min(best, duration)
+        size = self.size if size is None else size
+        result = {
+            'shape': self.shape,
+            'stage': stage,
+            'seconds': best,
+            'bytes': size,
+            'mb_per_s': size / best / 1e6 if best else 0.0,
+            'files_per_s': (files / best if best else 0.0) if files else None,
+            'peak_rss': sampler.peak_rss,
+            'temp_disk': sampler.peak_disk,
+        }
+        self.results.append(result)
+        print(format_result(result))
+        return result
+
+    def run(self):
+        tar_data = io.BytesIO()
+        Agbackup._make_tarfile(tar_data, self.source, mode="w|")
+        tar_data = tar_data.getvalue()
+
+        self.measure('tar', lambda: Agbackup._make_tarfile(CountingWriter(), self.source, mode="w|"),
+                     files=self.files)
+
+        compressed = io.BytesIO()
+
+        def compress():
+            compressed.seek(0)
+            compressed.truncate()
+            writer = CompressWriter(compressed, 'gzip')
+            writer.write(tar_data)
+            writer.finish()
+        self.measure('compress', compress, size=len(tar_data))
+
+        self.measure('decompress', lambda: decompress(compressed.getvalue()), size=len(tar_data))
+
+        crypt = AESCipher('benchmark key')
+        encrypted = io.BytesIO()
+
+        def encrypt():
+            encrypted.seek(0)
+            encrypted.truncate()
+            crypt.encrypt(io.BytesIO(tar_data), encrypted)
+        self.measure('encrypt', encrypt, size=len(tar_data))
+        self.measure('decrypt', lambda: crypt.decrypt(encrypted, CountingWriter()), size=len(tar_data))
+
+        vault = GlacierVault('bench', shelve_file=os.path.join(self.work_dir, 'state', 'shelve'))
+        vault.vault = LocalVault(os.path.join(self.work_dir, 'vault'))
+        self.measure('upload', lambda: vault.upload(io.BytesIO(tar_data), {
+            "name": "bench", "datetime": datetime.now(), "id": None, "encrypted": False}), size=len(tar_data))
+        vault.catalog.close()
+
+        def extract():
+            out = os.path.join(self.work_dir, 'extract')
+            shutil.rmtree(out, ignore_errors=True)
+            Agbackup._extract_tarfile(out, io.BytesIO(tar_data), mode="r|")
+        self.measure('extract', extract, size=len(tar_data), files=self.files)
+        shutil.rmtree(os.path.join(self.work_dir, 'extract'), ignore_errors=True)
+
+        agb = make_agbackup(self.work_dir, self.source)
+        self.measure('backup', lambda: agb.backup_element(agb.config['backup_objects'][0]), files=self.files)
+
+        def restore():
+            out = os.path.join(self.work_dir, 'restore')
+            shutil.rmtree(out, ignore_errors=True)
+            agb.retrive('bench', out, force=True, wait=False)
+        self.measure('restore', restore, files=self.files)
+        return self.results
+
+
+def decompress(data):
+    writer = DecompressWriter(CountingWriter(), 'gzip')
+    writer.write(data)
+    writer.finish()
+
+
+def make_agbackup(work_dir, source):
+    config = {
+        "vault": "bench",
+        "shelve_file": os.path.join(work_dir, 'state', 'agb_shelve'),
+        "encryption_key": "benchmark key",
+        "backup_objects": [{"path": source, "name": "bench", "encrypt": True}],
+    }
+    config_file = os.path.join(work_dir, 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    agb = Agbackup(config_file)
+    agb.vault.vault = LocalVault(os.path.join(work_dir, 'agb_vault'))
+    return agb
+
+
+def format_result(result):
+    line = '{shape:<7} {stage:<11} {seconds:>8.3f} s  {mb:>9.1f} MB/s'.format(
+        shape=result['shape'], stage=result['stage'], seconds=result['seconds'], mb=result['mb_per_s'])
+    if result['files_per_s'] is not None:
+        line += '  {:>10.0f} files/s'.format(result['files_per_s'])
+    line += '  rss {:>6.0f} MB  temp {:>6.0f} MB'.format(result['peak_rss'] / 1e6, result['temp_disk'] / 1e6)
+    return line
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the stages whose throughput fell more than tolerance (a fraction) below the baseline
+    """
+    previous = {(result['shape'], result['stage']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        base = previous.get((result['shape'], result['stage']))
+        if base is None or not base['mb_per_s']:
+            continue
+        change = result['mb_per_s'] / base['mb_per_s'] - 1
+        if change < -tolerance:
+            regressions.append('{} {}: {:.1f} MB/s, baseline {:.1f} MB/s ({:+.0%})'.format(
+                result['shape'], result['stage'], result['mb_per_s'], base['mb_per_s'], change))
+    return regressions
+
+
+def init_argparse():
+    parser = argparse.ArgumentParser(prog='agbench', description='Benchmarks the backup pipeline stages')
+    parser.add_argument('-size_mb', type=int, default=32, help='Size of every synthetic tree')
+    parser.add_argument('-shapes', default=','.join(SHAPES), help='Tree shapes: ' + ', '.join(SHAPES))
+    parser.add_argument('-repeat', type=int, default=1, help='Runs per stage, the fastest one counts')
+    parser.add_argument('-output', default=None, help='Write the results as JSON into this file')
+    parser.add_argument('-baseline', default=None, help='Compare with the results of an earlier -output')
+    parser.add_argument('-tolerance', type=float, default=0.2, help='Allowed throughput loss, default 0.2')
+    parser.add_argument('-dir', default=None, help='Working directory for the trees, default a temp folder')
+    return parser
+
+
+def main():
+    arg = init_argparse().parse_args()
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    results = []
+    for shape in arg.shapes.split(','):
+        work_dir = tempfile.mkdtemp(prefix='agbench-', dir=arg.dir)
+        try:
+            results.extend(Bench(work_dir, shape, arg.size_mb * MEGABYTE, arg.repeat).run())
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'size_mb': arg.size_mb,
+        'results': results,
+    }
+    if arg.output:
+        with open(arg.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if arg.baseline:
+        with open(arg.baseline) as f:
+            regressions = compare(results, json.load(f), arg.tolerance)
+        if regressions:
+            print('Regressions against {}:'.format(arg.baseline))
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('No regressions against {}'.format(arg.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# encoding: utf-8
+import io
+from datetime import datetime
+from aglacier import MEGABYTE
+
+
+class BundleEntry(io.BytesIO):
+    """
+    Stream of one bundled backup object, kept in memory until it is added to the bundle.
+    arch_descr is the description of the object's version, like the one of an ArchiveWriter.
+    """
+    def __init__(self, arch_descr):
+        super().__init__()
+        self.arch_descr = arch_descr
+
+    @property
+    def size(self):
+        return len(self.getbuffer())
+
+
+class BundleWriter(object):
+    """
+    Packs the streams of small backup objects one after another into bundle archives, so they
+    don't cost an upload request and an archive each.
+
+    Every object is compressed and encrypted on its own, its bytes in the bundle can be
+    restored without the rest of it. A stream is added only once it was written completely,
+    a failing object leaves nothing in the bundle. A bundle is uploaded once it reaches
+    bundle_size. The versions of the objects are then stored in the catalog with the id
+    '<bundle id>.<index>', their offset and size in the bundle (the offset table) and their
+    member index. open_upload(arch_descr) has to return an unrecorded ArchiveWriter. If the
+    upload of a bundle fails, failed maps the names of its objects to the exception.
+    """
+    def __init__(self, open_upload, catalog, bundle_size=64 * MEGABYTE):
+        self.open_upload = open_upload
+        self.catalog = catalog
+        self.bundle_size = bundle_size
+        self.upload = None
+        self.offset = 0
+        self.entries = []
+        self.bundle_ids = []
+        self.failed = {}
+
+    @staticmethod
+    def open(arch_descr):
+        return BundleEntry(arch_descr)
+
+    def add(self, entry, members=()):
+        """
+        Appends the finished entry to the bundle, members are its member index rows
+        """
+        if self.upload is None:
+            self.upload = self.open_upload({"name": "bundle", "datetime": datetime.now(), "id": None,
+                                            "type": "bundle"})
+            self.offset = 0
+        self.upload.write(entry.getbuffer())
+        entry.arch_descr['offset'] = self.offset
+        entry.arch_descr['size'] = entry.size
+        self.entries.append((entry.arch_descr, list(members)))
+        self.offset += entry.size
+        entry.close()
+        if self.offset >= self.bundle_size:
+            self._close_bundle()
+
+    def _close_bundle(self):
+        if self.upload is None:
+            return
+        upload, entries = self.upload, self.entries
+        self.upload = None
+        self.entries = []
+        try:
+            bundle_id = upload.close()
+        except Exception as e:
+            for arch_descr, members in entries:
+                self.failed[arch_descr['name']] = e
+            raise
+        with self.catalog.transaction():
+            for i, (arch_descr, members) in enumerate(entries):
+                arch_descr.update(id='{}.{}'.format(bundle_id, i), bundle=bundle_id, bundle_size=upload.size)
+                self.catalog.add_archive(arch_descr)
+                self.catalog.add_bundled(arch_descr['id'], bundle_id, arch_descr['offset'], arch_descr['size'])
+                self.catalog.add_members(arch_descr['id'], members)
+        self.bundle_ids.append(bundle_id)
+
+    def finish(self):
+        """
+        Uploads the last bundle, returns the ids of all bundles
+        """
+        self._close_bundle()
+        return self.bundle_ids
+
+    def abort(self):
+        if self.upload is not None:
+            self.upload.abort()
+        self.upload = None
+        self.entries = []
@@ -0,0 +1,185 @@
+# encoding: utf-8
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from aglacier import MEGABYTE, ChecksumMismatch, chunk_hashes, tree_hash, hex_digest
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+"""
+
+
+class CacheWriter(object):
+    """
+    File like object writing an entry of a RestoreCache into a temp file, the entry is added
+    by commit(key) and dropped by discard()
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.path = os.path.join(cache.folder, 'tmp-{}'.format(uuid.uuid4().hex))
+        self.file = open(self.path, 'wb')
+        self.hashes = []
+        self.buffer = bytearray()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        # the tree hash needs whole MiB chunks
+        self.buffer += data
+        if len(self.buffer) >= MEGABYTE:
+            whole = len(self.buffer) // MEGABYTE * MEGABYTE
+            self.hashes.extend(chunk_hashes(bytes(self.buffer[:whole])))
+            del self.buffer[:whole]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def commit(self, key):
+        if self.buffer or not self.hashes:
+            self.hashes.extend(chunk_hashes(bytes(self.buffer)))
+        self.file.close()
+        self.cache._add(key, self.path, self.size, hex_digest(tree_hash(self.hashes)))
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class RestoreCache(object):
+    """
+    Local cache of archive data as stored in the vault (still encrypted), keyed by archive id.
+
+    At most max_bytes are kept, the least recently used entries are evicted first. Every entry
+    is checked against the tree hash it was added with before it is served, a corrupted entry is
+    dropped and the data retrieved from Glacier again.
+    """
+    def __init__(self, folder, max_bytes):
+        self.folder = os.path.expanduser(folder)
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(os.path.join(self.folder, 'cache.sqlite'), check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def _path(self, key):
+        return os.path.join(self.folder, str(key))
+
+    def _query(self, sql, args=()):
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def __contains__(self, key):
+        return bool(self._query('SELECT 1 FROM entries WHERE key = ?', (str(key),)))
+
+    def total_size(self):
+        return self._query('SELECT COALESCE(SUM(size), 0) FROM entries')[0][0]
+
+    def writer(self):
+        return CacheWriter(self)
+
+    def put(self, key, fileobj):
+        """
+        Adds the content of the seekable fileobj as entry key
+        """
+        writer = self.writer()
+        try:
+            fileobj.seek(0)
+            while True:
+                data = fileobj.read(MEGABYTE)
+                if not data:
+                    break
+                writer.write(data)
+        except Exception:
+            writer.discard()
+            raise
+        writer.commit(key)
+
+    def _add(self, key, tmp_path, size, checksum):
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return
+        with self.lock:
+            os.replace(tmp_path, self._path(key))
+            self.connection.execute('INSERT OR REPLACE INTO entries (key, size, checksum, last_used) VALUES (?, ?, ?, ?)',
+                                    (str(key), size, checksum, time.time()))
+            self._evict()
+
+    def _evict(self):
+        total = self.total_size()
+        for key, size in self._query('SELECT key, size FROM entries ORDER BY last_used'):
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    def remove(self, key):
+        with self.lock:
+            self.connection.execute('DELETE FROM entries WHERE key = ?', (str(key),))
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+
+    def get(self, key, fileobj, start=0, end=None):
+        """
+        Writes the entry (or its bytes start to end inclusive) into fileobj after checking it.
+        Returns False if the entry is missing or was corrupted.
+        """
+        rows = self._query('SELECT size, checksum FROM entries WHERE key = ?', (str(key),))
+        if not rows:
+            return False
+        size, checksum = rows[0]
+        try:
+            f = open(self._path(key), 'rb')
+        except OSError:
+            self.remove(key)
+            return False
+
+        with f:
+            try:
+                self._check(f, size, checksum)
+            except ChecksumMismatch:
+                self.remove(key)
+                return False
+
+            f.seek(start)
+            remaining = (size if end is None else min(end + 1, size)) - start
+            while remaining > 0:
+                data = f.read(min(MEGABYTE, remaining))
+                fileobj.write(data)
+                remaining -= len(data)
+
+        self._query('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), str(key)))
+        return True
+
+    @staticmethod
+    def _check(f, size, checksum):
+        hashes = []
+        read = 0
+        while True:
+            data = f.read(MEGABYTE)
+            if not data:
+                break
+            read += len(data)
+            hashes.extend(chunk_hashes(data))
+        if read != size or hex_digest(tree_hash(hashes or chunk_hashes(b''))) != checksum:
+            raise ChecksumMismatch("cache entry is corrupted")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,403 @@
+# encoding: utf-8
+import dbm
+import json
+import os
+import shelve
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    datetime TEXT NOT NULL,
+    encrypted INTEGER NOT NULL DEFAULT 0,
+    type TEXT,
+    descr TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archives_name_datetime ON archives (name, datetime);
+CREATE INDEX IF NOT EXISTS archives_datetime ON archives (datetime);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    archive_id TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS downloads (
+    archive_id TEXT PRIMARY KEY,
+    range_size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS download_ranges (
+    archive_id TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (archive_id, start)
+);
+
+CREATE TABLE IF NOT EXISTS members (
+    archive_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mode INTEGER,
+    mtime INTEGER,
+    block_in INTEGER NOT NULL,
+    block_out INTEGER NOT NULL,
+    block_end INTEGER NOT NULL,
+    PRIMARY KEY (archive_id, path)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS deletions (
+    archive_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (archive_id, path)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS bundled (
+    archive_id TEXT PRIMARY KEY,
+    bundle_id TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bundled_bundle_id ON bundled (bundle_id);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError("Type not serializable")
+
+
+def _datetime_str(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+class Catalog(object):
+    """
+    SQLite catalog of archives, retrieval jobs and partial downloads.
+
+    Every operation only touches the rows it needs and writes happen in transactions, unlike the
+    shelve which was unpickled and rewritten as a whole. The connection is shared between threads,
+    a lock serializes its use.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the statements of the block in one transaction, nested blocks join the outer one
+        """
+        with self.lock:
+            if self.connection.in_transaction:
+                yield self.connection
+                return
+            self.connection.execute('BEGIN')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def _query(self, sql, args=()):
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    @staticmethod
+    def _load_descr(descr):
+        arch_descr = json.loads(descr)
+        if 'datetime' in arch_descr:
+            try:
+                arch_descr['datetime'] = datetime.fromisoformat(arch_descr['datetime'])
+            except (TypeError, ValueError):
+                pass
+        return arch_descr
+
+    # archives
+
+    def add_archive(self, arch_descr):
+        with self.transaction() as c:
+            c.execute('INSERT OR REPLACE INTO archives (id, name, datetime, encrypted, type, descr) '
+                      'VALUES (?, ?, ?, ?, ?, ?)',
+                      (str(arch_descr['id']), arch_descr['name'], _datetime_str(arch_descr['datetime']),
+                       1 if arch_descr.get('encrypted') else 0, arch_descr.get('type'),
+                       json.dumps(arch_descr, default=_json_default)))
+
+    def get_archive(self, archive_id):
+        rows = self._query('SELECT descr FROM archives WHERE id = ?', (str(archive_id),))
+        return self._load_descr(rows[0][0]) if rows else None
+
+    def versions(self, name):
+        """
+        Returns {archive id: archive description} of all versions of name
+        """
+        rows = self._query('SELECT id, descr FROM archives WHERE name = ? ORDER BY datetime', (name,))
+        return {archive_id: self._load_descr(descr) for archive_id, descr in rows}
+
+    def archive_objects(self):
+        """
+        Returns {name: {archive id: archive description}} of the whole catalog
+        """
+        archive_objects = {}
+        for archive_id, name, descr in self._query('SELECT id, name, descr FROM archives ORDER BY name, datetime'):
+            archive_objects.setdefault(name, {})[archive_id] = self._load_descr(descr)
+        return archive_objects
+
+    def latest(self, name, id_prefix=None):
+        """
+        Returns the description of the newest version of name (with an id starting with id_prefix)
+        """
+        if id_prefix is None:
+            rows = self._query('SELECT descr FROM archives WHERE name = ? ORDER BY datetime DESC, id DESC LIMIT 1',
+                               (name,))
+        else:
+            rows = self._query('SELECT descr FROM archives WHERE name = ? AND id >= ? AND id < ? '
+                               'ORDER BY datetime DESC, id DESC LIMIT 1',
+                               (name, id_prefix, id_prefix + '\U0010ffff'))
+        return self._load_descr(rows[0][0]) if rows else None
+
+    def delete_archive(self, archive_id):
+        with self.transaction() as c:
+            c.execute('DELETE FROM archives WHERE id = ?', (str(archive_id),))
+            c.execute('DELETE FROM jobs WHERE archive_id = ?', (str(archive_id),))
+            c.execute('DELETE FROM members WHERE archive_id = ?', (str(archive_id),))
+            c.execute('DELETE FROM bundled WHERE archive_id = ?', (str(archive_id),))
+            c.execute('DELETE FROM deletions WHERE archive_id = ?', (str(archive_id),))
+
+    def list_archives(self, name=None, since=None, until=None, archive_type=None, limit=None, offset=0):
+        """
+        Returns the descriptions of the archives matching the filters, newest first: name is a
+        prefix, since and until limit the datetime (including them)
+        """
+        where, args = self._filters(name, since, until, archive_type)
+        rows = self._query('SELECT descr FROM archives{} ORDER BY datetime DESC, id LIMIT ? OFFSET ?'.format(where),
+                           args + [-1 if limit is None else limit, offset])
+        return [self._load_descr(descr) for descr, in rows]
+
+    def list_names(self, name=None, since=None, until=None, archive_type=None, limit=None, offset=0):
+        """
+        Returns (name, number of versions, datetime of the newest version) of the archive names
+        matching the filters of list_archives, ordered by name
+        """
+        where, args = self._filters(name, since, until, archive_type)
+        rows = self._query('SELECT name, COUNT(*), MAX(datetime) FROM archives{} GROUP BY name ORDER BY name '
+                           'LIMIT ? OFFSET ?'.format(where), args + [-1 if limit is None else limit, offset])
+        return [(name, count, datetime.fromisoformat(newest)) for name, count, newest in rows]
+
+    @staticmethod
+    def _filters(name, since, until, archive_type):
+        conditions, args = [], []
+        if name is not None:
+            conditions.append('name >= ? AND name < ?')
+            args += [name, name + '\U0010ffff']
+        if since is not None:
+            conditions.append('datetime >= ?')
+            args.append(_datetime_str(since))
+        if until is not None:
+            conditions.append('datetime <= ?')
+            args.append(_datetime_str(until))
+        if archive_type is not None:
+            conditions.append('type = ?')
+            args.append(archive_type)
+        return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), args
+
+    def sync_inventory(self, archives, older_than=None, batch_size=10000):
+        """
+        Reconciles the catalog with the archive descriptions of a vault inventory: archives missing
+        in the catalog are added, in transactions of batch_size archives. If older_than is given,
+        archives from before it which are not in the inventory are removed, they were deleted
+        from the vault, unless they are bundled into an archive of the inventory. Bundles themselves
+        are not added, the versions in them are only known to the catalog.
+        Returns the number of added and of removed archives.
+        """
+        added = 0
+        with self.lock:
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS inventory_ids (id TEXT PRIMARY KEY)')
+            self.connection.execute('DELETE FROM inventory_ids')
+
+            batch = []
+            for arch_descr in archives:
+                batch.append(arch_descr)
+                if len(batch) >= batch_size:
+                    added += self._add_inventory_batch(batch)
+                    batch = []
+            added += self._add_inventory_batch(batch)
+
+            removed = 0
+            if older_than is not None:
+                with self.transaction() as c:
+                    missing = 'SELECT id FROM archives WHERE datetime < ? ' \
+                              'AND id NOT IN (SELECT id FROM inventory_ids) ' \
+                              'AND id NOT IN (SELECT archive_id FROM bundled WHERE bundle_id IN ' \
+                              '(SELECT id FROM inventory_ids))'
+                    args = (_datetime_str(older_than),)
+                    c.execute('DELETE FROM jobs WHERE archive_id IN ({})'.format(missing), args)
+                    c.execute('DELETE FROM members WHERE archive_id IN ({})'.format(missing), args)
+                    c.execute('DELETE FROM bundled WHERE archive_id IN ({})'.format(missing), args)
+                    c.execute('DELETE FROM deletions WHERE archive_id IN ({})'.format(missing), args)
+                    removed = c.execute('DELETE FROM archives WHERE id IN ({})'.format(missing), args).rowcount
+            self.connection.execute('DELETE FROM inventory_ids')
+        return added, removed
+
+    def _add_inventory_batch(self, batch):
+        with self.transaction() as c:
+            c.executemany('INSERT OR IGNORE INTO inventory_ids (id) VALUES (?)',
+                          [(str(arch_descr['id']),) for arch_descr in batch])
+            before = c.total_changes
+            c.executemany('INSERT OR IGNORE INTO archives (id, name, datetime, encrypted, type, descr) '
+                          'VALUES (?, ?, ?, ?, ?, ?)',
+                          [(str(arch_descr['id']), arch_descr['name'], _datetime_str(arch_descr['datetime']),
+                            1 if arch_descr.get('encrypted') else 0, arch_descr.get('type'),
+                            json.dumps(arch_descr, default=_json_default)) for arch_descr in batch
+                           if arch_descr.get('type') != 'bundle'])
+            return c.total_changes - before
+
+    # member index
+
+    def add_members(self, archive_id, rows):
+        """
+        Stores the member index of an archive, rows as yielded by agindex.member_rows
+        """
+        with self.transaction() as c:
+            c.executemany('INSERT OR REPLACE INTO members (archive_id, path, offset, size, mode, mtime, block_in, '
+                          'block_out, block_end) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          ((str(archive_id),) + tuple(row) for row in rows))
+
+    def member(self, archive_id, path):
+        """
+        Returns the index entry of the file path (an arcname) in the archive as dict or None
+        """
+        with self.lock:
+            cursor = self.connection.execute('SELECT * FROM members WHERE archive_id = ? AND path = ?',
+                                             (str(archive_id), path))
+            row = cursor.fetchone()
+            return dict(zip([column[0] for column in cursor.description], row)) if row else None
+
+    def member_paths(self, archive_id):
+        """
+        Yields the paths in the member index of the archive
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT path FROM members WHERE archive_id = ?', (str(archive_id),))
+            for path, in rows:
+                yield path
+
+    def has_members(self, archive_id):
+        return bool(self._query('SELECT 1 FROM members WHERE archive_id = ? LIMIT 1', (str(archive_id),)))
+
+    def add_deletions(self, archive_id, paths):
+        """
+        Stores the paths an incremental archive deleted since its base
+        """
+        with self.transaction() as c:
+            c.executemany('INSERT OR REPLACE INTO deletions (archive_id, path) VALUES (?, ?)',
+                          ((str(archive_id), path) for path in paths))
+
+    def is_deleted(self, archive_id, path):
+        return bool(self._query('SELECT 1 FROM deletions WHERE archive_id = ? AND path = ?', (str(archive_id), path)))
+
+    # bundles
+
+    def add_bundled(self, archive_id, bundle_id, offset, size):
+        """
+        Records that the archive is stored at offset in the bundle archive bundle_id
+        """
+        with self.transaction() as c:
+            c.execute('INSERT OR REPLACE INTO bundled (archive_id, bundle_id, offset, size) VALUES (?, ?, ?, ?)',
+                      (str(archive_id), str(bundle_id), offset, size))
+
+    def bundled(self, bundle_id):
+        """
+        Returns the ids of the archives in the bundle archive bundle_id
+        """
+        return [archive_id for archive_id, in self._query('SELECT archive_id FROM bundled WHERE bundle_id = ? '
+                                                          'ORDER BY offset', (str(bundle_id),))]
+
+    # retrieval jobs
+
+    def get_job(self, archive_id):
+        rows = self._query('SELECT job_id FROM jobs WHERE archive_id = ?', (str(archive_id),))
+        return rows[0][0] if rows else None
+
+    def set_job(self, archive_id, job_id):
+        with self.transaction() as c:
+            c.execute('INSERT OR REPLACE INTO jobs (archive_id, job_id) VALUES (?, ?)', (str(archive_id), job_id))
+
+    def delete_job(self, archive_id):
+        with self.transaction() as c:
+            c.execute('DELETE FROM jobs WHERE archive_id = ?', (str(archive_id),))
+
+    # partial downloads
+
+    def download_ranges(self, archive_id, range_size):
+        """
+        Returns {start: tree hash} of the finished ranges of a download with the given range size
+        """
+        rows = self._query('SELECT range_size FROM downloads WHERE archive_id = ?', (str(archive_id),))
+        if not rows or rows[0][0] != range_size:
+            return {}
+        return dict(self._query('SELECT start, hash FROM download_ranges WHERE archive_id = ?', (str(archive_id),)))
+
+    def add_download_ranges(self, archive_id, range_size, ranges):
+        with self.transaction() as c:
+            row = c.execute('SELECT range_size FROM downloads WHERE archive_id = ?', (str(archive_id),)).fetchone()
+            if row is None or row[0] != range_size:
+                c.execute('DELETE FROM download_ranges WHERE archive_id = ?', (str(archive_id),))
+                c.execute('INSERT OR REPLACE INTO downloads (archive_id, range_size) VALUES (?, ?)',
+                          (str(archive_id), range_size))
+            c.executemany('INSERT OR REPLACE INTO download_ranges (archive_id, start, hash) VALUES (?, ?, ?)',
+                          [(str(archive_id), start, range_hash) for start, range_hash in ranges.items()])
+
+    def clear_download(self, archive_id):
+        with self.transaction() as c:
+            c.execute('DELETE FROM downloads WHERE archive_id = ?', (str(archive_id),))
+            c.execute('DELETE FROM download_ranges WHERE archive_id = ?', (str(archive_id),))
+
+    # migration
+
+    def migrate_shelve(self, shelve_file):
+        """
+        Imports archives, jobs and partial downloads of a shelve written by older versions.
+        Runs once, the shelve itself is left untouched. Returns the number of imported archives.
+        """
+        if self._query("SELECT value FROM meta WHERE key = 'migrated_shelve'"):
+            return 0
+        if not shelve_file or not dbm.whichdb(shelve_file):
+            return 0
+
+        count = 0
+        d = shelve.open(shelve_file, flag='r')
+        try:
+            with self.transaction() as c:
+                for name, versions in d.get("archive_objects", {}).items():
+                    for archive_id, arch_descr in versions.items():
+                        arch_descr = dict(arch_descr, id=archive_id, name=arch_descr.get('name', name))
+                        self.add_archive(arch_descr)
+                        count += 1
+                for archive_id, job_id in d.get("jobs", {}).items():
+                    self.set_job(archive_id, job_id)
+                for archive_id, record in d.get("downloads", {}).items():
+                    self.add_download_ranges(archive_id, record['range_size'], record['ranges'])
+                c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_shelve', ?)",
+                          (os.path.abspath(shelve_file),))
+        finally:
+            d.close()
+        return count
@@ -0,0 +1,149 @@
+# encoding: utf-8
+import bz2
+import gzip
+import lzma
+import zlib
+from collections import deque
+
+CODECS = ('gzip', 'bz2', 'xz', 'none')
+
+# default level and uncompressed block size of each codec, xz gains from larger blocks
+DEFAULTS = {
+    'gzip': (6, 1024 * 1024),
+    'bz2': (9, 900 * 1024),
+    'xz': (6, 4 * 1024 * 1024),
+    'none': (None, 1024 * 1024),
+}
+
+
+class CompressionError(Exception):
+    pass
+
+
+def _compress_func(codec, level):
+    if codec == 'gzip':
+        # mtime=0 keeps the output deterministic
+        return lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+    if codec == 'bz2':
+        return lambda data: bz2.compress(data, compresslevel=level)
+    if codec == 'xz':
+        return lambda data: lzma.compress(data, preset=level)
+    raise CompressionError("unknown compression '{}', use one of {}".format(codec, ', '.join(CODECS)))
+
+
+def _decompressor(codec):
+    if codec == 'gzip':
+        return zlib.decompressobj(wbits=31)
+    if codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    if codec == 'xz':
+        return lzma.LZMADecompressor()
+    raise CompressionError("unknown compression '{}', use one of {}".format(codec, ', '.join(CODECS)))
+
+
+class CompressWriter(object):
+    """
+    File like object compressing everything written to it into out_file.
+
+    The data is cut into blocks which are compressed independently on executor (zlib, bz2 and
+    lzma release the GIL) and written in order as a concatenation of complete gzip members /
+    bz2 or xz streams, which the standard tools decompress like a single stream (pigz-style).
+    At most two blocks per worker are in flight. blocks lists (uncompressed offset, compressed
+    offset) of every block, the places where decompression can start.
+
+    Call finish() after the last write.
+    """
+    def __init__(self, out_file, codec='gzip', level=None, executor=None, workers=1, block_size=None):
+        if codec not in CODECS:
+            raise CompressionError("unknown compression '{}', use one of {}".format(codec, ', '.join(CODECS)))
+        default_level, default_block_size = DEFAULTS[codec]
+        self.out_file = out_file
+        self.codec = codec
+        self.compress = None if codec == 'none' else _compress_func(codec, default_level if level is None else level)
+        self.executor = executor
+        self.workers = workers
+        self.block_size = block_size or default_block_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.blocks = []
+        self.in_offset = 0
+        self.out_offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit(self, block):
+        if self.compress is None:
+            self._write_block(len(block), block)
+            return
+
+        if self.executor is None:
+            self._write_block(len(block), self.compress(block))
+            return
+
+        while len(self.pending) >= 2 * self.workers:
+            self._write_block(*self.pending.popleft().result())
+        self.pending.append(self.executor.submit(lambda b: (len(b), self.compress(b)), block))
+
+    def _write_block(self, size, compressed):
+        self.blocks.append((self.in_offset, self.out_offset))
+        self.out_file.write(compressed)
+        self.in_offset += size
+        self.out_offset += len(compressed)
+
+    def finish(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_block(*self.pending.popleft().result())
+
+
+class DecompressWriter(object):
+    """
+    File like object decompressing everything written to it into out_file, the counterpart of
+    CompressWriter. Handles concatenated members / streams, call finish() after the last write.
+    """
+    def __init__(self, out_file, codec='gzip'):
+        if codec not in CODECS:
+            raise CompressionError("unknown compression '{}', use one of {}".format(codec, ', '.join(CODECS)))
+        self.out_file = out_file
+        self.codec = codec
+        self.decompressor = None if codec == 'none' else _decompressor(codec)
+        self.started = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = len(data)
+        if self.decompressor is None:
+            self.out_file.write(data)
+            return size
+
+        data = bytes(data)
+        while data:
+            if self.decompressor.eof:
+                # next member / stream of a concatenation
+                self.decompressor = _decompressor(self.codec)
+            self.started = True
+            self.out_file.write(self.decompressor.decompress(data))
+            data = self.decompressor.unused_data if self.decompressor.eof else b''
+        return size
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if self.decompressor is not None and self.started and not self.decompressor.eof:
+            raise CompressionError("compressed data is truncated")
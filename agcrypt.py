@@ -1,24 +1,298 @@
 import hashlib
-from Crypto.Random import random
+from collections import deque
+from Crypto.Random import get_random_bytes
 from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad, unpad
 import struct
 
+# Headers of the streamable formats. Legacy files start with their size as '<Q', the last byte
+# of the magics makes it a size of more than 2^63 bytes, so the formats can't be confused.
+STREAM_MAGIC = b'AGCRYP\x02\xff'
+SEGMENT_MAGIC = b'AGCRYP\x03\xff'
+
+TAG_SIZE = 16
+# magic, plaintext bytes per segment, nonce prefix
+SEGMENT_HEADER = struct.Struct('<8sI8s')
+
+
+class DecryptionError(Exception):
+    pass
+
+
+def _segment_cipher(key, nonce_prefix, header, index, final):
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce_prefix + struct.pack('<I', index), mac_len=TAG_SIZE)
+    # the header and the final flag are authenticated, so segments can't be moved between
+    # streams and a stream can't be cut at a segment boundary unnoticed
+    cipher.update(header + (b'\x01' if final else b'\x00'))
+    return cipher
+
+
+def encrypt_segment(key, nonce_prefix, header, index, data, final):
+    ciphertext, tag = _segment_cipher(key, nonce_prefix, header, index, final).encrypt_and_digest(data)
+    return ciphertext + tag
+
+
+def decrypt_segment(key, nonce_prefix, header, index, data, final):
+    if len(data) < TAG_SIZE:
+        raise DecryptionError("encrypted data is truncated")
+    cipher = _segment_cipher(key, nonce_prefix, header, index, final)
+    try:
+        return cipher.decrypt_and_verify(data[:-TAG_SIZE], data[-TAG_SIZE:])
+    except ValueError:
+        raise DecryptionError("segment {} failed authentication, wrong key or corrupted data".format(index))
+
+
+class _SegmentPipeline(object):
+    """
+    Runs func on consecutive segments, on executor if there is one (AES releases the GIL), and
+    writes the results in order into out_file. At most two segments per worker are in flight.
+    """
+    def __init__(self, func, key, nonce_prefix, header, out_file, executor=None, workers=1, index=0):
+        self.func = func
+        self.key = key
+        self.nonce_prefix = nonce_prefix
+        self.header = header
+        self.out_file = out_file
+        self.executor = executor
+        self.workers = workers
+        self.index = index
+        self.pending = deque()
+
+    def submit(self, data, final):
+        args = (self.key, self.nonce_prefix, self.header, self.index, data, final)
+        self.index += 1
+        if self.executor is None:
+            self.out_file.write(self.func(*args))
+            return
+
+        while len(self.pending) >= 2 * self.workers:
+            self.out_file.write(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(self.func, *args))
+
+    def drain(self):
+        while self.pending:
+            self.out_file.write(self.pending.popleft().result())
+
+
+class SegmentEncryptWriter(object):
+    """
+    File like object encrypting everything written to it into out_file with AES-GCM.
+
+    Format: SEGMENT_HEADER, then segments of segment_size bytes (the last one shorter), each
+    encrypted with its own nonce, the nonce prefix followed by the segment index, and followed
+    by its 16 byte tag. Segments are authenticated and independently decryptable, so they
+    are encrypted in parallel. Call finish() after the last write.
+    """
+    def __init__(self, key, out_file, segment_size=1024 * 1024, executor=None, workers=1):
+        self.segment_size = segment_size
+        nonce_prefix = get_random_bytes(8)
+        header = SEGMENT_HEADER.pack(SEGMENT_MAGIC, segment_size, nonce_prefix)
+        self.header = header
+        self.pipeline = _SegmentPipeline(encrypt_segment, key, nonce_prefix, header, out_file, executor, workers)
+        self.buffer = bytearray()
+        out_file.write(header)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        # the last segment is flagged as final, so a full segment waits for more data
+        while len(self.buffer) > self.segment_size:
+            self.pipeline.submit(bytes(memoryview(self.buffer)[:self.segment_size]), False)
+            del self.buffer[:self.segment_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        self.pipeline.submit(bytes(self.buffer), True)
+        self.buffer = bytearray()
+        self.pipeline.drain()
+
+
+class EncryptWriter(object):
+    """
+    File like object encrypting everything written to it into out_file.
+    Only a partial AES block is kept between writes, call finish() to write the padding.
+
+    Format: STREAM_MAGIC, 16 byte iv, AES/CBC data with PKCS#7 padding. Only kept to
+    write the previous format, new data is written by SegmentEncryptWriter.
+    """
+    def __init__(self, key, out_file):
+        self.out_file = out_file
+        iv = get_random_bytes(16)
+        self.encryptor = AES.new(key, AES.MODE_CBC, iv)
+        self.pending = b''
+        out_file.write(STREAM_MAGIC)
+        out_file.write(iv)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = len(data)
+        data = self.pending + bytes(data)
+        aligned = len(data) - len(data) % AES.block_size
+        if aligned:
+            self.out_file.write(self.encryptor.encrypt(data[:aligned]))
+        self.pending = data[aligned:]
+        return size
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        self.out_file.write(self.encryptor.encrypt(pad(self.pending, AES.block_size)))
+        self.pending = b''
+
+
+class DecryptWriter(object):
+    """
+    File like object decrypting everything written to it into out_file, the counterpart of
+    SegmentEncryptWriter and EncryptWriter. Reads the segmented, the CBC streamable and the
+    legacy format, call finish() after the last write.
+
+    Given the SEGMENT_HEADER of a segmented stream, whole segments starting with segment
+    first_index can be written instead of the stream, final_index is the index of the last
+    segment of the stream (which is flagged as final).
+    """
+    header_size = struct.calcsize('<Q') + 16
+
+    def __init__(self, key, out_file, executor=None, workers=1, header=None, first_index=0, final_index=None):
+        self.key = key
+        self.out_file = out_file
+        self.executor = executor
+        self.workers = workers
+        self.decryptor = None
+        self.legacy_remaining = None
+        self.segments = None
+        self.final_index = final_index
+        self.pending = b''
+        if header is not None:
+            self._start_segments(header, first_index)
+
+    def _start_segments(self, header, first_index=0):
+        magic, self.segment_size, nonce_prefix = SEGMENT_HEADER.unpack(header)
+        if magic != SEGMENT_MAGIC:
+            raise DecryptionError("not a segmented stream header")
+        self.segments = _SegmentPipeline(decrypt_segment, self.key, nonce_prefix, header, self.out_file,
+                                         self.executor, self.workers, first_index)
+        self.pending = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = len(data)
+        if self.segments is not None:
+            self._write_segments(data)
+            return size
+
+        data = self.pending + bytes(data)
+
+        if self.decryptor is None:
+            if len(data) < max(self.header_size, SEGMENT_HEADER.size):
+                self.pending = data
+                return size
+            if data[:8] == SEGMENT_MAGIC:
+                self._start_segments(data[:SEGMENT_HEADER.size])
+                self._write_segments(data[SEGMENT_HEADER.size:])
+                return size
+
+            header, iv = data[:8], data[8:self.header_size]
+            if header != STREAM_MAGIC:
+                # legacy format: size header, iv, zero padded AES/CBC data
+                self.legacy_remaining = struct.unpack('<Q', header)[0]
+            self.decryptor = AES.new(self.key, AES.MODE_CBC, iv)
+            data = data[self.header_size:]
+
+        if self.legacy_remaining is None:
+            # the last block holds the padding, so it is only decrypted in finish()
+            cut = (len(data) - 1) // AES.block_size * AES.block_size if data else 0
+        else:
+            cut = len(data) - len(data) % AES.block_size
+
+        if cut > 0:
+            plain = self.decryptor.decrypt(data[:cut])
+            if self.legacy_remaining is not None:
+                plain = plain[:self.legacy_remaining]
+                self.legacy_remaining -= len(plain)
+            self.out_file.write(plain)
+        self.pending = data[cut:]
+        return size
+
+    def _write_segments(self, data):
+        self.pending += data
+        size = self.segment_size + TAG_SIZE
+        # a full segment may be the final one, it is only decrypted once more data follows
+        while len(self.pending) > size:
+            self.segments.submit(bytes(memoryview(self.pending)[:size]), False)
+            del self.pending[:size]
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if self.segments is not None:
+            final = self.final_index is None or self.segments.index == self.final_index
+            self.segments.submit(bytes(self.pending), final)
+            self.pending = bytearray()
+            self.segments.drain()
+            return
+        if self.decryptor is None:
+            raise DecryptionError("encrypted data is truncated")
+        if self.legacy_remaining is not None:
+            if self.legacy_remaining or self.pending:
+                raise DecryptionError("encrypted data is truncated")
+            return
+
+        if len(self.pending) != AES.block_size:
+            raise DecryptionError("encrypted data is truncated")
+        try:
+            self.out_file.write(unpad(self.decryptor.decrypt(self.pending), AES.block_size))
+        except ValueError:
+            raise DecryptionError("invalid padding, wrong key or corrupted data")
+        self.pending = b''
+
 
 class AESCipher(object):
 
-    def __init__(self, key):
-        self.chunksize = 24 * 1024
+    def __init__(self, key, executor=None, workers=1, segment_size=1024 * 1024):
+        self.chunksize = segment_size
+        self.segment_size = segment_size
         self.key = hashlib.sha256(key.encode()).digest()
+        self.executor = executor
+        self.workers = workers
+
+    def encrypt_writer(self, out_file):
+        """ Returns a SegmentEncryptWriter, data written to it is encrypted
+            into out_file without ever seeking in it.
+        """
+        return SegmentEncryptWriter(self.key, out_file, self.segment_size, self.executor, self.workers)
+
+    def _copy(self, in_file, writer):
+        # one reusable buffer, files without readinto fall back to read
+        buf = bytearray(self.chunksize)
+        view = memoryview(buf)
+        readinto = getattr(in_file, 'readinto', None)
+        while True:
+            if readinto is not None:
+                n = readinto(buf)
+                chunk = view[:n]
+            else:
+                chunk = in_file.read(self.chunksize)
+                n = len(chunk)
+            if not n:
+                break
+            writer.write(chunk)
+        writer.finish()
 
     def encrypt(self, in_file, out_file):
-            """ Encrypts a file using AES/CBC using the
+            """ Encrypts a file using AES/GCM segments using the
                 given key.
 
-                key:
-                    The encryption key - a string that must be
-                    either 16, 24 or 32 bytes long. Longer keys
-                    are more secure.
-
                 in_file:
                     The input file
 
@@ -26,43 +300,25 @@ class AESCipher(object):
                     The file to write to.
 
             """
-
-            # iv = b''.join(bytes(random.randint(0, 0xFF)) for i in range(16))
-            iv = b''+random.getrandbits(16*8).to_bytes(16, byteorder='big')
-            encryptor = AES.new(self.key, AES.MODE_CBC, iv)
-            # get file size
-            in_file.seek(0, 2)
-            filesize = in_file.tell()  # os.path.getsize(in_filename)
             in_file.seek(0)
+            self._copy(in_file, self.encrypt_writer(out_file))
 
-            out_file.write(struct.pack('<Q', filesize))
-            out_file.write(iv)
-
-            while True:
-                chunk = in_file.read(self.chunksize)
-                if len(chunk) == 0:
-                    break
-                elif len(chunk) % 16 != 0:
-                    chunk += b'\x00' * (16 - len(chunk) % 16)
+    def decrypt_writer(self, out_file):
+        """ Returns a DecryptWriter, encrypted data written to it
+            is decrypted into out_file.
+        """
+        return DecryptWriter(self.key, out_file, self.executor, self.workers)
 
-                out_file.write(encryptor.encrypt(chunk))
+    def segment_decrypt_writer(self, out_file, header, first_index, final_index):
+        """ Returns a DecryptWriter for whole segments of a segmented
+            stream, see DecryptWriter.
+        """
+        return DecryptWriter(self.key, out_file, self.executor, self.workers, header, first_index, final_index)
 
     def decrypt(self, in_file, out_file):
-        """ Decrypts a file using AES/CBC using the
-            given key. Parameters are similar to encrypt
+        """ Decrypts a file written by encrypt or by older versions
+            using the given key. Parameters are similar to encrypt
         """
         in_file.seek(0)
-        origsize = struct.unpack('<Q', in_file.read(struct.calcsize('<Q')))[0]
-        iv = in_file.read(16)
-        decryptor = AES.new(self.key, AES.MODE_CBC, iv)
-
-
-        while True:
-            chunk = in_file.read(self.chunksize)
-            if len(chunk) == 0:
-                break
-            out_file.write(decryptor.decrypt(chunk))
-
-        out_file.truncate(origsize)
+        self._copy(in_file, self.decrypt_writer(out_file))
         out_file.flush()
-
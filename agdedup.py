@@ -0,0 +1,218 @@
+# encoding: utf-8
+import hashlib
+import io
+import re
+import shelve
+import threading
+import zlib
+from datetime import datetime
+from aglacier import MEGABYTE
+
+
+class ChunkIndex(object):
+    """
+    Context manager for the local chunk index, a shelve mapping the sha256 of every uploaded
+    chunk to its location (pack archive id, offset, length) and archive ids to their manifest.
+    Encrypted and plaintext chunks are indexed apart, an encrypted object never references a
+    plaintext pack and vice versa. Entries are read one by one, the index is never loaded as a whole.
+
+    Backups running in parallel share one instance: the shelve is opened by the first and
+    closed by the last user, every access is serialized by a lock.
+    """
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.lock = threading.RLock()
+        self.users = 0
+        self.shelve = None
+
+    def __enter__(self):
+        with self.lock:
+            if self.users == 0:
+                self.shelve = shelve.open(self.index_file)
+            self.users += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.lock:
+            self.users -= 1
+            if self.users == 0:
+                self.shelve.close()
+                self.shelve = None
+
+    @staticmethod
+    def _chunk_key(chunk_hash, encrypted):
+        return 'c:' + ('e:' if encrypted else 'p:') + chunk_hash
+
+    def get(self, chunk_hash, encrypted=False):
+        with self.lock:
+            return self.shelve.get(self._chunk_key(chunk_hash, encrypted))
+
+    def add(self, chunk_hash, location, encrypted=False):
+        with self.lock:
+            self.shelve[self._chunk_key(chunk_hash, encrypted)] = location
+
+    def manifest(self, archive_id):
+        with self.lock:
+            return self.shelve.get('m:{}'.format(archive_id))
+
+    def store_manifest(self, archive_id, manifest):
+        with self.lock:
+            self.shelve['m:{}'.format(archive_id)] = manifest
+
+
+class Chunker(object):
+    """
+    Content defined chunking: a chunk ends where the crc32 of the preceding window bytes
+    matches the mask, so an insertion only changes the chunks around it.
+
+    A per byte rolling hash in python runs at about 10 MB/s, so the hash is only evaluated at
+    anchors, the ends of runs of a few common byte values, which the regex engine finds at C speed.
+    Data without anchors is cut at max_size.
+    """
+    anchors = re.compile(b'[\\x00\\n\\xff]+')
+    window = 48
+
+    def __init__(self, min_size=MEGABYTE // 4, avg_size=MEGABYTE, max_size=4 * MEGABYTE):
+        self.min_size = min_size
+        self.max_size = max_size
+        # about 3 anchors per 256 bytes of random data, the mask makes every n-th of them a boundary
+        anchors_per_chunk = max(1, (avg_size - min_size) * 3 // 256)
+        self.mask = (1 << (anchors_per_chunk.bit_length() - 1)) - 1
+
+    def find_cut(self, data, final=False):
+        """
+        Returns the end of the first chunk in data or None if more data is needed to decide
+        """
+        if len(data) < self.max_size and not final:
+            return None
+        if len(data) <= self.min_size:
+            return len(data) if data else None
+
+        for m in self.anchors.finditer(data, self.min_size, self.max_size):
+            pos = m.end()
+            if zlib.crc32(data[pos - self.window:pos]) & self.mask == 0:
+                return pos
+        return min(len(data), self.max_size)
+
+
+def pack_chunk(chunk, crypt=None):
+    data = zlib.compress(chunk, 6)
+    if crypt is not None:
+        encrypted = io.BytesIO()
+        writer = crypt.encrypt_writer(encrypted)
+        writer.write(data)
+        writer.finish()
+        data = encrypted.getvalue()
+    return data
+
+
+def unpack_chunk(data, chunk_hash, crypt=None):
+    if crypt is not None:
+        decrypted = io.BytesIO()
+        crypt.decrypt(io.BytesIO(data), decrypted)
+        data = decrypted.getvalue()
+    chunk = zlib.decompress(data)
+    if hashlib.sha256(chunk).hexdigest() != chunk_hash:
+        raise ValueError("chunk {} is corrupted".format(chunk_hash))
+    return chunk
+
+
+class DedupWriter(object):
+    """
+    File like object splitting the (uncompressed) tar stream of a backup object into chunks.
+    Chunks already in the index are only referenced, new chunks are compressed, encrypted and
+    appended to a pack archive which is uploaded once it reaches pack_size.
+
+    finish() returns the manifest, a list of [hash, pack archive id, offset, length] per chunk.
+    """
+    def __init__(self, glacier_vault, index, name, crypt=None, pack_size=64 * MEGABYTE, chunker=None,
+                 print_info=False):
+        self.glacier_vault = glacier_vault
+        self.index = index
+        self.name = name
+        self.crypt = crypt
+        self.pack_size = pack_size
+        self.chunker = chunker or Chunker()
+        self.print_info = print_info
+        self.buffer = bytearray()
+        self.manifest = []
+        self.pack = None
+        self.pack_offset = 0
+        self.pack_chunks = []
+        self.new_bytes = 0
+        self.total_bytes = 0
+        self.uploaded_bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self._cut()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _cut(self, final=False):
+        while True:
+            cut = self.chunker.find_cut(self.buffer, final)
+            if cut is None:
+                return
+            self._add_chunk(bytes(self.buffer[:cut]))
+            del self.buffer[:cut]
+
+    def _add_chunk(self, chunk):
+        chunk_hash = hashlib.sha256(chunk).hexdigest()
+        self.total_bytes += len(chunk)
+        location = self.index.get(chunk_hash, self.crypt is not None)
+        if location is None:
+            location = self._pack_chunk(chunk_hash, chunk)
+        self.manifest.append((chunk_hash, location))
+
+    def _pack_chunk(self, chunk_hash, chunk):
+        for h, location in self.pack_chunks:
+            # the same chunk twice in the current pack
+            if h == chunk_hash:
+                return location
+
+        if self.pack is None:
+            pack_descr = {"name": self.name, "datetime": datetime.now(), "id": None,
+                          "encrypted": self.crypt is not None, "type": "pack"}
+            self.pack = self.glacier_vault.open_upload(pack_descr, self.print_info, record=False)
+            self.pack_offset = 0
+
+        data = pack_chunk(chunk, self.crypt)
+        self.pack.write(data)
+        # the pack id is only known after the upload, it is filled in by _close_pack
+        location = [None, self.pack_offset, len(data)]
+        self.pack_chunks.append((chunk_hash, location))
+        self.pack_offset += len(data)
+        self.new_bytes += len(chunk)
+
+        if self.pack_offset >= self.pack_size:
+            self._close_pack()
+        return location
+
+    def _close_pack(self):
+        if self.pack is None:
+            return
+        pack_id = self.pack.close()
+        self.uploaded_bytes += self.pack.size
+        for chunk_hash, location in self.pack_chunks:
+            location[0] = pack_id
+            self.index.add(chunk_hash, tuple(location), self.crypt is not None)
+        self.pack = None
+        self.pack_chunks = []
+
+    def finish(self):
+        self._cut(final=True)
+        self._close_pack()
+        if self.print_info:
+            print("Deduplicated {} bytes, {} bytes new".format(self.total_bytes, self.new_bytes))
+        return [[chunk_hash] + list(location) for chunk_hash, location in self.manifest]
+
+    def abort(self):
+        if self.pack is not None:
+            self.pack.abort()
+            self.pack = None
@@ -0,0 +1,189 @@
+# encoding: utf-8
+import os
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# files up to this size are read from the stream and written by the pool
+SMALL_FILE_SIZE = 1024 * 1024
+
+# extraction of validated members, without the deprecation warning of newer Pythons
+_EXTRACT_KWARGS = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+
+
+class UnsafeMemberError(Exception):
+    pass
+
+
+class TarExtractor(object):
+    """
+    Extracts a tar stream in a single pass while it arrives.
+
+    Every member is validated before anything is written: absolute names, '..' components,
+    paths below a symlink of the archive or resolving outside of the output folder and hard
+    links to such paths raise UnsafeMemberError. Without overwrite, existing files raise
+    FileExistsError, checked against the set of files found by one walk of the output folder
+    instead of one lstat per member.
+
+    Files up to small_file_size are read from the stream and written, with their attributes,
+    by a pool of threads, at most two per thread are held in memory. Larger files are written
+    from the stream directly. Links are created after all files, so nothing is ever written
+    through a link of the archive, and the attributes of directories are set last.
+    """
+    def __init__(self, output_folder, overwrite=False, threads=8, small_file_size=SMALL_FILE_SIZE):
+        self.output_folder = os.path.abspath(output_folder)
+        self.real_output_folder = os.path.realpath(output_folder)
+        self.overwrite = overwrite
+        self.threads = threads
+        self.small_file_size = small_file_size
+        self.safe_dirs = {self.real_output_folder}
+
+    def existing_files(self):
+        """
+        Archive names of everything but directories in the output folder
+        """
+        existing = set()
+        folders = [(self.output_folder, '')]
+        while folders:
+            path, prefix = folders.pop()
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append((entry.path, prefix + entry.name + '/'))
+                    else:
+                        existing.add(prefix + entry.name)
+        return existing
+
+    def _path(self, name, member, symlinks):
+        """
+        Validates the name (or link name) of member, returns it normalized and its path
+        """
+        parts = [part for part in name.split('/') if part not in ('', '.')]
+        if name.startswith('/') or os.path.isabs(name) or '..' in parts or not parts:
+            raise UnsafeMemberError("member '{}' has an unsafe path '{}'".format(member.name, name))
+        for i in range(1, len(parts)):
+            if '/'.join(parts[:i]) in symlinks:
+                raise UnsafeMemberError("member '{}' is below a symlink of the archive".format(member.name))
+        path = os.path.join(self.output_folder, *parts)
+        self._check_dir(os.path.dirname(path), member)
+        return '/'.join(parts), path
+
+    def _check_dir(self, path, member):
+        """
+        Makes sure the existing part of the folder path is inside of the output folder
+        """
+        checked = []
+        while path not in self.safe_dirs and not os.path.lexists(path):
+            checked.append(path)
+            path = os.path.dirname(path)
+        if path not in self.safe_dirs:
+            real = os.path.realpath(path)
+            if real != self.real_output_folder and not real.startswith(self.real_output_folder + os.sep):
+                raise UnsafeMemberError("member '{}' would be written outside of the output folder".format(
+                    member.name))
+            checked.append(path)
+        self.safe_dirs.update(checked)
+
+    def target(self, member, symlinks):
+        """
+        Validates member, returns its normalized name and its path in the output folder
+        """
+        if member.islnk():
+            self._path(member.linkname, member, symlinks)
+        return self._path(member.name, member, symlinks)
+
+    def extract(self, tar, handlers=None, existing=None):
+        """
+        Extracts the members of the open tar stream. handlers maps member names to functions
+        called with the extracted file object instead of extracting the member. existing are the
+        existing_files() if they were already listed.
+        """
+        handlers = handlers or {}
+        if self.overwrite:
+            existing = None
+        elif existing is None:
+            existing = self.existing_files()
+        symlinks = set()
+        links = []
+        dirs = []
+        pending = deque()
+        pending_paths = {}
+
+        executor = ThreadPoolExecutor(max_workers=self.threads)
+        try:
+            for member in tar:
+                if member.name in handlers:
+                    self._wait(pending, pending_paths, len(pending))
+                    handlers[member.name](tar.extractfile(member))
+                    continue
+
+                name, target = self.target(member, symlinks)
+                if existing is not None and not member.isdir() and name in existing:
+                    raise FileExistsError(target)
+
+                if member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                    dirs.append((member, target))
+                    continue
+                if member.issym() or member.islnk():
+                    if member.issym():
+                        symlinks.add(name)
+                    links.append(member)
+                    continue
+
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if target in pending_paths:
+                    # the same name twice, the later one wins
+                    pending_paths[target].result()
+                if member.isreg() and member.size <= self.small_file_size:
+                    if len(pending) >= 2 * self.threads:
+                        self._wait(pending, pending_paths, 1)
+                    data = tar.extractfile(member).read()
+                    future = executor.submit(self._write_file, tar, member, target, [data])
+                    pending.append((target, future))
+                    pending_paths[target] = future
+                elif member.isreg():
+                    self._write_file(tar, member, target, self._chunks(tar.extractfile(member)))
+                else:
+                    # fifos and devices
+                    tar.extract(member, self.output_folder, **_EXTRACT_KWARGS)
+
+            self._wait(pending, pending_paths, len(pending))
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+        for member in links:
+            tar.extract(member, self.output_folder, **_EXTRACT_KWARGS)
+
+        # deepest first, creating their content changed their mtime
+        for member, target in sorted(dirs, key=lambda item: item[1], reverse=True):
+            tar.chown(member, target, False)
+            tar.chmod(member, target)
+            tar.utime(member, target)
+
+    def _chunks(self, fileobj):
+        while True:
+            data = fileobj.read(self.small_file_size)
+            if not data:
+                break
+            yield data
+
+    @staticmethod
+    def _wait(pending, pending_paths, count):
+        for i in range(count):
+            target, future = pending.popleft()
+            if pending_paths.get(target) is future:
+                del pending_paths[target]
+            future.result()
+
+    @staticmethod
+    def _write_file(tar, member, target, chunks):
+        if os.path.islink(target):
+            # never write through a link
+            os.unlink(target)
+        with open(target, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        tar.chown(member, target, False)
+        tar.chmod(member, target)
+        tar.utime(member, target)
@@ -0,0 +1,153 @@
+# encoding: utf-8
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+import stat
+import tarfile
+from agindex import IndexingTarFile
+from agscan import TreeScanner, scanned_tarinfo
+
+# first member of an incremental archive, lists the paths deleted since the base archive
+INFO_MEMBER = '.agbackup_incremental.json'
+
+
+def scan_tree(source, scanner=None, entries=None):
+    """
+    Walks source with a TreeScanner (parallel os.scandir, one lstat per entry).
+    Returns {arcname: (file type, size, mtime_ns, inode)}, arcnames start with the basename of source.
+    The ScanEntries are stored by arcname in entries if given, for make_incremental_tarfile.
+    """
+    if scanner is None:
+        scanner = TreeScanner()
+    current = {}
+    for entry in scanner.scan(source):
+        current[entry.arcname] = (stat.S_IFMT(entry.stat.st_mode), entry.stat.st_size, entry.stat.st_mtime_ns,
+                                  entry.stat.st_ino)
+        if entries is not None:
+            entries[entry.arcname] = entry
+    return current
+
+
+class FileIndex(object):
+    """
+    State of the files of one backup object at its last backup: {arcname: (file type, size,
+    mtime_ns, inode, sha256)}, the id of that archive and the number of incrementals since the last full.
+    Stored as one pickle, which is the fastest way to get millions of entries into memory.
+    """
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.archive_id = None
+        self.chain = 0
+        self.files = {}
+        if os.path.exists(index_file):
+            with open(index_file, 'rb') as f:
+                data = pickle.load(f)
+            self.archive_id = data['archive_id']
+            self.chain = data['chain']
+            self.files = data['files']
+
+    def changes(self, current):
+        """
+        Returns the sorted arcnames of new or modified entries and of deleted entries
+        """
+        files = self.files
+        changed = []
+        for arcname, state in current.items():
+            previous = files.get(arcname)
+            if previous is None:
+                changed.append(arcname)
+            elif stat.S_ISDIR(state[0]):
+                # a directory's mtime changes with its content, only the type matters
+                if previous[0] != state[0]:
+                    changed.append(arcname)
+            elif previous[:4] != state:
+                changed.append(arcname)
+        deleted = [arcname for arcname in files if arcname not in current]
+        return sorted(changed), sorted(deleted)
+
+    def update(self, current, hashes, archive_id, full):
+        files = {}
+        for arcname, state in current.items():
+            if arcname in hashes:
+                files[arcname] = state + (hashes[arcname],)
+            elif arcname in self.files and not full:
+                files[arcname] = state + (self.files[arcname][4],)
+            elif not stat.S_ISREG(state[0]):
+                files[arcname] = state + (None,)
+        self.files = files
+        self.archive_id = archive_id
+        self.chain = 0 if full else self.chain + 1
+
+    def save(self):
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'archive_id': self.archive_id, 'chain': self.chain, 'files': self.files}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.index_file)
+
+
+class HashingReader(object):
+    """
+    Passes reads through to fileobj and hashes the data, so files are read only once
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def make_incremental_tarfile(output_file, changed, deleted=None, mode="w|gz", members=None):
+    """
+    Writes the changed ScanEntries (from scan_tree, the headers are built from their stat) into a
+    tar stream, led by the INFO_MEMBER if deleted is not None. Returns {arcname: sha256} of the
+    archived files, entries which vanished since the scan are left out. The member index of the
+    stream is appended to members if given.
+    """
+    hashes = {}
+    with IndexingTarFile.open(fileobj=output_file, mode=mode) as tar:
+        if deleted is not None:
+            info = json.dumps({'deleted': deleted}).encode('utf-8')
+            tarinfo = tarfile.TarInfo(INFO_MEMBER)
+            tarinfo.size = len(info)
+            tar.addfile(tarinfo, io.BytesIO(info))
+
+        for entry in changed:
+            tarinfo = scanned_tarinfo(tar, entry)
+            if tarinfo is None:
+                continue
+            if tarinfo.isreg():
+                try:
+                    f = open(entry.path, 'rb')
+                except FileNotFoundError:
+                    continue
+                with f:
+                    reader = HashingReader(f)
+                    tar.addfile(tarinfo, reader)
+                hashes[entry.arcname] = reader.sha256.hexdigest()
+            else:
+                tar.addfile(tarinfo)
+    if members is not None:
+        members.extend(index for index in tar.members_index if index[0] != INFO_MEMBER)
+    return hashes
+
+
+def apply_deletions(output_folder, info_file):
+    """
+    Removes the entries listed in an INFO_MEMBER from output_folder
+    """
+    output_folder = os.path.abspath(output_folder)
+    for arcname in json.loads(info_file.read().decode('utf-8'))['deleted']:
+        path = os.path.abspath(os.path.join(output_folder, arcname))
+        if not path.startswith(output_folder + os.sep):
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
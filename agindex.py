@@ -0,0 +1,42 @@
+# encoding: utf-8
+import tarfile
+from bisect import bisect_right
+
+
+class IndexingTarFile(tarfile.TarFile):
+    """
+    TarFile recording where the data of every regular file starts in the uncompressed tar
+    stream: members_index holds (arcname, data offset, size, mode, mtime) per file.
+    Use IndexingTarFile.open like tarfile.open.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.members_index = []
+
+    def addfile(self, tarinfo, fileobj=None):
+        super().addfile(tarinfo, fileobj)
+        if tarinfo.isreg():
+            # the data, padded to whole blocks, ends where the stream is now
+            blocks = (tarinfo.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+            self.members_index.append((tarinfo.name, self.offset - blocks * tarfile.BLOCKSIZE, tarinfo.size,
+                                       tarinfo.mode, int(tarinfo.mtime)))
+
+
+def member_rows(members, blocks, compressed_size):
+    """
+    Joins the members_index of an IndexingTarFile with the blocks of the CompressWriter the tar
+    stream went through. Yields (arcname, data offset, size, mode, mtime, block in offset, block
+    out offset, block end) per member: decompression of the compressed bytes from block out offset
+    to block end yields the tar stream from block in offset on, which contains the member's data.
+    """
+    in_offsets = [in_offset for in_offset, out_offset in blocks]
+    for arcname, offset, size, mode, mtime in members:
+        i = max(bisect_right(in_offsets, offset) - 1, 0)
+        # first block starting at or behind the end of the data
+        j = bisect_right(in_offsets, offset + size - 1) if size else i + 1
+        block_end = blocks[j][1] if j < len(blocks) else compressed_size
+        if blocks:
+            block_in, block_out = blocks[i]
+        else:
+            block_in, block_out = 0, 0
+        yield arcname, offset, size, mode, mtime, block_in, block_out, block_end
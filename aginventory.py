@@ -0,0 +1,96 @@
+# encoding: utf-8
+import codecs
+import json
+import re
+from datetime import datetime
+
+
+class InventoryError(Exception):
+    pass
+
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[\s,]*')
+_inventory_date = re.compile(r'"InventoryDate"\s*:\s*"([^"]*)"')
+
+
+def iter_inventory(fileobj, chunk_size=1024 * 1024):
+    """
+    Parses a vault inventory ({"VaultARN": .., "InventoryDate": .., "ArchiveList": [..]}) from
+    fileobj incrementally. Yields the InventoryDate first (None if it does not precede the
+    archive list), then the entries of the ArchiveList one by one. Only the entry being parsed
+    and one chunk are held in memory, whatever the size of the inventory.
+    """
+    buffer = ''
+    eof = False
+    decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def more():
+        nonlocal eof
+        data = fileobj.read(chunk_size)
+        eof = not data
+        if isinstance(data, bytes):
+            # a chunk may end within a multi byte character
+            data = decoder.decode(data, final=eof)
+        return data
+
+    # everything up to the opening bracket of the archive list
+    while True:
+        m = re.search(r'"ArchiveList"\s*:\s*\[', buffer)
+        if m:
+            break
+        if eof:
+            raise InventoryError("no ArchiveList in the inventory")
+        buffer += more()
+
+    m_date = _inventory_date.search(buffer, 0, m.start())
+    yield m_date.group(1) if m_date else None
+
+    pos = m.end()
+    while True:
+        pos = _whitespace.match(buffer, pos).end()
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        if pos < len(buffer):
+            try:
+                entry, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise InventoryError("inventory is truncated or invalid")
+            else:
+                yield entry
+                pos = end
+                continue
+        elif eof:
+            raise InventoryError("inventory is truncated")
+
+        # the entry is not complete yet, drop what was parsed and read on
+        buffer = buffer[pos:]
+        pos = 0
+        buffer += more()
+
+
+def parse_date(value):
+    """
+    Glacier dates ('2026-10-16T08:11:40Z', UTC) as naive local datetime, like the catalog's
+    """
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).astimezone().replace(tzinfo=None)
+
+
+def archive_descr(entry):
+    """
+    The archive description of an inventory entry, decoded from the ArchiveDescription written
+    by upload. Archives uploaded by other tools are named by their description.
+    """
+    try:
+        arch_descr = json.loads(entry['ArchiveDescription'])
+        if not isinstance(arch_descr, dict) or 'name' not in arch_descr:
+            raise ValueError
+    except ValueError:
+        arch_descr = {'name': entry['ArchiveDescription'] or entry['ArchiveId'], 'encrypted': False}
+    if 'datetime' not in arch_descr or arch_descr['datetime'] is None:
+        arch_descr['datetime'] = parse_date(entry['CreationDate']).isoformat()
+    arch_descr['id'] = entry['ArchiveId']
+    arch_descr['size'] = entry['Size']
+    arch_descr['checksum'] = entry['SHA256TreeHash']
+    return arch_descr
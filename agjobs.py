@@ -0,0 +1,143 @@
+# encoding: utf-8
+import asyncio
+import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobFailed(Exception):
+    pass
+
+
+def _notification_job_id(message):
+    """
+    Returns the job id of a Glacier job notification, the SNS message as dict or JSON string,
+    also when still wrapped in an SNS envelope (as delivered to SQS)
+    """
+    if isinstance(message, (bytes, str)):
+        message = json.loads(message)
+    if 'Message' in message and 'JobId' not in message:
+        return _notification_job_id(message['Message'])
+    return message.get('JobId')
+
+
+class JobManager(object):
+    """
+    Retrieves many archives at once: starts (or resumes) the retrieval jobs of all of them,
+    records them in the catalog and downloads every archive as soon as its job completes.
+
+    Completion is polled with one paginated ListJobs call for all completed jobs of the vault
+    instead of one DescribeJob per archive. The interval starts at poll_interval and grows by
+    backoff up to max_poll_interval while nothing completes. notifications is an optional
+    queue.Queue like object fed with Glacier SNS job notifications (e.g. by an SQS consumer),
+    a notification makes the manager check its job right away.
+    """
+    def __init__(self, glacier_vault, poll_interval=60, max_poll_interval=1800, backoff=2.0,
+                 notifications=None, archive_workers=2, print_info=False):
+        self.glacier_vault = glacier_vault
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.notifications = notifications
+        self.archive_workers = archive_workers
+        self.print_info = print_info
+
+    def retrieve(self, targets, download, wait_mode=True, byte_ranges=None):
+        """
+        Downloads every archive of targets ({archive id: fileobj}) by calling download(job,
+        archive_id, fileobj) once its job completed. Without wait_mode only the archives with
+        completed jobs are downloaded. byte_ranges ({archive id: 'start-end'}) limits the jobs
+        of archives to a range. Returns the ids of the archives not downloaded.
+        """
+        return asyncio.run(self.run(targets, download, wait_mode, byte_ranges))
+
+    async def run(self, targets, download, wait_mode=True, byte_ranges=None):
+        byte_ranges = byte_ranges or {}
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=self.archive_workers) as executor:
+            # job id -> archive id of the jobs still running
+            waiting = {}
+            downloads = []
+
+            def start_download(job, archive_id):
+                if self.print_info:
+                    print("Job of archive {} completed, downloading...".format(archive_id))
+                downloads.append(loop.run_in_executor(executor, download, job, archive_id, targets[archive_id]))
+
+            # starting jobs means one request per archive, done concurrently
+            jobs = await asyncio.gather(*[loop.run_in_executor(None, self.glacier_vault._get_job, archive_id,
+                                                               self.print_info, byte_ranges.get(archive_id))
+                                          for archive_id in targets])
+            for archive_id, job in zip(targets, jobs):
+                if job.completed:
+                    start_download(job, archive_id)
+                else:
+                    waiting[job.id] = archive_id
+
+            interval = self.poll_interval
+            failed = []
+            while waiting and wait_mode:
+                if self.print_info:
+                    print("Waiting for {} retrieval job(s), next check in {:.0f} s".format(len(waiting), interval))
+                notified = await self._wait(loop, interval, waiting)
+
+                completed = await loop.run_in_executor(None, self._completed_jobs, notified)
+                found = False
+                for job in completed:
+                    if job.id not in waiting:
+                        continue
+                    found = True
+                    archive_id = waiting.pop(job.id)
+                    if job.status_code == 'Succeeded':
+                        start_download(job, archive_id)
+                    else:
+                        # a new job is initiated by the next retrieval
+                        self.glacier_vault.catalog.delete_job(
+                            self.glacier_vault._job_key(archive_id, byte_ranges.get(archive_id)))
+                        failed.append("{} ({})".format(archive_id, job.status_code))
+                interval = self.poll_interval if found else min(interval * self.backoff, self.max_poll_interval)
+
+            if downloads:
+                results = await asyncio.gather(*downloads, return_exceptions=True)
+                for result in results:
+                    if isinstance(result, BaseException):
+                        raise result
+            if failed:
+                raise JobFailed("retrieval job(s) failed: {}".format(', '.join(failed)))
+            return list(waiting.values())
+
+    async def _wait(self, loop, interval, waiting):
+        """
+        Sleeps for interval or until a notification for one of the waiting jobs arrives,
+        returns the ids of the notified jobs
+        """
+        if self.notifications is None:
+            await asyncio.sleep(interval)
+            return []
+
+        deadline = loop.time() + interval
+        while True:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                return []
+            try:
+                message = await loop.run_in_executor(None, self.notifications.get, True, timeout)
+            except queue.Empty:
+                return []
+            try:
+                job_id = _notification_job_id(message)
+            except (ValueError, TypeError, AttributeError):
+                continue
+            if job_id in waiting:
+                return [job_id]
+
+    def _completed_jobs(self, notified):
+        """
+        The notified jobs or all completed jobs of the vault, the collection pages through ListJobs
+        """
+        if notified:
+            jobs = [self.glacier_vault.vault.Job(job_id) for job_id in notified]
+            for job in jobs:
+                job.load()
+            return [job for job in jobs if job.completed]
+        return list(self.glacier_vault.vault.completed_jobs.all())
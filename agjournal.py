@@ -0,0 +1,160 @@
+# encoding: utf-8
+import json
+import os
+import threading
+import time
+import uuid
+from aglacier import json_datetime_serial
+
+STAGING = 'staging'
+STAGED = 'staged'
+
+
+class JournalJob(object):
+    """
+    One journaled backup. The archive stream is written into the stage file <id>.stage while it
+    is uploaded, the record <id>.json holds the backup object, the state (staging while the
+    stream is written, staged once it is complete), the multipart upload id and the parts
+    confirmed by Glacier with their tree hashes. The record is replaced atomically and synced
+    on every change, so after a crash it describes what is safely stored.
+
+    An ArchiveWriter with a journal writes into it and reports upload_started, part_done and done.
+    """
+    def __init__(self, journal, record):
+        self.journal = journal
+        self.record = record
+        self.lock = threading.RLock()
+        self.stage_file = None
+
+    @property
+    def id(self):
+        return self.record['id']
+
+    @property
+    def name(self):
+        return self.record['name']
+
+    @property
+    def state(self):
+        return self.record['state']
+
+    @property
+    def resumable(self):
+        return self.record['state'] == STAGED
+
+    @property
+    def upload_id(self):
+        return self.record['upload_id']
+
+    @property
+    def parts(self):
+        """Confirmed parts as {offset: hex tree hash}"""
+        return {int(offset): part_hash for offset, part_hash in self.record['parts'].items()}
+
+    @property
+    def path(self):
+        return os.path.join(self.journal.folder, self.id + '.json')
+
+    @property
+    def stage_path(self):
+        return os.path.join(self.journal.folder, self.id + '.stage')
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.record, f, default=json_datetime_serial)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.resumable:
+            # resumed from the stage file
+            return len(data)
+        if self.stage_file is None:
+            self.stage_file = open(self.stage_path, 'wb')
+        self.stage_file.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def upload_started(self, upload_id):
+        with self.lock:
+            self.record['upload_id'] = upload_id
+            self.save()
+
+    def part_done(self, offset, part_hash):
+        # called by the upload threads
+        with self.lock:
+            self.record['parts'][str(offset)] = part_hash
+            self.save()
+
+    def staged(self, arch_descr, members=None):
+        """
+        Marks the stream as complete, from now on the upload can be resumed from the stage file.
+        arch_descr is the final description, members the member rows to store with the archive.
+        """
+        if self.stage_file is None:
+            # empty stream
+            self.write(b'')
+        self.stage_file.flush()
+        os.fsync(self.stage_file.fileno())
+        self.stage_file.close()
+        with self.lock:
+            self.record['arch_descr'] = dict(arch_descr)
+            self.record['members'] = list(members) if members is not None else None
+            self.record['state'] = STAGED
+            self.save()
+
+    def open_stage(self):
+        return open(self.stage_path, 'rb')
+
+    def done(self, archive_id):
+        self.remove()
+
+    def remove(self):
+        if self.stage_file is not None:
+            self.stage_file.close()
+        for path in (self.path, self.stage_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class BackupJournal(object):
+    """
+    Folder of JournalJobs, the backups which were started and not finished
+    """
+    def __init__(self, folder):
+        self.folder = os.path.expanduser(folder)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    def create(self, name, arch_descr, part_size):
+        job = JournalJob(self, {'id': uuid.uuid4().hex, 'name': name, 'created': time.time(), 'state': STAGING,
+                                'arch_descr': dict(arch_descr), 'part_size': part_size, 'upload_id': None,
+                                'parts': {}, 'members': None})
+        job.save()
+        return job
+
+    def jobs(self, name=None):
+        """
+        The journaled jobs, of the backup object name if given, oldest first
+        """
+        jobs = []
+        for file_name in os.listdir(self.folder):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.folder, file_name)) as f:
+                    record = json.load(f)
+            except ValueError:
+                # not written completely, the atomic replace makes that a leftover temp file
+                continue
+            if name is None or record['name'] == name:
+                jobs.append(JournalJob(self, record))
+        return sorted(jobs, key=lambda job: job.record['created'])
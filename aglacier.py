@@ -1,17 +1,34 @@
 # encoding: utf-8
 import argparse
 import os
-import shelve
-import boto3
 import json
-from datetime import datetime
+import hashlib
+import binascii
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
 import random
 
+from agaws import GlacierClientPool
+from agcatalog import Catalog
+from agjobs import JobManager
+from agstream import SliceWriter, TeeWriter
+from aginventory import iter_inventory, archive_descr, parse_date
+
+MEGABYTE = 1024 * 1024
+
+# key of the running inventory retrieval job in the catalog
+INVENTORY_JOB = 'inventory'
+
 
 
 class ConfigError(Exception):
     pass
 
+
+class ChecksumMismatch(Exception):
+    pass
+
 def json_datetime_serial(obj):
     """JSON serializer for date objects not serializable by default json code"""
 
@@ -21,32 +38,263 @@ def json_datetime_serial(obj):
     raise TypeError("Type not serializable")
 
 
-class glacier_shelve(object):
+def chunk_hashes(data):
+    """SHA-256 digests of every 1 MiB chunk of data (the leaves of a Glacier tree hash)"""
+    if not data:
+        return [hashlib.sha256(b'').digest()]
+    return [hashlib.sha256(data[i:i + MEGABYTE]).digest() for i in range(0, len(data), MEGABYTE)]
+
+
+def tree_hash(hashes):
     """
-    Context manager for shelve
+    Combines SHA-256 digests pairwise until a single digest (the tree hash) is left.
+
+    Tree hashes of parts whose size is a power of two MiB can be combined the same way
+    as 1 MiB leaf hashes, which is how the multipart checksum is built.
     """
-    def __init__(self, shelve_file):
-        self.shelve_file = shelve_file
+    hashes = list(hashes)
+    while len(hashes) > 1:
+        combined = [hashlib.sha256(hashes[i] + hashes[i + 1]).digest() for i in range(0, len(hashes) - 1, 2)]
+        if len(hashes) % 2:
+            combined.append(hashes[-1])
+        hashes = combined
+    return hashes[0]
 
-    def __enter__(self):
-        self.shelve = shelve.open(self.shelve_file)
 
-        if "jobs" not in self.shelve:
-            self.shelve["jobs"] = dict()
+def hex_digest(digest):
+    return binascii.hexlify(digest).decode('ascii')
 
-        if "archive_objects" not in self.shelve:
-            self.shelve["archive_objects"] = dict()
 
-        return self.shelve
+class TreeHashWriter(object):
+    """
+    File like object computing the tree hash of everything written through it into out_file
+    (if given) while it streams by, the 1 MiB leaves are hashed incrementally so nothing is
+    buffered.
+    """
+    def __init__(self, out_file=None):
+        self.out_file = out_file
+        self.hashes = []
+        self.leaf = hashlib.sha256()
+        self.leaf_size = 0
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        view = memoryview(data)
+        self.size += len(view)
+        while len(view):
+            n = min(MEGABYTE - self.leaf_size, len(view))
+            self.leaf.update(view[:n])
+            self.leaf_size += n
+            view = view[n:]
+            if self.leaf_size == MEGABYTE:
+                self.hashes.append(self.leaf.digest())
+                self.leaf = hashlib.sha256()
+                self.leaf_size = 0
+        if self.out_file is not None:
+            self.out_file.write(data)
+        return len(data)
+
+    def flush(self):
+        if self.out_file is not None and hasattr(self.out_file, 'flush'):
+            self.out_file.flush()
+
+    def hexdigest(self):
+        hashes = self.hashes
+        if self.leaf_size or not hashes:
+            hashes = hashes + [self.leaf.digest()]
+        return hex_digest(tree_hash(hashes))
+
+
+class ArchiveWriter(object):
+    """
+    File like object uploading everything written to it as one archive.
+
+    Data is kept in memory until more than multipart_threshold bytes were written, then a
+    multipart upload is started and every full part is handed to the vault's pool of
+    upload_threads workers, which all writers share. At most two parts per worker are in
+    flight, so memory use is bounded no matter how large the archive gets. Smaller archives
+    are sent with a single upload_archive call.
+
+    Every part is taken from the throttle of the writer (a per object limit) and the upload
+    throttle of the vault before it is sent.
+
+    With a journal (agjournal.JournalJob) the stream is staged into the journal and the upload id
+    and every confirmed part are recorded. An upload error while the stream is written stops the
+    upload, the rest of the stream only goes into the journal and close() raises the error. If the
+    journal is staged by then, a failing close() keeps the multipart upload, so it can be continued
+    with resume().
+    """
+    def __init__(self, glacier_vault, arch_descr, print_info=False, record=True, throttle=None, journal=None):
+        self.glacier_vault = glacier_vault
+        self.record = record
+        self.arch_descr = arch_descr
+        self.print_info = print_info
+        self.description = json.dumps(arch_descr, default=json_datetime_serial)
+        self.part_size = glacier_vault.part_size
+        self.buffer = bytearray()
+        self.offset = 0
+        self.size = 0
+        self.multipart_upload = None
+        self.pending = deque()
+        self.part_hashes = []
+        self.closed = False
+        self.throttles = [t for t in (throttle, glacier_vault.upload_throttle) if t is not None]
+        self.journal = journal
+        self.upload_error = None
+        # offset -> tree hash of the parts uploaded before a resume
+        self.done_parts = {}
+        # write through into the restore cache
+        self.cache_writer = None
+        if glacier_vault.cache is not None and glacier_vault.cache_uploads:
+            self.cache_writer = glacier_vault.cache.writer()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.cache_writer is not None:
+            self.cache_writer.write(data)
+        if self.journal is not None:
+            self.journal.write(data)
+        if self.upload_error is not None:
+            # only staged, resume() uploads the rest
+            return len(data)
+        self.buffer += data
+        try:
+            if self.multipart_upload is None and len(self.buffer) > self.glacier_vault.multipart_threshold:
+                self.multipart_upload = self.glacier_vault.vault.initiate_multipart_upload(
+                    archiveDescription=self.description, partSize=str(self.part_size))
+                if self.journal is not None:
+                    self.journal.upload_started(self.multipart_upload.id)
+
+            if self.multipart_upload is not None:
+                while len(self.buffer) >= self.part_size:
+                    self._submit_part(bytes(self.buffer[:self.part_size]))
+                    del self.buffer[:self.part_size]
+        except Exception as e:
+            if self.journal is None:
+                raise
+            self.upload_error = e
+            self.buffer = bytearray()
+            if self.print_info:
+                print("Upload failed ({}), the rest of the stream is only staged for a resume".format(e))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit_part(self, data):
+        threads = self.glacier_vault.upload_threads
+        while len(self.pending) >= 2 * threads:
+            self.part_hashes.append(self.pending.popleft().result())
+        if self.offset in self.done_parts:
+            future = Future()
+            future.set_result(self.done_parts[self.offset])
+        elif self.journal is not None:
+            future = self.glacier_vault.upload_executor.submit(self._upload_journaled_part, self.offset, data)
+        else:
+            future = self.glacier_vault.upload_executor.submit(
+                self.glacier_vault._upload_part, self.multipart_upload.id, self.offset, data, self.throttles)
+        self.pending.append(future)
+        self.offset += len(data)
+        if self.print_info:
+            print("Uploading part {} ({} bytes)".format(self.offset // self.part_size, self.offset))
+
+    def _upload_journaled_part(self, offset, data):
+        part_hash = self.glacier_vault._upload_part(self.multipart_upload.id, offset, data, self.throttles)
+        self.journal.part_done(offset, hex_digest(part_hash))
+        return part_hash
+
+    def resume(self, upload_id, parts):
+        """
+        Continues the multipart upload upload_id, of which the parts ({offset: hex tree hash})
+        are confirmed. The whole stream has to be written again, confirmed parts are skipped.
+        """
+        self.multipart_upload = self.glacier_vault.vault.MultipartUpload(upload_id)
+        self.done_parts = {offset: binascii.unhexlify(part_hash) for offset, part_hash in parts.items()}
+
+    def close(self):
+        """
+        Uploads the remaining data, completes the upload and stores the archive in the catalog.
+        Returns the archive id.
+        """
+        if self.closed:
+            return self.arch_descr['id']
+        self.closed = True
+
+        if self.upload_error is not None:
+            # the parts still running are recorded when they are confirmed
+            wait(self.pending)
+            if not self.journal.resumable:
+                self.abort()
+            elif self.cache_writer is not None:
+                self.cache_writer.discard()
+            raise self.upload_error
+
+        if self.multipart_upload is None:
+            self.size = len(self.buffer)
+            for throttle in self.throttles:
+                throttle.consume(self.size)
+            checksum = hex_digest(tree_hash(chunk_hashes(self.buffer)))
+            archive_id = self.glacier_vault.vault.upload_archive(archiveDescription=self.description,
+                                                                 body=bytes(self.buffer), checksum=checksum).id
+        else:
+            try:
+                if self.buffer:
+                    self._submit_part(bytes(self.buffer))
+                while self.pending:
+                    self.part_hashes.append(self.pending.popleft().result())
+            except Exception:
+                if self.journal is None or not self.journal.resumable:
+                    self.abort()
+                else:
+                    # the parts still running are recorded when they are confirmed
+                    wait(self.pending)
+                raise
+            self.size = self.offset
+            checksum = hex_digest(tree_hash(self.part_hashes))
+            response = self.multipart_upload.complete(archiveSize=str(self.offset), checksum=checksum)
+            archive_id = response['archiveId']
+
+        self.buffer = bytearray()
+        self.arch_descr['size'] = self.size
+        # checked by every later download
+        self.arch_descr['checksum'] = checksum
+        if self.cache_writer is not None:
+            self.cache_writer.commit(archive_id)
+        if self.record:
+            self.glacier_vault._store_archive(self.arch_descr, archive_id)
+        else:
+            self.arch_descr['id'] = archive_id
+        if self.journal is not None:
+            self.journal.done(archive_id)
+        return archive_id
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.shelve.close()
+    def abort(self):
+        """
+        Drops the written data and aborts a started multipart upload
+        """
+        self.closed = True
+        self.buffer = bytearray()
+        if self.cache_writer is not None:
+            self.cache_writer.discard()
+        if self.journal is not None:
+            self.journal.remove()
+        for future in self.pending:
+            future.cancel()
+        wait(self.pending)
+        self.pending.clear()
+        if self.multipart_upload is not None:
+            self.multipart_upload.abort()
 
 
 class GlacierVault:
     """
     Wrapper for uploading/download archive to/from Amazon Glacier Vault
-    Makes use of shelve to store archive id corresponding to filename and waiting jobs.
+    Makes use of a SQLite catalog to store archive ids corresponding to names and waiting jobs.
 
     Backup:
     >>> GlacierVault("myvault")upload("myarchive", "myfile")
@@ -57,99 +305,485 @@ class GlacierVault:
     or to wait until the job is ready:
     >>> GlacierVault("myvault")retrieve("myarchive", "serverhealth2.py", True)
     """
-    def __init__(self, vault_name, access_key=None, secret_key=None, shelve_file="~/.glaciervault.db"):
+    def __init__(self, vault_name, access_key=None, secret_key=None, shelve_file="~/.glaciervault.db",
+                 part_size=8 * MEGABYTE, upload_threads=4, multipart_threshold=None, download_threads=4,
+                 catalog_file=None, poll_interval=60, max_poll_interval=1800, notifications=None, cache=None,
+                 cache_uploads=False, upload_throttle=None, download_throttle=None, max_connections=10, max_attempts=5,
+                 retry_mode='adaptive'):
         """
         Initialize the vault
+
+        part_size:
+            Size of the parts of a multipart upload, a power of two MiB between 1 MiB and 4 GiB.
+        upload_threads:
+            Number of parts uploaded concurrently.
+        multipart_threshold:
+            Archives larger than this are uploaded in parts, defaults to part_size.
+        download_threads:
+            Number of byte ranges of a job output downloaded concurrently, each range is part_size long.
+        catalog_file:
+            SQLite archive catalog, defaults to the shelve_file path with '.sqlite' appended.
+        poll_interval, max_poll_interval:
+            Seconds between checks for completed retrieval jobs, the interval grows up to
+            max_poll_interval while no job completes.
+        notifications:
+            queue.Queue like source of Glacier SNS job notifications, see JobManager.
+        cache:
+            RestoreCache serving retrievals of archives downloaded before.
+        cache_uploads:
+            Uploaded archives are written into the cache too.
+        upload_throttle, download_throttle:
+            Throttle shared by all uploads / downloads of the vault.
+        max_connections, max_attempts, retry_mode:
+            Connection pool size and retry settings of the AWS clients, see GlacierClientPool.
         """
+        if part_size < MEGABYTE or part_size > 4096 * MEGABYTE or part_size & (part_size - 1):
+            raise ConfigError("part_size must be a power of two MiB between 1 MiB and 4 GiB")
+        if upload_threads < 1 or download_threads < 1:
+            raise ConfigError("upload_threads and download_threads must be at least 1")
+
+        self.part_size = part_size
+        self.upload_threads = upload_threads
+        self.multipart_threshold = part_size if multipart_threshold is None else multipart_threshold
+        self.download_threads = download_threads
+        # shared by all uploads, so concurrent backups together use at most upload_threads connections
+        self.upload_executor = ThreadPoolExecutor(max_workers=upload_threads)
+        self.download_chunk_size = MEGABYTE
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.notifications = notifications
+        self.cache = cache
+        self.cache_uploads = cache_uploads
+        self.upload_throttle = upload_throttle
+        self.download_throttle = download_throttle
+
         # layer2 = boto.connect_glacier(aws_access_key_id = ACCESS_KEY_ID,
         #                             aws_secret_access_key = SECRET_ACCESS_KEY)
-        # Or via the Session
-        if access_key and secret_key:
-            session = boto3.Session(
-                aws_access_key_id=access_key,
-                aws_secret_access_key=secret_key,
-            )
-        else:
-            session = boto3.Session()
-
-        glacier = session.resource('glacier')
-        self.vault = glacier.Vault('-', vault_name)
+        # Or via the Session, created when the vault is used first
+        self.vault_name = vault_name
+        self.clients = GlacierClientPool(access_key, secret_key, max_connections, max_attempts, retry_mode)
+        self._vault = None
         self.shelve_file = os.path.expanduser(shelve_file)
+
+        # the catalog replaces the shelve, an existing shelve is imported on first use
+        if catalog_file is None:
+            catalog_file = self.shelve_file + '.sqlite'
+        self.catalog = Catalog(os.path.expanduser(catalog_file))
+        self.catalog.migrate_shelve(self.shelve_file)
         # self.vault = layer2.get_vault(vault_name)
 
-    def upload(self, fileobj, arch_descr, print_info=False, dummy=False):
+    @property
+    def vault(self):
         """
-        Upload filename and store the archive id for future retrieval
+        The boto3 Vault of the calling thread, or the vault object set instead (e.g. a LocalVault)
         """
+        if self._vault is not None:
+            return self._vault
+        return self.clients.vault(self.vault_name)
 
-        if print_info:
-            print("Uploading '{}'".format(arch_descr))
+    @vault.setter
+    def vault(self, vault):
+        self._vault = vault
 
+    def upload(self, fileobj, arch_descr, print_info=False, dummy=False):
+        """
+        Upload filename and store the archive id for future retrieval
+        """
         fileobj.seek(0)
         if not dummy:
-            archive = self.vault.upload_archive(
-                archiveDescription=json.dumps(arch_descr, default=json_datetime_serial),
-                body=fileobj
-            )
+            upload = self.open_upload(arch_descr, print_info)
+            try:
+                while True:
+                    data = fileobj.read(self.part_size)
+                    if not data:
+                        break
+                    upload.write(data)
+            except Exception:
+                upload.abort()
+                raise
+            upload.close()
         else:
+            if print_info:
+                print("Uploading '{}'".format(arch_descr))
             arch_id = random.randint(0, 9999999999)
             d = open("vault/f{}.txt".format(arch_id), 'wb')
             d.write(fileobj.read())
             d.close()
+            self._store_archive(arch_descr, arch_id)
 
-        # Storing the filename => archive_id data.
-        with glacier_shelve(self.shelve_file) as d:
-            archive_objects = d["archive_objects"]
+    def open_upload(self, arch_descr, print_info=False, record=True, throttle=None, journal=None):
+        """
+        Returns an ArchiveWriter, everything written to it is uploaded as one archive.
+        If record is set, the archive is stored in the catalog when the writer is closed.
+        throttle limits this upload in addition to the upload_throttle of the vault, journal
+        makes it resumable (see ArchiveWriter).
+        """
+        if print_info:
+            print("Uploading '{}'".format(arch_descr))
+        return ArchiveWriter(self, arch_descr, print_info, record, throttle, journal)
 
-            if not dummy:
-                arch_descr['id'] = archive.id
+    def abort_orphaned_uploads(self, keep=(), older_than=timedelta(days=1), print_info=False):
+        """
+        Aborts the multipart uploads of this tool (the description is an archive description)
+        started more than older_than ago and not in keep, e.g. left by a crashed backup without
+        journal. Glacier keeps such uploads and their parts until they are aborted.
+        Returns the number of aborted uploads.
+        """
+        aborted = 0
+        for multipart_upload in self.vault.multipart_uploads.all():
+            if multipart_upload.id in keep:
+                continue
+            try:
+                description = json.loads(multipart_upload.archive_description)
+            except (TypeError, ValueError):
+                continue
+            if not isinstance(description, dict) or 'name' not in description:
+                continue
+            if datetime.now() - parse_date(multipart_upload.creation_date) < older_than:
+                continue
+            if print_info:
+                print("Aborting orphaned upload of '{}' started {}".format(description['name'],
+                                                                          multipart_upload.creation_date))
+            multipart_upload.abort()
+            aborted += 1
+        return aborted
+
+    def delete_archives(self, archive_ids, threads=4, print_info=False):
+        """
+        Deletes the archives from the vault, threads at a time, and removes the deleted ones from
+        the catalog (in one transaction) and the cache.
+        Returns the ids of the deleted archives and {archive id: exception} of the failed ones.
+        """
+        def delete(archive_id):
+            self.vault.Archive(archive_id).delete()
+            if print_info:
+                print("Deleted archive {}".format(archive_id))
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [(archive_id, executor.submit(delete, archive_id)) for archive_id in archive_ids]
+        deleted = []
+        failed = {}
+        for archive_id, future in futures:
+            if future.exception() is not None:
+                failed[archive_id] = future.exception()
             else:
-                arch_descr['id'] = arch_id
-            archive_objects[arch_descr['name']] = {arch_descr['id']: arch_descr}
+                deleted.append(archive_id)
+
+        with self.catalog.transaction():
+            for archive_id in deleted:
+                self.catalog.delete_archive(archive_id)
+        if self.cache is not None:
+            for archive_id in deleted:
+                self.cache.remove(archive_id)
+        return deleted, failed
+
+    def _store_archive(self, arch_descr, archive_id):
+        # Storing the filename => archive_id data, every version is kept
+        arch_descr['id'] = archive_id
+        self.catalog.add_archive(arch_descr)
+
+    def _upload_part(self, upload_id, offset, data, throttles=()):
+        # the upload resource of the calling thread, boto3 resources must not be shared between threads
+        multipart_upload = self.vault.MultipartUpload(upload_id)
+        for throttle in throttles:
+            throttle.consume(len(data))
+        part_hash = tree_hash(chunk_hashes(data))
+        multipart_upload.upload_part(range='bytes {}-{}/*'.format(offset, offset + len(data) - 1),
+                                     checksum=hex_digest(part_hash),
+                                     body=data)
+        return part_hash
+
+    def _copy_stream(self, source, fileobj):
+        while True:
+            data = source.read(self.download_chunk_size)
+            if not data:
+                break
+            fileobj.write(data)
+
+    def _download_output(self, job, archive_id, fileobj, print_info=False, resumable=False):
+        """
+        Downloads the job output in byte ranges of part_size using download_threads workers.
+        Every range is checked against its tree hash.
+
+        If resumable (fileobj must be a seekable file kept between attempts), ranges are written at
+        their offset as they arrive and the finished ranges are recorded in the catalog, so an
+        interrupted download continues where it stopped when called again with the same file. The
+        recorded ranges are read back from the file and hashed again first, ranges which don't
+        match are downloaded again. Otherwise ranges are written in order and at most two ranges per worker are held in memory.
+        """
+        size = int(job.archive_size_in_bytes)
+        starts = list(range(0, size, self.part_size))
+
+        range_hashes = {}
+        if resumable:
+            range_hashes = self._check_ranges(fileobj, archive_id, self.catalog.download_ranges(
+                archive_id, self.part_size), size)
+            if print_info and range_hashes:
+                print("Resuming download, {} of {} ranges already done".format(len(range_hashes), len(starts)))
+
+        todo = [start for start in starts if start not in range_hashes]
+        executor = ThreadPoolExecutor(max_workers=self.download_threads)
+        pending = deque()
+        try:
+            for start in todo:
+                if len(pending) >= 2 * self.download_threads:
+                    self._write_ranges(pending, fileobj, archive_id, range_hashes, resumable)
+                end = min(start + self.part_size, size) - 1
+                pending.append(executor.submit(self._download_range, job.id, start, end,
+                                               throttle=self.download_throttle))
+                if print_info:
+                    print("Downloading bytes {}-{} of {}".format(start, end, size))
+
+            while pending:
+                self._write_ranges(pending, fileobj, archive_id, range_hashes, resumable)
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            if resumable:
+                # keep the ranges which did arrive for the next attempt
+                self._write_ranges(pending, fileobj, archive_id, range_hashes, resumable, raise_errors=False)
+            raise
+        executor.shutdown()
+
+        if size:
+            actual = hex_digest(tree_hash(binascii.unhexlify(range_hashes[start]) for start in starts))
+            if getattr(job, 'sha256_tree_hash', None) and actual != job.sha256_tree_hash:
+                raise ChecksumMismatch("tree hash of archive {} does not match: {} != {}".format(
+                    archive_id, actual, job.sha256_tree_hash))
+            self.check_tree_hash(archive_id, actual)
+
+        if resumable:
+            self.catalog.clear_download(archive_id)
+
+    def _check_ranges(self, fileobj, archive_id, range_hashes, size):
+        """
+        Returns the recorded ranges of a partial download which the file really holds. If the
+        file is shorter than the recorded ranges (e.g. it was removed), the record is dropped.
+        """
+        if not range_hashes:
+            return range_hashes
+        fileobj.seek(0, os.SEEK_END)
+        if fileobj.tell() < max(min(start + self.part_size, size) for start in range_hashes):
+            self.catalog.clear_download(archive_id)
+            return {}
+        checked = {}
+        for start, range_hash in range_hashes.items():
+            fileobj.seek(start)
+            data = fileobj.read(min(start + self.part_size, size) - start)
+            if hex_digest(tree_hash(chunk_hashes(data))) == range_hash:
+                checked[start] = range_hash
+        return checked
+
+    def check_tree_hash(self, archive_id, actual):
+        """
+        Raises ChecksumMismatch if the catalog recorded another tree hash for the archive at upload
+        """
+        arch_descr = self.catalog.get_archive(archive_id)
+        if arch_descr is not None and 'checksum' in arch_descr and arch_descr['checksum'] != actual:
+            raise ChecksumMismatch("tree hash of archive {} does not match the one recorded at upload: {} != {}".format(
+                archive_id, actual, arch_descr['checksum']))
 
-            #write to shelve
-            d["archive_objects"] = archive_objects
+    def _write_ranges(self, pending, fileobj, archive_id, range_hashes, resumable, raise_errors=True):
+        """
+        Writes downloaded ranges from pending. Resumable files get every finished range at its
+        offset and the ranges are recorded in the catalog, other files get the next range in order.
+        """
+        if not resumable:
+            start, data, range_hash = pending.popleft().result()
+            fileobj.write(data)
+            range_hashes[start] = range_hash
+            return
+
+        if raise_errors:
+            wait(pending, return_when=FIRST_COMPLETED)
+        error = None
+        finished_ranges = {}
+        for future in [f for f in pending if f.done()]:
+            pending.remove(future)
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                error = error or future.exception()
+                continue
+            start, data, range_hash = future.result()
+            fileobj.seek(start)
+            fileobj.write(data)
+            finished_ranges[start] = range_hash
+        fileobj.flush()
+        if finished_ranges and hasattr(fileobj, 'fileno'):
+            # the ranges are only recorded once they are on disk
+            os.fsync(fileobj.fileno())
+
+        range_hashes.update(finished_ranges)
+        self.catalog.add_download_ranges(archive_id, self.part_size, finished_ranges)
+
+        if error is not None and raise_errors:
+            raise error
+
+    def _download_range(self, job_id, start, end, attempts=3, throttle=None):
+        # the job resource of the calling thread, boto3 resources must not be shared between threads
+        job = self.vault.Job(job_id)
+        for attempt in range(attempts):
+            response = job.get_output(range='bytes={}-{}'.format(start, end))
+            if throttle is None:
+                data = response['body'].read()
+            else:
+                # reading slower than the network delivers throttles the connection
+                data = bytearray()
+                while True:
+                    chunk = response['body'].read(MEGABYTE)
+                    if not chunk:
+                        break
+                    throttle.consume(len(chunk))
+                    data += chunk
+                data = bytes(data)
+            response['body'].close()
+
+            range_hash = hex_digest(tree_hash(chunk_hashes(data)))
+            if len(data) == end - start + 1 and response.get('checksum', range_hash) == range_hash:
+                return start, data, range_hash
+
+        raise ChecksumMismatch("bytes {}-{} of job {} failed the tree hash check {} times".format(
+            start, end, job.id, attempts))
 
     def get_archive_list(self, arch_obj_name=None):
         """
+        Returns {name: {archive id: description}} of all archives or {archive id: description}
+        of the versions of arch_obj_name, None if there are none.
+        """
+        if arch_obj_name is None:
+            return self.catalog.archive_objects()
+
+        return self.catalog.versions(arch_obj_name) or None
+
+    def get_latest(self, arch_obj_name, archive_id=None):
+        """
+        Returns the description of the newest version of arch_obj_name, optionally the newest one
+        with an id starting with archive_id. Answered by the catalog index, no sorting needed.
+        """
+        return self.catalog.latest(arch_obj_name, archive_id)
+
+    def get_archive(self, archive_id):
+        return self.catalog.get_archive(archive_id)
 
+    @staticmethod
+    def _job_key(archive_id, byte_range=None):
         """
-        with glacier_shelve(self.shelve_file) as d:
-            archive_objects = d["archive_objects"]
+        Key of a retrieval job in the catalog, jobs for a byte range are kept apart from the archive's job
+        """
+        if byte_range is None:
+            return archive_id
+        return '{}@{}'.format(archive_id, byte_range)
 
-            if arch_obj_name is None:
-                return archive_objects
+    def _get_job(self, archive_id, print_info=False, byte_range=None):
+        """
+        Loads the retrieval job of the archive (or of its byte_range 'start-end') stored in the
+        catalog or initiates a new one
+        """
+        job = None
+        job_key = self._job_key(archive_id, byte_range)
+        job_id = self.catalog.get_job(job_key)
 
-            if arch_obj_name in archive_objects:
-                return archive_objects[arch_obj_name]
+        if job_id is not None:
+            if print_info:
+                print('Some job for this archive found in catalog. Trying to load it')
+            # The job is already in the catalog
+            try:
+                job = self.vault.Job(job_id)
+                job.load()
+                if print_info:
+                    print('Retrive job loaded from AWS.')
+            except Exception as e:
+                job = None
+                # todo catch ResourceNotFoundException
+                if print_info:
+                    print('Error while trying to load Job.')
+                    print(e)
+
+        if not job:
+            if print_info:
+                print('No job for this archive found. Creating new retrive job.')
+            # Job initialization
+            if byte_range is None:
+                job = self.vault.Archive(archive_id).initiate_archive_retrieval()
+            else:
+                # the Archive resource can't retrieve a range, the client call can
+                response = self.vault.meta.client.initiate_job(
+                    accountId='-', vaultName=self.vault.name,
+                    jobParameters={'Type': 'archive-retrieval', 'ArchiveId': archive_id,
+                                   'RetrievalByteRange': byte_range})
+                job = self.vault.Job(response['jobId'])
+                job.load()
+            # job = self.vault.retrieve_archive(archive_id)
+            self.catalog.set_job(job_key, job.id)
+
+        return job
+
+    def sync_inventory(self, wait_mode=False, print_info=False):
+        """
+        Rebuilds the catalog from the vault inventory: starts an inventory retrieval job (or
+        loads the running one) and, once it completed, adds the archives missing in the catalog.
+        Archives uploaded two days or more before the inventory which are not in it were
+        deleted from the vault, they are removed. The inventory is parsed as it is downloaded.
+        Returns (added, removed) or None if the job is not completed yet.
+        """
+        import time
+        job = None
+        job_id = self.catalog.get_job(INVENTORY_JOB)
+        if job_id is not None:
+            try:
+                job = self.vault.Job(job_id)
+                job.load()
+            except Exception as e:
+                job = None
+                if print_info:
+                    print('Error while trying to load the inventory job: {}'.format(e))
+        if job is None:
+            if print_info:
+                print('Starting inventory retrieval job.')
+            job = self.vault.initiate_inventory_retrieval()
+            self.catalog.set_job(INVENTORY_JOB, job.id)
+
+        interval = self.poll_interval
+        while wait_mode and not job.completed:
+            if print_info:
+                print("Inventory job {}, next check in {:.0f} s".format(job.status_code, interval))
+            time.sleep(interval)
+            job.load()
+            interval = min(interval * 2, self.max_poll_interval)
 
-        return None
+        if not job.completed:
+            if print_info:
+                print("Inventory job not ready yet, it takes about 4 hours.")
+            return None
+
+        entries = iter_inventory(job.get_output()['body'])
+        inventory_date = next(entries)
+        older_than = None
+        if inventory_date:
+            older_than = parse_date(inventory_date) - timedelta(days=2)
+        # packs of deduplicated backups are not recorded in the catalog
+        archives = (arch_descr for arch_descr in map(archive_descr, entries) if arch_descr.get('type') != 'pack')
+        added, removed = self.catalog.sync_inventory(archives, older_than)
+        self.catalog.delete_job(INVENTORY_JOB)
+        if print_info:
+            print("Inventory of {}: {} archives added to the catalog, {} removed".format(
+                inventory_date, added, removed))
+        return added, removed
 
-    # def get_latest_name(self, search_name):
-    #     with glacier_shelve(self.shelve_file) as d:
-    #         archives = d["archives"]
-    #
-    #         latest = None
-    #         for archive_name in sorted(archives):
-    #             m = re.search('(.*)_\d{4}-\d{2}-\d{2}', archive_name)
-    #             rest = None
-    #             if m:
-    #                 rest = m.group(1)
-    #             if archive_name == search_name or rest == search_name:
-    #                 latest = archive_name
-    #
-    #     if latest is None:
-    #         raise NameError('No latest archive found for \'{}\''.format(search_name))
-    #
-    #     return latest
+    def start_retrieval(self, archive_id, print_info=False):
+        """
+        Makes sure a retrieval job for the archive is running, returns True if it is completed
+        """
+        return self._get_job(archive_id, print_info).completed
 
-    def retrieve(self, archive_id, fileobj, wait_mode=False, print_info=False, dummy=False):
+    def retrieve(self, archive_id, fileobj, wait_mode=False, print_info=False, dummy=False, resume=False):
         """
         Initiate a Job, check its status, and download the archive when it's completed.
+        With resume, fileobj has to be a seekable file which is reused when the download is retried.
         """
         if dummy:
             d = open("vault/f{}.txt".format(archive_id), 'rb')
-            fileobj.write(d.read())
+            self._copy_stream(d, fileobj)
             d.close()
             return True
         # archive_id = self.get_archive_id(archive_name)
@@ -159,70 +793,96 @@ class GlacierVault:
         # elif print_info:
         #         print('Getting archive: {}'.format(archive_name))
 
-        with glacier_shelve(self.shelve_file) as d:
-            jobs = d["jobs"]
-            job = None
-
-            if archive_id in jobs:
-                if print_info:
-                    print('Some job for this archive found in shelve. Trying to load it')
-                # The job is already in shelve
-                job_id = jobs[archive_id]
-                try:
-                    job = self.vault.Job(job_id)
-                    job.load()
-                    if print_info:
-                        print('Retrive job loaded from AWS.')
-                except Exception as e:
-                    job = None
-                    # todo catch ResourceNotFoundException
-                    if print_info:
-                        print('Error while trying to load Job.')
-                        print(e)
-
-            if not job:
-                if print_info:
-                    print('No job for this archive found. Creating new retrive job.')
-                # Job initialization
-                job = self.vault.Archive(archive_id).initiate_archive_retrieval()
-                # job = self.vault.retrieve_archive(archive_id)
-                jobs[archive_id] = job.id
-                job_id = job.id
-
-            # Commiting changes in shelve
-            d["jobs"] = jobs
-
-        # checking manually if job is completed every 600 secondes instead of using Amazon SNS
-        if wait_mode:
-            import time
-            while not job.completed:
-                job = self.vault.Job(job_id)
-                if print_info:
-                    print("Job {action}: {status_code} ({creation_date}/{completion_date})".format(
-                        action=job.action,
-                        status_code=job.status_code,
-                        creation_date=job.creation_date,
-                        completion_date=job.completion_date))
-                time.sleep(600)
+        return self.retrieve_many({archive_id: fileobj}, wait_mode, print_info, resume)
 
+    def _download_cached(self, job, archive_id, fileobj, print_info=False, resumable=False):
+        """
+        _download_output, adding the archive to the cache if there is one
+        """
+        if self.cache is None:
+            self._download_output(job, archive_id, fileobj, print_info, resumable)
+        elif resumable:
+            self._download_output(job, archive_id, fileobj, print_info, resumable)
+            self.cache.put(archive_id, fileobj)
         else:
+            cache_writer = self.cache.writer()
+            try:
+                self._download_output(job, archive_id, TeeWriter(fileobj, cache_writer), print_info)
+            except BaseException:
+                cache_writer.discard()
+                raise
+            cache_writer.commit(archive_id)
+
+    def retrieve_range(self, archive_id, start, end, fileobj, wait_mode=False, print_info=False, size=None):
+        """
+        Retrieves only the bytes start to end (inclusive) of the archive into fileobj, returns
+        True if they were downloaded. Glacier retrieves whole MiB, so the job covers the
+        surrounding aligned range, the output is checked against its tree hash. size is the
+        size of the archive, taken from the catalog if not given.
+        """
+        if size is None:
+            arch_descr = self.catalog.get_archive(archive_id)
+            size = arch_descr['size'] if arch_descr is not None and 'size' in arch_descr else None
+        if size is None:
+            raise ValueError("size of archive {} unknown, it can only be retrieved as a whole".format(archive_id))
+
+        aligned_start = start // MEGABYTE * MEGABYTE
+        aligned_end = min((end // MEGABYTE + 1) * MEGABYTE, size) - 1
+        byte_range = '{}-{}'.format(aligned_start, aligned_end)
+        if self.cache is not None and self.cache.get(archive_id, fileobj, start, end):
             if print_info:
-                print("Job {action}: {status_code} ({creation_date}/{completion_date})".format(
-                    action=job.action,
-                    status_code=job.status_code,
-                    creation_date=job.creation_date,
-                    completion_date=job.completion_date))
-
-        if job.completed:
-            if print_info:
-                print("Downloading...")
-            response = job.get_output()
-
-            fileobj.write(response['body'].read())
-
+                print("Archive {} served from the cache".format(archive_id))
             return True
 
-        else:
+        slicer = SliceWriter(fileobj, start - aligned_start, end - start + 1)
+
+        manager = JobManager(self, self.poll_interval, self.max_poll_interval, notifications=self.notifications,
+                             print_info=print_info)
+        pending = manager.retrieve({archive_id: slicer}, self._download_job_output, wait_mode,
+                                   byte_ranges={archive_id: byte_range})
+        if pending:
             if print_info:
                 print("Job not ready yet.")
             return False
+        slicer.finish()
+        return True
+
+    def _download_job_output(self, job, archive_id, fileobj):
+        """
+        Streams the whole output of a (ranged) job into fileobj, checking it against its tree hash
+        """
+        response = job.get_output()
+        hashes = []
+        while True:
+            data = response['body'].read(MEGABYTE)
+            if not data:
+                break
+            if self.download_throttle is not None:
+                self.download_throttle.consume(len(data))
+            hashes.extend(chunk_hashes(data))
+            fileobj.write(data)
+        if response.get('checksum') and hashes and hex_digest(tree_hash(hashes)) != response['checksum']:
+            raise ChecksumMismatch("tree hash of the output of job {} does not match".format(job.id))
+
+    def retrieve_many(self, targets, wait_mode=False, print_info=False, resume=False):
+        """
+        Retrieves all archives of targets ({archive id: fileobj}) at once, every archive is
+        downloaded as soon as its job completes. Returns True if all of them were downloaded.
+        """
+        if self.cache is not None:
+            cached = [archive_id for archive_id, fileobj in targets.items() if self.cache.get(archive_id, fileobj)]
+            if cached and print_info:
+                print("Archive(s) {} served from the cache".format(', '.join(cached)))
+            targets = {archive_id: fileobj for archive_id, fileobj in targets.items() if archive_id not in cached}
+            if not targets:
+                return True
+
+        manager = JobManager(self, self.poll_interval, self.max_poll_interval, notifications=self.notifications,
+                             print_info=print_info)
+        pending = manager.retrieve(
+            targets, lambda job, archive_id, fileobj: self._download_cached(job, archive_id, fileobj, print_info,
+                                                                            resume),
+            wait_mode)
+        if pending and print_info:
+            print("Job not ready yet.")
+        return not pending
@@ -0,0 +1,315 @@
+# encoding: utf-8
+import io
+import json
+import os
+import uuid
+from datetime import datetime, timezone
+from aglacier import chunk_hashes, tree_hash, hex_digest
+
+
+class LocalVaultError(Exception):
+    pass
+
+
+class LocalJob(object):
+    """
+    Stand-in for boto3's Job resource. Jobs complete once the vault's job_delay polls passed.
+    """
+    def __init__(self, vault, job_id, archive_id, byte_range=None):
+        self.vault = vault
+        self.id = job_id
+        self.archive_id = archive_id
+        self.retrieval_byte_range = byte_range
+        self.action = 'ArchiveRetrieval'
+        self.creation_date = datetime.now().isoformat()
+        self.completion_date = None
+        self.polls = 0
+        self.completed = False
+        self.status_code = 'InProgress'
+        self.archive_size_in_bytes = os.path.getsize(vault.data_path(archive_id))
+        self.sha256_tree_hash = vault.read_meta(archive_id)['checksum']
+        if byte_range is not None:
+            with open(vault.data_path(archive_id), 'rb') as f:
+                self.sha256_tree_hash = hex_digest(tree_hash(chunk_hashes(self._read_range(f, None))))
+        self.load()
+
+    def _read_range(self, f, range):
+        """
+        Reads the 'bytes=start-end' range of the job output, which is the retrieved byte range
+        """
+        first, last = 0, self.archive_size_in_bytes - 1
+        if self.retrieval_byte_range is not None:
+            first, last = (int(x) for x in self.retrieval_byte_range.split('-'))
+        start, end = 0, last - first
+        if range is not None:
+            start, end = (int(x) for x in range.split('=')[1].split('-'))
+        f.seek(first + start)
+        return f.read(end - start + 1)
+
+    def load(self):
+        if self.polls >= self.vault.job_delay:
+            self.completed = True
+            self.status_code = 'Succeeded'
+            self.completion_date = self.completion_date or datetime.now().isoformat()
+        self.polls += 1
+
+    def get_output(self, range=None):
+        """
+        Serves the archive, or the given 'bytes=start-end' range of it, from the vault folder
+        """
+        if not self.completed:
+            raise LocalVaultError("job {} is not completed".format(self.id))
+        f = open(self.vault.data_path(self.archive_id), 'rb')
+        if range is None and self.retrieval_byte_range is None:
+            return {'body': f, 'status': 200, 'checksum': self.sha256_tree_hash}
+
+        data = self._read_range(f, range)
+        f.close()
+        if range is None:
+            return {'body': io.BytesIO(data), 'status': 200, 'checksum': self.sha256_tree_hash}
+        start, end = (int(x) for x in range.split('=')[1].split('-'))
+        response = {'body': io.BytesIO(data), 'status': 206, 'contentRange': 'bytes {}-{}'.format(start, end)}
+        if start % (1024 * 1024) == 0:
+            response['checksum'] = hex_digest(tree_hash(chunk_hashes(data)))
+        return response
+
+
+class LocalInventoryJob(object):
+    """
+    Stand-in for an inventory retrieval Job, its output is the vault inventory JSON
+    """
+    def __init__(self, vault, job_id):
+        self.vault = vault
+        self.id = job_id
+        self.action = 'InventoryRetrieval'
+        self.archive_id = None
+        self.completed = False
+        self.status_code = 'InProgress'
+        self.polls = 0
+        self.load()
+
+    def load(self):
+        if self.polls >= self.vault.job_delay:
+            self.completed = True
+            self.status_code = 'Succeeded'
+        self.polls += 1
+
+    def get_output(self, range=None):
+        if not self.completed:
+            raise LocalVaultError("job {} is not completed".format(self.id))
+        archives = []
+        for name in sorted(os.listdir(self.vault.folder)):
+            if not name.endswith('.json'):
+                continue
+            archive_id = name[:-len('.json')]
+            meta = self.vault.read_meta(archive_id)
+            mtime = datetime.fromtimestamp(os.path.getmtime(self.vault.data_path(archive_id)), timezone.utc)
+            archives.append({'ArchiveId': archive_id, 'ArchiveDescription': meta['description'],
+                             'CreationDate': mtime.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                             'Size': os.path.getsize(self.vault.data_path(archive_id)),
+                             'SHA256TreeHash': meta['checksum']})
+        inventory = {'VaultARN': 'arn:aws:glacier:local:0:vaults/' + self.vault.name,
+                     'InventoryDate': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                     'ArchiveList': archives}
+        return {'body': io.BytesIO(json.dumps(inventory).encode('utf-8')), 'status': 200}
+
+
+class LocalArchive(object):
+    def __init__(self, vault, archive_id):
+        self.vault = vault
+        self.id = archive_id
+
+    def initiate_archive_retrieval(self):
+        if not os.path.exists(self.vault.data_path(self.id)):
+            raise LocalVaultError("archive {} does not exist".format(self.id))
+        job = LocalJob(self.vault, uuid.uuid4().hex, self.id)
+        self.vault.jobs[job.id] = job
+        return job
+
+    def delete(self):
+        if not os.path.exists(self.vault.data_path(self.id)):
+            raise LocalVaultError("archive {} does not exist".format(self.id))
+        os.remove(self.vault.data_path(self.id))
+        os.remove(self.vault.data_path(self.id) + '.json')
+
+
+class LocalClient(object):
+    """
+    Stand-in for the client behind the vault resource (vault.meta.client), only initiate_job
+    """
+    def __init__(self, vault):
+        self.vault = vault
+
+    def initiate_job(self, accountId, vaultName, jobParameters):
+        archive_id = jobParameters['ArchiveId']
+        if not os.path.exists(self.vault.data_path(archive_id)):
+            raise LocalVaultError("archive {} does not exist".format(archive_id))
+        job = LocalJob(self.vault, uuid.uuid4().hex, archive_id, jobParameters.get('RetrievalByteRange'))
+        self.vault.jobs[job.id] = job
+        return {'jobId': job.id}
+
+
+class LocalCompletedJobs(object):
+    """
+    Stand-in for the vault's completed_jobs collection, every listing counts as one poll of all jobs
+    """
+    def __init__(self, vault):
+        self.vault = vault
+
+    def all(self):
+        self.vault.list_jobs_calls += 1
+        for job in list(self.vault.jobs.values()):
+            if not job.completed:
+                job.load()
+        return [job for job in self.vault.jobs.values() if job.completed]
+
+
+class LocalMultipartUpload(object):
+    """
+    Stand-in for boto3's MultipartUpload resource, parts are written into a file in the vault
+    folder. Open uploads are recorded in <id>.upload, so they survive the process like in Glacier.
+    """
+    def __init__(self, vault, description, part_size, upload_id=None, creation_date=None):
+        self.vault = vault
+        self.id = upload_id or uuid.uuid4().hex
+        self.description = description
+        self.archive_description = description
+        self.part_size = int(part_size)
+        self.part_size_in_bytes = self.part_size
+        self.creation_date = creation_date or datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        self.path = os.path.join(vault.folder, self.id + '.part')
+        self.parts = {}
+        self.aborted = False
+        if upload_id is None:
+            open(self.path, 'wb').close()
+            with open(self.path[:-len('.part')] + '.upload', 'w') as f:
+                json.dump({'description': description, 'part_size': self.part_size,
+                           'creation_date': self.creation_date}, f)
+
+    def upload_part(self, range, body, checksum=None):
+        if self.aborted:
+            raise LocalVaultError("upload {} was aborted".format(self.id))
+        start, end = (int(x) for x in range.split(' ')[1].split('/')[0].split('-'))
+        if len(body) != end - start + 1:
+            raise LocalVaultError("part size does not match range {}".format(range))
+        if start % self.part_size or len(body) > self.part_size:
+            raise LocalVaultError("part {} is not aligned to the part size".format(range))
+        part_hash = hex_digest(tree_hash(chunk_hashes(body)))
+        if checksum is not None and checksum != part_hash:
+            raise LocalVaultError("checksum mismatch for part {}".format(range))
+
+        with open(self.path, 'r+b') as f:
+            f.seek(start)
+            f.write(body)
+        self.parts[start] = part_hash
+        return {'checksum': part_hash}
+
+    def complete(self, archiveSize, checksum):
+        size = os.path.getsize(self.path)
+        if size != int(archiveSize):
+            raise LocalVaultError("archive size {} does not match {}".format(size, archiveSize))
+        with open(self.path, 'rb') as f:
+            actual = self.vault.file_tree_hash(f)
+        if actual != checksum:
+            raise LocalVaultError("tree hash mismatch: {} != {}".format(actual, checksum))
+
+        archive_id = uuid.uuid4().hex
+        os.rename(self.path, self.vault.data_path(archive_id))
+        os.remove(self.path[:-len('.part')] + '.upload')
+        self.vault.write_meta(archive_id, self.description, checksum)
+        return {'archiveId': archive_id, 'checksum': checksum, 'location': archive_id}
+
+    def abort(self):
+        self.aborted = True
+        for path in (self.path, self.path[:-len('.part')] + '.upload'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class LocalMultipartUploads(list):
+    """
+    The uploads initiated through the vault object, all() lists the open uploads of the vault folder
+    """
+    def __init__(self, vault):
+        super().__init__()
+        self.vault = vault
+
+    def all(self):
+        return [self.vault.MultipartUpload(name[:-len('.upload')]) for name in sorted(os.listdir(self.vault.folder))
+                if name.endswith('.upload')]
+
+
+class LocalVault(object):
+    """
+    Stand-in for a boto3 Glacier Vault resource that keeps archives in a local folder.
+    Used by the tests and for dry runs without an AWS account.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.name = os.path.basename(os.path.abspath(folder))
+        self.multipart_uploads = LocalMultipartUploads(self)
+        self.jobs = {}
+        self.job_delay = 0
+        self.list_jobs_calls = 0
+        self.completed_jobs = LocalCompletedJobs(self)
+        self.meta = type('Meta', (), {'client': LocalClient(self)})()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def data_path(self, archive_id):
+        return os.path.join(self.folder, archive_id)
+
+    def write_meta(self, archive_id, description, checksum):
+        with open(self.data_path(archive_id) + '.json', 'w') as f:
+            json.dump({'description': description, 'checksum': checksum}, f)
+
+    def read_meta(self, archive_id):
+        with open(self.data_path(archive_id) + '.json') as f:
+            return json.load(f)
+
+    @staticmethod
+    def file_tree_hash(f):
+        hashes = []
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            hashes.extend(chunk_hashes(data))
+        return hex_digest(tree_hash(hashes or chunk_hashes(b'')))
+
+    def upload_archive(self, archiveDescription, body, checksum=None):
+        archive_id = uuid.uuid4().hex
+        data = body.read() if hasattr(body, 'read') else body
+        actual = hex_digest(tree_hash(chunk_hashes(data)))
+        if checksum is not None and checksum != actual:
+            raise LocalVaultError("tree hash mismatch: {} != {}".format(actual, checksum))
+        with open(self.data_path(archive_id), 'wb') as f:
+            f.write(data)
+        self.write_meta(archive_id, archiveDescription, actual)
+        return LocalArchive(self, archive_id)
+
+    def initiate_multipart_upload(self, archiveDescription, partSize):
+        multipart_upload = LocalMultipartUpload(self, archiveDescription, partSize)
+        self.multipart_uploads.append(multipart_upload)
+        return multipart_upload
+
+    def initiate_inventory_retrieval(self):
+        job = LocalInventoryJob(self, uuid.uuid4().hex)
+        self.jobs[job.id] = job
+        return job
+
+    def MultipartUpload(self, upload_id):
+        path = os.path.join(self.folder, upload_id + '.upload')
+        if not os.path.exists(path):
+            raise LocalVaultError("multipart upload {} does not exist".format(upload_id))
+        with open(path) as f:
+            meta = json.load(f)
+        return LocalMultipartUpload(self, meta['description'], meta['part_size'], upload_id, meta['creation_date'])
+
+    def Archive(self, archive_id):
+        return LocalArchive(self, archive_id)
+
+    def Job(self, job_id):
+        if job_id not in self.jobs:
+            raise LocalVaultError("job {} does not exist".format(job_id))
+        return self.jobs[job_id]
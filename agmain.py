@@ -1,12 +1,31 @@
-from Crypto.Cipher import AES
 import argparse
 import json
-from agcrypt import AESCipher
-from aglacier import GlacierVault, ConfigError
+from aglacier import GlacierVault, ConfigError, ChecksumMismatch, TreeHashWriter, MEGABYTE
+from agstream import ThreadedConsumer, SliceWriter, TeeWriter
+from agdedup import ChunkIndex, DedupWriter, unpack_chunk
+from agsched import BackupScheduler
+from agcompress import CompressWriter, DecompressWriter, CODECS
+from agincr import FileIndex, scan_tree, make_incremental_tarfile, apply_deletions, INFO_MEMBER
+from agindex import IndexingTarFile, member_rows
+from agcache import RestoreCache
+from agmetrics import Metrics, ProgressReporter, PROFILERS, tree_size
+from agthrottle import Throttle, BandwidthSchedule, mbit
+from agjournal import BackupJournal
+from agscan import TreeScanner, add_scanned
+from agextract import TarExtractor
+from agretention import RetentionPolicy, MIN_STORAGE_DAYS
+from agwatch import BackupDaemon, read_status
+from agbundle import BundleWriter
 import os
 from datetime import datetime
 import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
+from contextlib import ExitStack
+import io
+import hashlib
+import traceback
 
 
 class BackupObjectNotFound(Exception):
@@ -17,6 +36,18 @@ class NotReadyYet(Exception):
     pass
 
 
+class BackupFailed(Exception):
+    pass
+
+
+class PruneFailed(Exception):
+    pass
+
+
+class VerifyFailed(Exception):
+    pass
+
+
 class Agbackup(object):
     def __init__(self, config_path):
         # load config file
@@ -35,9 +66,8 @@ class Agbackup(object):
         if not 'backup_objects' in self.config:
             raise ConfigError("backup_objects not in config")
 
-        # init crypt
-        if 'encryption_key' in self.config:
-            self.crypt = AESCipher(self.config['encryption_key'])
+        # the cipher (and the crypto library) is loaded on first use, see crypt
+        self._crypt = None
 
         # check backup objects
         for backup_object in self.config['backup_objects']:
@@ -45,11 +75,28 @@ class Agbackup(object):
                 raise ConfigError("backup_object '{}' has no 'name' attribute in config".format(object))
             if 'path' not in backup_object:
                 raise ConfigError("backup_object '{}' has no 'path' attribute in config".format(object))
-            if 'encrypt' in backup_object and backup_object['encrypt'] and self.crypt is None:
+            if 'dedup' in backup_object and backup_object['dedup'] and \
+                    'incremental' in backup_object and backup_object['incremental']:
+                raise ConfigError("backup_object '{}' can't be dedup and incremental".format(backup_object['name']))
+            if 'compression' in backup_object and backup_object['compression'] not in CODECS:
+                raise ConfigError("backup_object '{}' has an unknown compression, use one of {}".format(
+                    backup_object['name'], ', '.join(CODECS)))
+            for key in ('include', 'exclude'):
+                if key in backup_object and not isinstance(backup_object[key], list):
+                    raise ConfigError("'{}' of backup_object '{}' must be a list of glob patterns".format(
+                        key, backup_object['name']))
+            if 'retention' in backup_object:
+                RetentionPolicy.from_config(backup_object['retention'], backup_object['name'])
+            if 'encrypt' in backup_object and backup_object['encrypt'] and 'encryption_key' not in self.config:
                 raise ConfigError(
                     "backup_object '{}' has encypt activated but no enkyrpton_key is given in config".format(
                         object))
 
+        # versions kept by prune, the retention of an object replaces the one of the config
+        self.retention = None
+        if 'retention' in self.config:
+            self.retention = RetentionPolicy.from_config(self.config['retention'], 'all backup objects')
+
         # init glacier
         access_key = None
         if 'access_key' in self.config:
@@ -63,18 +110,162 @@ class Agbackup(object):
         if 'shelve_file' in self.config:
             shelve_file = self.config['shelve_file']
 
+        part_size = 8 * MEGABYTE
+        if 'part_size_mb' in self.config:
+            part_size = self.config['part_size_mb'] * MEGABYTE
+
+        upload_threads = 4
+        if 'upload_threads' in self.config:
+            upload_threads = self.config['upload_threads']
+
+        download_threads = 4
+        if 'download_threads' in self.config:
+            download_threads = self.config['download_threads']
+
+        catalog_file = None
+        if 'catalog_file' in self.config:
+            catalog_file = self.config['catalog_file']
+
+        poll_interval = 60
+        if 'job_poll_interval' in self.config:
+            poll_interval = self.config['job_poll_interval']
+
+        max_poll_interval = 1800
+        if 'job_max_poll_interval' in self.config:
+            max_poll_interval = self.config['job_max_poll_interval']
+
+        cache = None
+        if 'cache_dir' in self.config:
+            cache_size = 1024 * MEGABYTE
+            if 'cache_size_mb' in self.config:
+                cache_size = self.config['cache_size_mb'] * MEGABYTE
+            cache = RestoreCache(self.config['cache_dir'], cache_size)
+
+        cache_uploads = False
+        if 'cache_uploads' in self.config:
+            cache_uploads = self.config['cache_uploads']
+
+        # bandwidth limits in Mbit/s, the schedule overrides them in its time windows
+        schedule = []
+        if 'bandwidth_schedule' in self.config:
+            schedule = self.config['bandwidth_schedule']
+        upload_limit = None
+        if 'upload_limit_mbit' in self.config:
+            upload_limit = self.config['upload_limit_mbit']
+        download_limit = None
+        if 'download_limit_mbit' in self.config:
+            download_limit = self.config['download_limit_mbit']
+        upload_throttle = Throttle(mbit(upload_limit), BandwidthSchedule(schedule, 'upload_mbit', mbit(upload_limit)))
+        download_throttle = Throttle(mbit(download_limit),
+                                     BandwidthSchedule(schedule, 'download_mbit', mbit(download_limit)))
+        self.object_limit = None
+        if 'object_limit_mbit' in self.config:
+            self.object_limit = self.config['object_limit_mbit']
+
+        # connection pool of every AWS client and the retries with backoff of throttled or failed requests
+        max_connections = 10
+        if 'max_connections' in self.config:
+            max_connections = self.config['max_connections']
+        max_attempts = 5
+        if 'aws_max_attempts' in self.config:
+            max_attempts = self.config['aws_max_attempts']
+        retry_mode = 'adaptive'
+        if 'aws_retry_mode' in self.config:
+            retry_mode = self.config['aws_retry_mode']
+
         self.vault = GlacierVault(self.config['vault'],
                                   access_key,
                                   secret_key,
-                                  shelve_file)
+                                  shelve_file,
+                                  part_size=part_size,
+                                  upload_threads=upload_threads,
+                                  download_threads=download_threads,
+                                  catalog_file=catalog_file,
+                                  poll_interval=poll_interval,
+                                  max_poll_interval=max_poll_interval,
+                                  cache=cache,
+                                  cache_uploads=cache_uploads,
+                                  upload_throttle=upload_throttle if upload_throttle.limited else None,
+                                  download_throttle=download_throttle if download_throttle.limited else None,
+                                  max_connections=max_connections,
+                                  max_attempts=max_attempts,
+                                  retry_mode=retry_mode)
+        self.chunk_index = ChunkIndex(self.vault.shelve_file + '.chunks')
+
+        # directories listed and stat'ed at once when walking a backup object
+        self.scan_threads = 8
+        if 'scan_threads' in self.config:
+            self.scan_threads = self.config['scan_threads']
+
+        # when all objects are backed up, the ones up to bundle_max_object_kb are packed into archives of
+        # bundle_size_mb, restored by ranged retrievals of their part
+        self.bundle_max_object = 0
+        if 'bundle_max_object_kb' in self.config:
+            self.bundle_max_object = self.config['bundle_max_object_kb'] * 1024
+        self.bundle_size = 64 * MEGABYTE
+        if 'bundle_size_mb' in self.config:
+            self.bundle_size = self.config['bundle_size_mb'] * MEGABYTE
+
+        # threads writing the small files of a restore
+        self.extract_threads = 8
+        if 'extract_threads' in self.config:
+            self.extract_threads = self.config['extract_threads']
+
+        # backups are staged and journaled, so an interrupted one can be resumed
+        self.journal = None
+        if 'journal_dir' in self.config:
+            self.journal = BackupJournal(self.config['journal_dir'])
+
+        # shared by all backups running at once
+        self.compression_threads = os.cpu_count() or 1
+        if 'compression_threads' in self.config:
+            self.compression_threads = self.config['compression_threads']
+        self.compress_executor = ThreadPoolExecutor(max_workers=self.compression_threads)
+
+        # byte counters and timers of the pipeline stages, exported after every command if configured
+        self.metrics = Metrics()
+        self.progress = False
+        if 'progress' in self.config:
+            self.progress = self.config['progress']
+
+    @property
+    def crypt(self):
+        """
+        AESCipher of the encryption_key, None without one. Created on first use, so commands
+        which don't encrypt or decrypt never load the crypto library.
+        """
+        if self._crypt is None and 'encryption_key' in self.config:
+            from agcrypt import AESCipher
+            # segments are encrypted and decrypted on the same pool as the compression blocks
+            self._crypt = AESCipher(self.config['encryption_key'], self.compress_executor, self.compression_threads)
+        return self._crypt
 
-    def backup(self, object_name):
+    def backup(self, object_name, resume=False):
         backup_objects = self.config["backup_objects"]
 
-        # when no object name given -> backup all
+        # when no object name given -> backup all, cpu_workers objects at once
         if object_name is None:
-            for backup_object in backup_objects:
-                self.backup_element(backup_object)
+            if resume:
+                backup_objects = [backup_object for backup_object in backup_objects
+                                  if not self.resume_backup(backup_object)]
+                self._abort_orphaned_uploads()
+
+            cpu_workers = 2
+            if 'cpu_workers' in self.config:
+                cpu_workers = self.config['cpu_workers']
+
+            started = time.time()
+            bundled = self._bundled_objects(backup_objects)
+            results = []
+            if bundled:
+                results = self._backup_bundles(bundled)
+            results += BackupScheduler(self.backup_element, cpu_workers).run(
+                [backup_object for backup_object in backup_objects if backup_object not in bundled])
+            print(BackupScheduler.format_summary(results, time.time() - started))
+
+            failed = [result.name for result in results if result.error is not None]
+            if failed:
+                raise BackupFailed("backup of {} failed".format(', '.join(failed)))
 
         # else backup the given object
         else:
@@ -82,133 +273,837 @@ class Agbackup(object):
             for backup_object in backup_objects:
                 if backup_object['name'] == object_name:
                     found = True
+                    if resume:
+                        resumed = self.resume_backup(backup_object)
+                        self._abort_orphaned_uploads()
+                        if resumed:
+                            break
                     self.backup_element(backup_object)
                     break
             if not found:
                 raise BackupObjectNotFound("backup_object '{}' not found in config".format(object_name))
 
     def backup_element(self, backup_object):
-
+        """
+        Streams the object through tar+gzip, encryption and a multipart upload.
+        Nothing is written to disk and memory use is bounded by the upload buffers.
+        Returns the number of bytes uploaded.
+        """
         if os.path.exists(backup_object['path']):
-            # tar+zip it in temp folder
-            targz = tempfile.TemporaryFile()  # open('tmp.tar.gz', 'wb+')  #
-            self._make_tarfile(output_file=targz, source=backup_object['path'])
+            arch_desc = self._new_arch_desc(backup_object)
+
+            if 'dedup' in backup_object and backup_object['dedup']:
+                return self._backup_dedup(backup_object, arch_desc)
+
+            if 'incremental' in backup_object and backup_object['incremental']:
+                return self._backup_incremental(backup_object, arch_desc)
+
+            journal_job = None
+            if self.journal is not None:
+                if self.journal.jobs(backup_object['name']):
+                    print("'{}' has an interrupted backup, it is continued by backup --resume".format(
+                        backup_object['name']))
+                journal_job = self.journal.create(backup_object['name'], arch_desc, self.vault.part_size)
 
-            arch_desc = {"name": backup_object['name'], 'datetime': datetime.now(), "id": None, "encrypted": False}
+            members = []
+            upload = self._open_upload(arch_desc, backup_object, journal_job)
+            try:
+                # tar+zip it straight into the encryption / upload stream
+                with self._progress('tar', backup_object['name'], backup_object['path']):
+                    blocks = self._write_encrypted(upload, arch_desc['encrypted'], lambda encr: self._write_compressed(
+                        encr, arch_desc,
+                        lambda comp: self._make_tarfile(output_file=comp, source=backup_object['path'], mode="w|",
+                                                        members=members, scanner=self._scanner(backup_object))))
+            except Exception:
+                upload.abort()
+                raise
+            rows = list(member_rows(members, blocks, arch_desc['compressed_size']))
+            if journal_job is not None:
+                # from here on a failed upload can be resumed
+                journal_job.staged(arch_desc, rows)
+            self.vault.catalog.add_members(upload.close(), rows)
+            return upload.size
+
+        else:
+            raise ConfigError(
+                "backup_object '{}' has an invalid 'path' attribute. Does the file exist?".format(backup_object))
+
+    @staticmethod
+    def _new_arch_desc(backup_object):
+        encrypt = 'encrypt' in backup_object and backup_object['encrypt']
+        arch_desc = {"name": backup_object['name'], 'datetime': datetime.now(), "id": None, "encrypted": encrypt,
+                     "compression": 'gzip'}
+        if 'compression' in backup_object:
+            arch_desc['compression'] = backup_object['compression']
+        if 'compression_level' in backup_object:
+            arch_desc['compression_level'] = backup_object['compression_level']
+        return arch_desc
+
+    def _bundled_objects(self, backup_objects):
+        """
+        The objects of at most bundle_max_object_kb, except deduplicated and incremental ones
+        """
+        if not self.bundle_max_object:
+            return []
+        bundled = []
+        for backup_object in backup_objects:
+            if 'dedup' in backup_object and backup_object['dedup'] or \
+                    'incremental' in backup_object and backup_object['incremental']:
+                continue
+            if os.path.exists(backup_object['path']) and \
+                    tree_size(backup_object['path'], self.bundle_max_object) <= self.bundle_max_object:
+                bundled.append(backup_object)
+        return bundled
+
+    def _backup_bundles(self, backup_objects):
+        """
+        Backs up the objects one after another into bundles (see agbundle.BundleWriter) instead
+        of an archive each. Returns their BackupResults, the objects of a bundle whose upload
+        failed are failed.
+        """
+        bundle = BundleWriter(lambda descr: self.metrics.writer('upload', self.vault.open_upload(
+            descr, print_info=True, record=False)), self.vault.catalog, self.bundle_size)
+        results = BackupScheduler(lambda backup_object: self._backup_bundled(backup_object, bundle), 1).run(
+            backup_objects)
+        try:
+            bundle.finish()
+        except Exception:
+            traceback.print_exc()
+        for result in results:
+            if result.error is None and result.name in bundle.failed:
+                result.error = bundle.failed[result.name]
+        return results
+
+    def _backup_bundled(self, backup_object, bundle):
+        """
+        Tars, compresses and encrypts the object into an entry of the bundle, returns its size
+        """
+        arch_desc = self._new_arch_desc(backup_object)
+        entry = bundle.open(arch_desc)
+        members = []
+        blocks = self._write_encrypted(entry, arch_desc['encrypted'], lambda encr: self._write_compressed(
+            encr, arch_desc,
+            lambda comp: self._make_tarfile(output_file=comp, source=backup_object['path'], mode="w|",
+                                            members=members, scanner=self._scanner(backup_object))))
+        bundle.add(entry, member_rows(members, blocks, arch_desc['compressed_size']))
+        return arch_desc['size']
+
+    def daemon(self, object_name=None, stop=None):
+        """
+        Runs the BackupDaemon, backing up the objects (all or object_name) whenever they changed,
+        until the threading.Event stop is set
+        """
+        backup_objects = self.config['backup_objects']
+        if object_name is not None:
+            backup_objects = [backup_object for backup_object in backup_objects if backup_object['name'] == object_name]
+            if not backup_objects:
+                raise BackupObjectNotFound("backup_object '{}' not found in config".format(object_name))
+
+        debounce = 60
+        if 'daemon_debounce' in self.config:
+            debounce = self.config['daemon_debounce']
+        max_delay = 3600
+        if 'daemon_max_delay' in self.config:
+            max_delay = self.config['daemon_max_delay']
+        poll_interval = 60
+        if 'daemon_poll_interval' in self.config:
+            poll_interval = self.config['daemon_poll_interval']
+        watcher = 'auto'
+        if 'daemon_watcher' in self.config:
+            watcher = self.config['daemon_watcher']
+            if watcher not in ('auto', 'inotify', 'polling'):
+                raise ConfigError("daemon_watcher must be auto, inotify or polling")
+        max_watches = None
+        if 'daemon_max_watches' in self.config:
+            max_watches = self.config['daemon_max_watches']
+        socket_path = None
+        if 'daemon_socket' in self.config:
+            socket_path = self.config['daemon_socket']
+        cpu_workers = 2
+        if 'cpu_workers' in self.config:
+            cpu_workers = self.config['cpu_workers']
+
+        BackupDaemon(self.backup_element, backup_objects, self._scanner, self.vault.shelve_file + '.daemon.json',
+                     debounce, max_delay, poll_interval, watcher, max_watches, socket_path, cpu_workers).run(stop)
+
+    def report_metrics(self, command=None):
+        """
+        Prints the time and throughput of the pipeline stages and exports them to the metrics_file
+        (JSON lines or, with metrics_format 'prometheus', a textfile for the node exporter)
+        """
+        if not self.metrics.stages:
+            return
+        print(self.metrics.format_summary())
+        for direction, throttle in (('Upload', self.vault.upload_throttle), ('Download', self.vault.download_throttle)):
+            if throttle is not None and throttle.bytes:
+                print("{} throttled, achieved {:.1f} Mbit/s".format(direction, throttle.achieved() / mbit(1)))
+        if 'metrics_file' in self.config:
+            metrics_format = 'json'
+            if 'metrics_format' in self.config:
+                metrics_format = self.config['metrics_format']
+            self.metrics.export(self.config['metrics_file'], metrics_format, command)
 
-            if 'encrypt' in backup_object and backup_object['encrypt']:
-                # set description to encrypted
-                arch_desc["encrypted"] = True
+    def resume_backup(self, backup_object):
+        """
+        Continues the interrupted journaled backups of the object. A backup whose stream was
+        staged completely is uploaded from its stage file, skipping the parts Glacier confirmed.
+        The others can't be continued: their multipart upload is aborted and their journal
+        removed. Returns True if a backup of the object was completed.
+        """
+        if self.journal is None:
+            return False
+        open_uploads = None
+        completed = False
+        for job in self.journal.jobs(backup_object['name']):
+            if job.upload_id is not None and open_uploads is None:
+                open_uploads = {upload.id for upload in self.vault.vault.multipart_uploads.all()}
+            upload_open = job.upload_id is None or job.upload_id in open_uploads
+            if not completed and job.resumable and upload_open and job.record['part_size'] == self.vault.part_size:
+                print("Resuming the backup of '{}', {} part(s) already uploaded".format(job.name, len(job.parts)))
+                upload = self._open_upload(job.record['arch_descr'], backup_object, job)
+                if job.upload_id is not None:
+                    upload.resume(job.upload_id, job.parts)
+                with job.open_stage() as f:
+                    while True:
+                        data = f.read(self.vault.part_size)
+                        if not data:
+                            break
+                        upload.write(data)
+                archive_id = upload.close()
+                if job.record['members'] is not None:
+                    self.vault.catalog.add_members(archive_id, job.record['members'])
+                completed = True
+                continue
 
-                # encrypt it
-                encr = tempfile.TemporaryFile()  # open('tmp.tar.gz.enc', 'wb+')  # tempfile.TemporaryFile()
-                self.crypt.encrypt(targz, encr)
+            print("Cleaning up the interrupted backup of '{}' ({})".format(
+                job.name, 'superseded' if completed else 'not resumable'))
+            if upload_open and job.upload_id is not None:
+                self.vault.vault.MultipartUpload(job.upload_id).abort()
+            job.remove()
+        return completed
 
+    def prune(self, object_name=None, dry_run=False, early=False):
+        """
+        Deletes the versions of the backup objects (all or object_name) their retention policy
+        doesn't keep, delete_threads at a time. Versions stored for less than min_storage_days
+        (default 90, Glacier's minimum storage charge) are deleted by a later prune, unless early.
+        With dry_run the plan is only printed.
+        """
+        min_storage_days = MIN_STORAGE_DAYS
+        if 'min_storage_days' in self.config:
+            min_storage_days = self.config['min_storage_days']
+        delete_threads = 4
+        if 'delete_threads' in self.config:
+            delete_threads = self.config['delete_threads']
+
+        backup_objects = self.config['backup_objects']
+        if object_name is not None:
+            backup_objects = [backup_object for backup_object in backup_objects if backup_object['name'] == object_name]
+            if not backup_objects:
+                raise BackupObjectNotFound("backup_object '{}' not found in config".format(object_name))
+
+        now = datetime.now()
+        to_delete = []
+        # {bundle id: ids of the versions in it to delete}
+        bundled = {}
+        for backup_object in backup_objects:
+            policy = self.retention
+            if 'retention' in backup_object:
+                policy = RetentionPolicy.from_config(backup_object['retention'], backup_object['name'])
+            if policy is None:
+                continue
+            plan = policy.plan(list(self.vault.catalog.versions(backup_object['name']).values()), now,
+                               min_storage_days, early)
+            print("'{}': keeping {}, deleting {}, {} deferred".format(
+                backup_object['name'], len(plan.keep), len(plan.delete), len(plan.deferred)))
+            if dry_run:
+                for archive_id, reason in plan.keep.items():
+                    print('  keep   {} ({})'.format(archive_id, reason))
+                for descr in plan.delete:
+                    print('  delete {} from {}'.format(descr['id'], descr['datetime']))
+                for descr, days_left in plan.deferred:
+                    print('  defer  {} from {}, stored for less than {} days, {} day(s) left'.format(
+                        descr['id'], descr['datetime'], min_storage_days, days_left))
+            for descr in plan.delete:
+                if 'bundle' in descr:
+                    bundled.setdefault(descr['bundle'], set()).add(descr['id'])
+                else:
+                    to_delete.append(descr['id'])
+
+        # a bundle is deleted with its last version, until then its versions only leave the catalog
+        dropped = []
+        for bundle_id, archive_ids in bundled.items():
+            if set(self.vault.catalog.bundled(bundle_id)) <= archive_ids:
+                to_delete.append(bundle_id)
             else:
-                encr = targz
+                dropped += sorted(archive_ids)
+
+        if dry_run or not (to_delete or dropped):
+            return []
+        deleted, failed = self.vault.delete_archives(to_delete, delete_threads, print_info=True)
+        with self.vault.catalog.transaction():
+            for bundle_id in deleted:
+                if bundle_id in bundled:
+                    dropped += sorted(bundled[bundle_id])
+            for archive_id in dropped:
+                self.vault.catalog.delete_archive(archive_id)
+        deleted = [archive_id for archive_id in deleted if archive_id not in bundled] + dropped
+        if failed:
+            raise PruneFailed("deleting {} archive(s) failed: {}".format(
+                len(failed), ', '.join('{} ({})'.format(archive_id, e) for archive_id, e in failed.items())))
+        return deleted
 
-            self.vault.upload(fileobj=encr, arch_descr=arch_desc, print_info=True)
+    def _abort_orphaned_uploads(self):
+        # uploads of journaled backups are kept for the next resume
+        keep = set()
+        if self.journal is not None:
+            keep = {job.upload_id for job in self.journal.jobs() if job.upload_id is not None}
+        self.vault.abort_orphaned_uploads(keep, print_info=True)
 
-            targz.close()
+    def _scanner(self, backup_object):
+        include = backup_object['include'] if 'include' in backup_object else None
+        exclude = backup_object['exclude'] if 'exclude' in backup_object else None
+        return TreeScanner(self.scan_threads, include, exclude)
+
+    def _open_upload(self, arch_desc, backup_object, journal=None):
+        # the object's limit applies to its upload in addition to the limit of all uploads
+        limit = self.object_limit
+        if 'limit_mbit' in backup_object:
+            limit = backup_object['limit_mbit']
+        throttle = Throttle(mbit(limit)) if limit is not None else None
+        return self.metrics.writer('upload', self.vault.open_upload(arch_desc, print_info=True, throttle=throttle,
+                                                                    journal=journal))
+
+    def _progress(self, stage, label, source=None, total=None):
+        """
+        Progress line of the bytes going through stage while in the with block, if progress is configured.
+        The total of a backup is the size of its source.
+        """
+        if not self.progress:
+            return ExitStack()
+        if source is not None:
+            total = tree_size(source)
+        return ProgressReporter(self.metrics, stage, total, label)
+
+    def _write_encrypted(self, upload, encrypt, write):
+        """
+        Calls write with upload or, if encrypt is set, with an encryption stream into upload.
+        Returns what write returned.
+        """
+        if encrypt:
+            encr = self.metrics.writer('encrypt', self.crypt.encrypt_writer(upload))
+            # recorded so single segments can be decrypted without the start of the archive
+            upload.arch_descr['segment_header'] = encr.header.hex()
+        else:
+            encr = upload
+
+        result = write(encr)
+
+        if encrypt:
+            encr.finish()
+        return result
+
+    def _write_compressed(self, out_file, arch_desc, write):
+        """
+        Calls write with a stream compressing into out_file with the codec recorded in arch_desc,
+        blocks are compressed in parallel on the shared compression pool.
+        Returns the blocks of the compressed stream.
+        """
+        level = None
+        if 'compression_level' in arch_desc:
+            level = arch_desc['compression_level']
+
+        compressor = self.metrics.writer('compress', CompressWriter(
+            out_file, arch_desc['compression'], level, executor=self.compress_executor,
+            workers=self.compression_threads))
+        # tree hash of the tar stream, checked after decompressing it on restore
+        content = TreeHashWriter(compressor)
+        write(self.metrics.source('tar', self.metrics.writer('hash', content)))
+        compressor.finish()
+        arch_desc['compressed_size'] = compressor.out_offset
+        arch_desc['content_checksum'] = content.hexdigest()
+        return compressor.blocks
+
+    def _store_members(self, archive_id, members, blocks, arch_desc):
+        """
+        Stores the member index of a tar archive written through _write_compressed
+        """
+        self.vault.catalog.add_members(archive_id, member_rows(members, blocks, arch_desc['compressed_size']))
+
+    def _backup_dedup(self, backup_object, arch_desc):
+        """
+        The uncompressed tar stream is split into content defined chunks, only chunks missing
+        in the local chunk index are uploaded (packed into archives). The version itself is a
+        small archive holding the manifest, the list of its chunks and their locations.
+        """
+        arch_desc['dedup'] = True
+        # chunks are compressed one by one with zlib
+        del arch_desc['compression']
+        arch_desc.pop('compression_level', None)
+        pack_size = 64 * MEGABYTE
+        if 'pack_size_mb' in self.config:
+            pack_size = self.config['pack_size_mb'] * MEGABYTE
+
+        with self.chunk_index as index:
+            writer = DedupWriter(self.vault, index, backup_object['name'],
+                                 crypt=self.crypt if arch_desc['encrypted'] else None,
+                                 pack_size=pack_size, print_info=True)
             try:
-                encr.close()
+                self._make_tarfile(output_file=writer, source=backup_object['path'], mode="w|",
+                                   scanner=self._scanner(backup_object))
+                manifest = writer.finish()
             except Exception:
-                pass
+                writer.abort()
+                raise
 
+            upload = self._open_upload(arch_desc, backup_object)
+            try:
+                self._write_encrypted(upload, arch_desc['encrypted'],
+                                      lambda encr: encr.write(json.dumps({'chunks': manifest}).encode('utf-8')))
+            except Exception:
+                upload.abort()
+                raise
+            index.store_manifest(upload.close(), manifest)
+        return writer.uploaded_bytes + upload.size
+
+    def _backup_incremental(self, backup_object, arch_desc):
+        """
+        Archives only the entries added or changed since the last backup of the object, according
+        to its file index (type, size, mtime, inode), and records the deleted ones. Every
+        'full_every' (default 7) incrementals a full archive is made.
+        """
+        full_every = 7
+        if 'full_every' in backup_object:
+            full_every = backup_object['full_every']
+
+        index = FileIndex(self._file_index_file(backup_object['name']))
+        entries = {}
+        current = scan_tree(backup_object['path'], self._scanner(backup_object), entries)
+
+        full = index.archive_id is None or self.vault.get_archive(index.archive_id) is None \
+            or index.chain + 1 >= full_every
+        if full:
+            arch_desc['type'] = 'full'
+            changed, deleted = sorted(current), None
         else:
-            raise ConfigError(
-                "backup_object '{}' has an invalid 'path' attribute. Does the file exist?".format(backup_object))
+            changed, deleted = index.changes(current)
+            if not changed and not deleted:
+                print("No changes in '{}' since the last backup".format(backup_object['name']))
+                return 0
+            arch_desc['type'] = 'incremental'
+            arch_desc['base'] = index.archive_id
+
+        hashes = {}
+        members = []
+        upload = self._open_upload(arch_desc, backup_object)
+        try:
+            blocks = self._write_encrypted(upload, arch_desc['encrypted'], lambda encr: self._write_compressed(
+                encr, arch_desc,
+                lambda comp: hashes.update(make_incremental_tarfile(comp, [entries[arcname] for arcname in changed],
+                                                                    deleted, mode="w|", members=members))))
+        except Exception:
+            upload.abort()
+            raise
 
-    def retrive(self, name, out_path, force, wait, archive_id=None):
+        archive_id = upload.close()
+        self._store_members(archive_id, members, blocks, arch_desc)
+        if deleted:
+            # a single file restore must not find them in the base archives
+            self.vault.catalog.add_deletions(archive_id, deleted)
+        index.update(current, hashes, archive_id, full)
+        index.save()
+        return upload.size
 
-        # config object is needed to get type, enkryption etc.
-        backup_objects = self.vault.get_archive_list(name)
-        if backup_objects is None:
-            raise BackupObjectNotFound("backup_object '{}' not found in shelve".format(name))
+    def _file_index_file(self, name):
+        return '{}.files.{}'.format(self.vault.shelve_file, hashlib.sha1(name.encode('utf-8')).hexdigest()[:16])
+
+
+    def retrive(self, name, out_path, force, wait, archive_id=None, path=None):
 
         # get the latest element for the selected name and (if given) id
-        selected_object = self.get_latest_from_dict(backup_objects, 'datetime', archive_id)[1]
+        # the description is needed to get type, enkryption etc.
+        selected_object = self.vault.get_latest(name, archive_id)
 
         if selected_object is None:
-            raise BackupObjectNotFound("backup_object '{}' not found in shelve".format(name))
+            raise BackupObjectNotFound("backup_object '{}' not found in catalog".format(name))
 
-        archived = tempfile.TemporaryFile()  # open('tmp_outof_archive.tar.gz.enc', 'wb+')  #
-        if not self.vault.retrieve(selected_object['id'], fileobj=archived, wait_mode=wait, print_info=True):
-            raise NotReadyYet("AWS Glacier job not ready yet, it takes 3 to 5 hours")
+        if path is not None:
+            self._retrive_member(selected_object, path, out_path, force, wait)
+            return
 
-        decrypted = None
-        if 'encrypted' in selected_object and selected_object['encrypted']:
-            decrypted = tempfile.TemporaryFile()  # open('tmpdecr.tar.gz', 'wb+')  #
-            self.crypt.decrypt(archived, decrypted)
-        else:
-            decrypted = archived
+        if 'dedup' in selected_object and selected_object['dedup']:
+            self._retrive_dedup(selected_object, out_path, force, wait)
+            return
 
-        # unpack file(s) and write into dest_folder
-        self._extract_tarfile(output_folder=out_path, source_file=decrypted, overwrite=force)
+        # an incremental needs its base archives down to the last full backup, oldest first
+        chain = [selected_object]
+        while 'type' in chain[0] and chain[0]['type'] == 'incremental':
+            base = self.vault.get_archive(chain[0]['base'])
+            if base is None:
+                raise BackupObjectNotFound("base archive '{}' of '{}' not found in catalog".format(
+                    chain[0]['base'], chain[0]['id']))
+            chain.insert(0, base)
+
+        existing = None if force else self._check_overwrite(chain, out_path)
+
+        if len(chain) > 1:
+            # start the retrieval jobs of the whole chain before waiting for any of them
+            ready = [self.vault.start_retrieval(arch_descr['id'], print_info=True) for arch_descr in chain]
+            if not all(ready) and not wait:
+                raise NotReadyYet("AWS Glacier job not ready yet, it takes 3 to 5 hours")
+
+        for i, arch_descr in enumerate(chain):
+            self._restore_archive(arch_descr, out_path, force or i > 0, wait, existing)
 
-        archived.close()
+    def _check_overwrite(self, chain, out_path):
+        """
+        Raises FileExistsError before anything is retrieved if a file in the member index of the
+        archives exists in out_path. Returns the files found in out_path, for the extraction to
+        check the members which aren't indexed (links, devices). Returns None if an archive has no
+        member index, then all conflicts are only found while extracting.
+        """
+        if not os.path.exists(out_path):
+            return set()
+        if not all(self.vault.catalog.has_members(arch_descr['id']) for arch_descr in chain):
+            return None
+        existing = TarExtractor(out_path).existing_files()
+        for arch_descr in chain:
+            for path in self.vault.catalog.member_paths(arch_descr['id']):
+                if path in existing:
+                    raise FileExistsError(os.path.join(out_path, path))
+        return existing
+
+    def _restore_archive(self, arch_descr, out_path, force, wait, existing=None):
+        # download -> decrypt -> decompress -> untar, all stages run on the same stream of chunks
+        extractor = ThreadedConsumer(
+            lambda stream: self._extract_tarfile(output_folder=out_path, source_file=stream, overwrite=force,
+                                                 mode="r|", threads=self.extract_threads, existing=existing))
+        # archives of older versions have no codec recorded, they are gzip
+        codec = 'gzip'
+        if 'compression' in arch_descr:
+            codec = arch_descr['compression']
+        extracted = self.metrics.writer('extract', extractor)
+        content = TreeHashWriter(extracted)
+        decompressor = self.metrics.writer('decompress', DecompressWriter(self.metrics.writer('hash', content), codec))
         try:
-            decrypted.close()
+            with self._progress('download', arch_descr['name'], total=arch_descr['size'] if 'size' in arch_descr else None):
+                self._retrieve_archive(arch_descr, decompressor, wait)
+                decompressor.finish()
+            self._check_content(arch_descr, content)
         except Exception:
-            pass
+            extractor.abort()
+            raise
 
-    @staticmethod
-    def _make_tarfile(output_file, source):
-        with tarfile.open(fileobj=output_file, mode="w:gz") as tar:
-            tar.add(source, arcname=os.path.basename(source))
+        # unpack file(s) and write into dest_folder
+        extracted.close()
 
     @staticmethod
-    def _extract_tarfile(output_folder, source_file, overwrite=False):
-        # TODO Inspect tar before extract
-        # Warning  Never extract archives from untrusted sources without prior inspection.
-        # It is possible that files are created outside of path, e.g. members that have absolute
-        # filenames starting with "/" or filenames with two dots "..".
-        source_file.seek(0)
+    def _check_content(arch_descr, content):
+        """
+        Raises ChecksumMismatch if the tar stream hashed by the TreeHashWriter content isn't the
+        one archived. Archives of older versions have no content hash.
+        """
+        if 'content_checksum' in arch_descr and content.hexdigest() != arch_descr['content_checksum']:
+            raise ChecksumMismatch("content of archive {} does not match its tree hash: {} != {}".format(
+                arch_descr['id'], content.hexdigest(), arch_descr['content_checksum']))
 
-        if not os.path.exists(output_folder):
-            os.mkdir(output_folder)
-        t = tarfile.open(fileobj=source_file, mode="r:gz")
+    def verify(self, name=None, archive_id=None, all_versions=False, wait=False, cached_only=False):
+        """
+        Checks archives (the newest version of every object starting with name, all versions or
+        the one with archive_id) against the tree hashes recorded at upload: the stored data and,
+        after decrypting and decompressing it, the tar stream. The archives come from the cache
+        or are retrieved, verify_threads at a time. With cached_only archives not in the cache
+        are skipped. Returns {archive id: result}, raises VerifyFailed on mismatches.
+        """
+        if archive_id is not None:
+            arch_descr = self.vault.get_archive(archive_id)
+            if arch_descr is None:
+                raise BackupObjectNotFound("archive '{}' not found in catalog".format(archive_id))
+            archives = [arch_descr]
+        else:
+            archives = self.vault.catalog.list_archives(name)
+            if not all_versions:
+                newest = {}
+                for arch_descr in archives:
+                    newest.setdefault(arch_descr['name'], arch_descr)
+                archives = list(newest.values())
+
+        verify_threads = 4
+        if 'verify_threads' in self.config:
+            verify_threads = self.config['verify_threads']
+        with ThreadPoolExecutor(max_workers=verify_threads) as executor:
+            results = dict(zip([arch_descr['id'] for arch_descr in archives],
+                               executor.map(lambda arch_descr: self._verify_archive(arch_descr, wait, cached_only),
+                                            archives)))
 
-        # check if files will get overwritten
-        if not overwrite:
-            for file in t.getnames():
-                write_to = os.path.join(output_folder, file)
-                if os.path.exists(write_to):
-                    raise FileExistsError(write_to)
+        for arch_descr in archives:
+            print('{}\t {}: {} {}'.format(arch_descr['name'], arch_descr['datetime'], arch_descr['id'],
+                                          results[arch_descr['id']]))
+        failed = [archive_id for archive_id, result in results.items()
+                  if result not in ('ok', 'not ready', 'not cached')]
+        if failed:
+            raise VerifyFailed("{} of {} archive(s) failed the verification".format(len(failed), len(results)))
+        return results
 
-        t.extractall(output_folder)
+    def _verify_archive(self, arch_descr, wait, cached_only):
+        if 'checksum' not in arch_descr and 'content_checksum' not in arch_descr:
+            return 'no hash recorded'
+        stored = TreeHashWriter()
+        content = TreeHashWriter()
+        sink = stored
+        decrypted = None
+        if 'content_checksum' in arch_descr:
+            codec = 'gzip'
+            if 'compression' in arch_descr:
+                codec = arch_descr['compression']
+            decompressor = DecompressWriter(content, codec)
+            decrypted = decompressor
+            if 'encrypted' in arch_descr and arch_descr['encrypted']:
+                decrypted = self.crypt.decrypt_writer(decompressor)
+            sink = TeeWriter(decrypted, stored)
+
+        try:
+            if cached_only:
+                archive_id, start, end, size = self._stored_range(arch_descr)
+                if self.vault.cache is None or not self.vault.cache.get(archive_id, sink, start, end):
+                    return 'not cached'
+            elif not self._retrieve_stored(arch_descr, sink, wait):
+                return 'not ready'
+            if 'checksum' in arch_descr:
+                self.vault.check_tree_hash(arch_descr['id'], stored.hexdigest())
+            if decrypted is not None:
+                decrypted.finish()
+                if decrypted is not decompressor:
+                    decompressor.finish()
+                self._check_content(arch_descr, content)
+        except ChecksumMismatch as e:
+            return 'MISMATCH ({})'.format(e)
+        except Exception as e:
+            return 'FAILED ({}: {})'.format(type(e).__name__, e)
+        return 'ok'
+
+    def _retrieve_archive(self, arch_descr, fileobj, wait):
+        """
+        Downloads the archive into fileobj, decrypting it on the way if it is encrypted
+        """
+        encrypted = 'encrypted' in arch_descr and arch_descr['encrypted']
+        if encrypted:
+            archived = self.metrics.writer('decrypt', self.crypt.decrypt_writer(fileobj))
+        else:
+            archived = fileobj
+
+        downloaded = self.metrics.source('download', archived)
+        if 'download_dir' in self.config and 'bundle' not in arch_descr:
+            self._retrieve_resumable(arch_descr['id'], downloaded, wait)
+        elif not self._retrieve_stored(arch_descr, downloaded, wait, print_info=True):
+            raise NotReadyYet("AWS Glacier job not ready yet, it takes 3 to 5 hours")
+        if encrypted:
+            archived.finish()
 
     @staticmethod
-    def get_latest_from_dict(dict_to_sort, order_attr, key_startswith=None):
-        def key_from_item(func):
-            return lambda item: func(*item)
+    def _stored_range(arch_descr):
+        """
+        (archive id, first byte, last byte or None for the end, size of the archive or None) where
+        the archive is stored, the part of its bundle for bundled archives
+        """
+        if 'bundle' in arch_descr:
+            return (arch_descr['bundle'], arch_descr['offset'], arch_descr['offset'] + arch_descr['size'] - 1,
+                    arch_descr['bundle_size'])
+        return arch_descr['id'], 0, None, None
 
-        if key_startswith is not None:
-            filtered_dict = {k: v for k, v in dict_to_sort.items() if k.startsWith(key_startswith)}
+    def _retrieve_stored(self, arch_descr, fileobj, wait, print_info=False):
+        """
+        Retrieves the archive as stored into fileobj, only its range of the bundle if it is bundled.
+        Returns True if it was downloaded.
+        """
+        archive_id, start, end, size = self._stored_range(arch_descr)
+        if end is not None:
+            return self.vault.retrieve_range(archive_id, start, end, fileobj, wait, print_info, size=size)
+        return self.vault.retrieve(archive_id, fileobj=fileobj, wait_mode=wait, print_info=print_info)
 
-            use_dict = filtered_dict
-        else :
-            use_dict = dict_to_sort
+    def _retrive_dedup(self, arch_descr, out_path, force, wait):
+        """
+        Rebuilds a deduplicated version from its manifest: the pack archives holding its chunks are
+        downloaded into temp files, then the chunks are unpacked in manifest order into the extraction.
+        """
+        with self.chunk_index as index:
+            manifest = index.manifest(arch_descr['id'])
 
-        s = sorted(
-            use_dict.items(),
-            key=key_from_item(lambda k, v: (v[order_attr], k)),
-            reverse=True
-        )
+        if manifest is None:
+            # local index lost, the manifest archive has everything needed
+            manifest_data = io.BytesIO()
+            self._retrieve_archive(arch_descr, manifest_data, wait)
+            manifest = json.loads(manifest_data.getvalue().decode('utf-8'))['chunks']
 
-        return s[0]
+        # the retrieval jobs of all packs run at once, each pack is downloaded when its job completes
+        pack_files = {}
+        try:
+            for chunk_hash, pack_id, offset, length in manifest:
+                if pack_id not in pack_files:
+                    pack_files[pack_id] = tempfile.TemporaryFile()
+            if not self.vault.retrieve_many(pack_files, wait_mode=wait, print_info=True):
+                raise NotReadyYet("AWS Glacier job not ready yet, it takes 3 to 5 hours")
+
+            crypt = self.crypt if 'encrypted' in arch_descr and arch_descr['encrypted'] else None
+            extractor = ThreadedConsumer(
+                lambda stream: self._extract_tarfile(output_folder=out_path, source_file=stream, overwrite=force,
+                                                     mode="r|", threads=self.extract_threads))
+            try:
+                for chunk_hash, pack_id, offset, length in manifest:
+                    pack_file = pack_files[pack_id]
+                    pack_file.seek(offset)
+                    extractor.write(unpack_chunk(pack_file.read(length), chunk_hash, crypt))
+            except Exception:
+                extractor.abort()
+                raise
+            extractor.close()
+        finally:
+            for pack_file in pack_files.values():
+                pack_file.close()
+
+    def _retrive_member(self, arch_descr, path, out_path, force, wait):
+        """
+        Restores the single file path (an arcname like 'folder/sub/file') of a version using its
+        member index: only the compressed blocks holding the file, or the encrypted segments
+        holding them, are retrieved from Glacier. Incrementals look up the file in their base
+        archives if they don't contain it and didn't delete it.
+        """
+        if path.startswith('./'):
+            path = path[2:]
+        path = path.lstrip('/')
+        member = None
+        while True:
+            member = self.vault.catalog.member(arch_descr['id'], path)
+            if member is not None or 'base' not in arch_descr:
+                break
+            if self.vault.catalog.is_deleted(arch_descr['id'], path):
+                raise BackupObjectNotFound("'{}' was deleted in archive '{}'".format(path, arch_descr['id']))
+            arch_descr = self.vault.get_archive(arch_descr['base'])
+            if arch_descr is None:
+                break
+
+        if member is None:
+            if arch_descr is not None and not self.vault.catalog.has_members(arch_descr['id']):
+                raise BackupObjectNotFound("archive '{}' has no member index, restore it as a whole".format(
+                    arch_descr['id']))
+            raise BackupObjectNotFound("'{}' not found in the member index".format(path))
+
+        write_to = os.path.abspath(os.path.join(out_path, path))
+        if not write_to.startswith(os.path.abspath(out_path) + os.sep):
+            raise BackupObjectNotFound("'{}' is outside of the output folder".format(path))
+        if not force and os.path.lexists(write_to):
+            raise FileExistsError(write_to)
+        os.makedirs(os.path.dirname(write_to), exist_ok=True)
+
+        with open(write_to, 'wb') as f:
+            if member['size']:
+                # tar stream from the block start -> the file's data
+                data = SliceWriter(f, member['offset'] - member['block_in'], member['size'])
+                codec = 'gzip'
+                if 'compression' in arch_descr:
+                    codec = arch_descr['compression']
+                decompressor = DecompressWriter(data, codec)
+                if not self._retrieve_compressed_range(arch_descr, member['block_out'], member['block_end'],
+                                                       decompressor, wait):
+                    raise NotReadyYet("AWS Glacier job not ready yet, it takes 3 to 5 hours")
+                data.finish()
+        os.chmod(write_to, member['mode'])
+        os.utime(write_to, (member['mtime'], member['mtime']))
+        print("Restored {}".format(write_to))
+
+    def _retrieve_compressed_range(self, arch_descr, start, end, fileobj, wait):
+        """
+        Retrieves the bytes start to end (exclusive) of the compressed stream of an archive into
+        fileobj, for encrypted archives the segments containing them are retrieved and decrypted
+        """
+        # the bytes of bundled archives start at their offset in the bundle
+        archive_id, offset, last, archive_size = self._stored_range(arch_descr)
+        if not ('encrypted' in arch_descr and arch_descr['encrypted']):
+            return self.vault.retrieve_range(archive_id, offset + start, offset + end - 1, fileobj, wait,
+                                             print_info=True, size=archive_size)
+
+        from agcrypt import SEGMENT_HEADER, TAG_SIZE
+        header = bytes.fromhex(arch_descr['segment_header'])
+        segment_size = SEGMENT_HEADER.unpack(header)[1]
+        first, last = start // segment_size, (end - 1) // segment_size
+        final = max(1, -(-arch_descr['compressed_size'] // segment_size)) - 1
+
+        # decrypted segments -> the requested range
+        data = SliceWriter(fileobj, start - first * segment_size, end - start)
+        decryptor = self.crypt.segment_decrypt_writer(data, header, first, final)
+        encrypted_start = len(header) + first * (segment_size + TAG_SIZE)
+        encrypted_end = min(len(header) + (last + 1) * (segment_size + TAG_SIZE), arch_descr['size'])
+        if not self.vault.retrieve_range(archive_id, offset + encrypted_start, offset + encrypted_end - 1, decryptor,
+                                         wait, print_info=True, size=archive_size):
+            return False
+        decryptor.finish()
+        data.finish()
+        return True
+
+    def _retrieve_resumable(self, archive_id, fileobj, wait):
+        """
+        Downloads into a partial file in the configured download_dir, an interrupted download
+        continues from the finished ranges. The complete file is streamed into fileobj and removed.
+        """
+        download_dir = os.path.expanduser(self.config['download_dir'])
+        if not os.path.exists(download_dir):
+            os.makedirs(download_dir)
+
+        part_path = os.path.join(download_dir, '{}.part'.format(archive_id))
+        with open(part_path, 'r+b' if os.path.exists(part_path) else 'w+b') as part_file:
+            if not self.vault.retrieve(archive_id, fileobj=part_file, wait_mode=wait, print_info=True, resume=True):
+                raise NotReadyYet("AWS Glacier job not ready yet, it takes 3 to 5 hours")
+
+            part_file.seek(0)
+            while True:
+                data = part_file.read(MEGABYTE)
+                if not data:
+                    break
+                fileobj.write(data)
+
+        os.remove(part_path)
+
+    @staticmethod
+    def _make_tarfile(output_file, source, mode="w|gz", members=None, scanner=None):
+        # the member index of the stream is appended to members if given
+        if scanner is None:
+            scanner = TreeScanner()
+        with IndexingTarFile.open(fileobj=output_file, mode=mode) as tar:
+            # the entries come pre-stat'ed from the parallel scan
+            add_scanned(tar, scanner.scan(source))
+        if members is not None:
+            members.extend(tar.members_index)
+
+    @staticmethod
+    def _extract_tarfile(output_folder, source_file, overwrite=False, mode="r|gz", threads=8, existing=None):
+        if hasattr(source_file, 'seekable') and source_file.seekable():
+            source_file.seek(0)
+
+        if not os.path.exists(output_folder):
+            os.mkdir(output_folder)
+
+        # stream mode: members are validated and extracted while the archive is still arriving,
+        # an incremental archive removes what was deleted since its base
+        with tarfile.open(fileobj=source_file, mode=mode) as t:
+            TarExtractor(output_folder, overwrite, threads).extract(
+                t, {INFO_MEMBER: lambda info_file: apply_deletions(output_folder, info_file)}, existing)
 
 
 def init_argparse():
     # create the top-level parser
     parser = argparse.ArgumentParser(prog='AmazonGlacierBackup')
     parser.add_argument('-c', dest='conf_file', help='Path to alternative config file', default=None)
+    parser.add_argument('-profile', '--profile', choices=sorted(PROFILERS), default=None,
+                        help='Profile the run with cProfile (the threads started by the run included) or tracemalloc')
+    parser.add_argument('-profile_output', default=None, help='File for the profile, default agbackup.<profiler>')
     subparsers = parser.add_subparsers(dest='mode')
 
     # create the parser for the "backup" command
     parser_a = subparsers.add_parser('backup',
                                      help='Archives the object with the given name configured in the config file in amazon glacier')
     parser_a.add_argument('-name', help='object name')
+    parser_a.add_argument('-resume', '--resume', action='store_true', dest='resume',
+                          help='Continue interrupted backups (needs journal_dir) and clean up orphaned uploads')
 
     parser_d = subparsers.add_parser('backuponce',
                                      help='Archives the given file/folder in amazon glacier')
@@ -224,9 +1119,43 @@ def init_argparse():
                           dest='id')
     parser_b.add_argument('-wait', action='store_true', dest='wait')
     parser_b.add_argument('-force', action='store_true', dest='force', help='Overwrite existing files')
+    parser_b.add_argument('-path', '--path', dest='path', default=None,
+                          help='Restore only this file of the object, e.g. folder/sub/file.txt')
 
     parser_c = subparsers.add_parser('list', help='Show a list of all archived objects.')
     parser_c.add_argument('-a', action='store_true', help='Show with versions of objects', dest='all')
+    parser_c.add_argument('-name', help='Only objects with names starting with this', default=None)
+    parser_c.add_argument('-since', type=datetime.fromisoformat, default=None,
+                          help='Only versions from this date on, e.g. 2024-01-31 or 2024-01-31T12:00')
+    parser_c.add_argument('-until', type=datetime.fromisoformat, default=None,
+                          help='Only versions up to this date')
+    parser_c.add_argument('-type', dest='archive_type', default=None, help='Only versions of this type, e.g. full')
+    parser_c.add_argument('-limit', type=int, default=None, help='Show at most this many lines')
+    parser_c.add_argument('-offset', type=int, default=0, help='Skip this many lines')
+
+    parser_h = subparsers.add_parser('daemon', help='Keeps running, backs up the objects whenever they changed')
+    parser_h.add_argument('-name', help='Only this object', default=None)
+    parser_h.add_argument('-status', action='store_true', dest='status',
+                          help='Show the status of the running daemon (needs daemon_socket)')
+
+    parser_g = subparsers.add_parser('verify', help='Checks archives against the tree hashes recorded at upload')
+    parser_g.add_argument('-name', help='Only objects with names starting with this', default=None)
+    parser_g.add_argument('-id', help='Only this archive', dest='id', default=None)
+    parser_g.add_argument('-a', action='store_true', help='All versions instead of the newest', dest='all')
+    parser_g.add_argument('-wait', action='store_true', dest='wait')
+    parser_g.add_argument('-cached', action='store_true', dest='cached',
+                          help='Only check the archives in the cache, nothing is retrieved')
+
+    parser_f = subparsers.add_parser('prune', help='Deletes the versions not kept by the retention policies')
+    parser_f.add_argument('-name', help='Only this object', default=None)
+    parser_f.add_argument('-dry_run', '--dry-run', action='store_true', dest='dry_run',
+                          help='Only show what would be kept and deleted')
+    parser_f.add_argument('-early', action='store_true', dest='early',
+                          help='Also delete versions stored for less than min_storage_days, they are charged for it')
+
+    parser_e = subparsers.add_parser('inventory',
+                                     help='Rebuilds the catalog from the vault inventory, the job takes about 4 hours')
+    parser_e.add_argument('-wait', action='store_true', dest='wait')
 
     return parser
 
@@ -259,8 +1188,17 @@ def main():
     else:
         agb = Agbackup(arg.conf_file)
 
+    if arg.profile is not None:
+        agb.metrics.hooks.append(PROFILERS[arg.profile](arg.profile_output or 'agbackup.{}'.format(arg.profile)))
+
+    with agb.metrics.run():
+        run_command(agb, parser, arg)
+    agb.report_metrics(arg.mode)
+
+
+def run_command(agb, parser, arg):
     if arg.mode == 'backup':
-        agb.backup(arg.name)
+        agb.backup(arg.name, arg.resume)
 
     elif arg.mode == 'backuponce':
         temp_backup_data = {
@@ -271,16 +1209,37 @@ def main():
         agb.backup_element(temp_backup_data)
 
     elif arg.mode == 'get':
-        agb.retrive(arg.name, arg.out, arg.force, arg.wait, arg.id)
+        agb.retrive(arg.name, arg.out, arg.force, arg.wait, arg.id, arg.path)
 
     elif arg.mode == 'list':
-        arlist = agb.vault.get_archive_list()
-        for name, arch_obj in arlist.items():
-            print('{}'.format(name))
-            if arg.all:
-                for arch_id, arch_data in arch_obj.items():
-                    print('\t {dt}: {id} Enrypted: {enc}'.format(dt=arch_data['datetime'], id=arch_id,
-                                                                    enc=arch_data['encrypted']))
+        # answered by the catalog's indexes, only the requested page is loaded
+        filters = dict(name=arg.name, since=arg.since, until=arg.until, archive_type=arg.archive_type,
+                       limit=arg.limit, offset=arg.offset)
+        if arg.all:
+            for arch_data in agb.vault.catalog.list_archives(**filters):
+                print('{name}\t {dt}: {id} Enrypted: {enc}'.format(name=arch_data['name'], dt=arch_data['datetime'],
+                                                                   id=arch_data['id'], enc=arch_data['encrypted']))
+        else:
+            for name, versions, newest in agb.vault.catalog.list_names(**filters):
+                print('{}\t {} version(s), newest {}'.format(name, versions, newest))
+
+    elif arg.mode == 'daemon':
+        if arg.status:
+            if 'daemon_socket' not in agb.config:
+                raise ConfigError("daemon_socket not in config")
+            print(json.dumps(read_status(agb.config['daemon_socket']), indent=2))
+        else:
+            agb.daemon(arg.name)
+
+    elif arg.mode == 'verify':
+        agb.verify(arg.name, arg.id, arg.all, arg.wait, arg.cached)
+
+    elif arg.mode == 'prune':
+        agb.prune(arg.name, arg.dry_run, arg.early)
+
+    elif arg.mode == 'inventory':
+        if agb.vault.sync_inventory(arg.wait, print_info=True) is None:
+            raise NotReadyYet("AWS Glacier inventory job not ready yet, it takes about 4 hours")
 
     else:
         parser.print_help()
@@ -0,0 +1,407 @@
+# encoding: utf-8
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+
+
+class StageStats(object):
+    def __init__(self):
+        self.bytes = 0
+        self.seconds = 0.0
+        self.calls = 0
+        self.first = None
+        self.last = None
+
+    def rate(self):
+        """Bytes per second of busy time"""
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+class Metrics(object):
+    """
+    Byte counters and timers of the pipeline stages (tar, compress, encrypt, upload, ...).
+
+    The time of a stage is the time spent in it minus the time spent in the stages it writes
+    into, so with the stages nested like the pipeline (tar -> compress -> encrypt -> upload) the
+    stage with the biggest share is the one the run is bound by. hooks are context manager
+    factories entered around a whole run, e.g. profilers.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.started = time.time()
+        self.hooks = []
+        self._local = threading.local()
+
+    def add(self, stage, nbytes=0, seconds=0.0):
+        now = time.time()
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = StageStats()
+            stats = self.stages[stage]
+            stats.bytes += nbytes
+            stats.seconds += seconds
+            stats.calls += 1
+            if stats.first is None:
+                stats.first = now
+            stats.last = now
+
+    def bytes(self, stage):
+        with self.lock:
+            return self.stages[stage].bytes if stage in self.stages else 0
+
+    @contextmanager
+    def timed(self, stage, nbytes=0):
+        """
+        Adds the time of the block to stage, without the time of stages timed within it
+        """
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        frame = [0.0]
+        self._local.stack.append(frame)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self._local.stack.pop()
+            if self._local.stack:
+                self._local.stack[-1][0] += elapsed
+            self.add(stage, nbytes, elapsed - frame[0])
+
+    def writer(self, stage, out_file):
+        return MeteredWriter(self, stage, out_file)
+
+    def source(self, stage, out_file):
+        return SourceWriter(self, stage, out_file)
+
+    @contextmanager
+    def run(self):
+        """
+        Enters the hooks around a run
+        """
+        with ExitStack() as stack:
+            for hook in self.hooks:
+                stack.enter_context(hook())
+            yield self
+
+    def snapshot(self):
+        with self.lock:
+            return OrderedDict((stage, {'bytes': stats.bytes, 'seconds': stats.seconds, 'calls': stats.calls})
+                               for stage, stats in self.stages.items())
+
+    def format_summary(self):
+        with self.lock:
+            stages = list(self.stages.items())
+        busy = sum(stats.seconds for stage, stats in stages) or 1.0
+        lines = ['{:<11} {:>12} {:>10} {:>11} {:>6}'.format('stage', 'MB', 'seconds', 'MB/s', 'share')]
+        for stage, stats in stages:
+            lines.append('{:<11} {:>12.1f} {:>10.2f} {:>11.1f} {:>5.0f}%'.format(
+                stage, stats.bytes / 1e6, stats.seconds, stats.rate() / 1e6, stats.seconds / busy * 100))
+        return '\n'.join(lines)
+
+    def write_json_lines(self, path, command=None):
+        """
+        Appends one JSON object per stage to path
+        """
+        now = time.time()
+        with open(os.path.expanduser(path), 'a') as f:
+            for stage, values in self.snapshot().items():
+                line = {'time': now, 'started': self.started, 'command': command, 'stage': stage}
+                line.update(values)
+                f.write(json.dumps(line) + '\n')
+
+    def write_prometheus(self, path, command=None):
+        """
+        Writes the counters in the Prometheus text format, for the textfile collector of the
+        node exporter. The file is replaced atomically so a scrape never sees half of it.
+        """
+        lines = ['# HELP agbackup_stage_bytes_total Bytes processed by a pipeline stage.',
+                 '# TYPE agbackup_stage_bytes_total counter']
+        snapshot = self.snapshot()
+        label = ',command="{}"'.format(command) if command else ''
+        for stage, values in snapshot.items():
+            lines.append('agbackup_stage_bytes_total{{stage="{}"{}}} {}'.format(stage, label, values['bytes']))
+        lines += ['# HELP agbackup_stage_seconds_total Time spent in a pipeline stage.',
+                  '# TYPE agbackup_stage_seconds_total counter']
+        for stage, values in snapshot.items():
+            lines.append('agbackup_stage_seconds_total{{stage="{}"{}}} {:.6f}'.format(stage, label, values['seconds']))
+        lines += ['# HELP agbackup_last_run_timestamp_seconds End of the last run.',
+                  '# TYPE agbackup_last_run_timestamp_seconds gauge',
+                  'agbackup_last_run_timestamp_seconds{{{}}} {:.3f}'.format(label.lstrip(','), time.time())]
+
+        path = os.path.expanduser(path)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    def export(self, path, metrics_format='json', command=None):
+        if metrics_format == 'prometheus':
+            self.write_prometheus(path, command)
+        else:
+            self.write_json_lines(path, command)
+
+
+class MeteredWriter(object):
+    """
+    File like object counting the bytes written into out_file and timing the writes as stage.
+    finish() and close() of out_file are timed too, everything else is passed through.
+    """
+    def __init__(self, metrics, stage, out_file):
+        self.metrics = metrics
+        self.stage = stage
+        self.out_file = out_file
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        with self.metrics.timed(self.stage, len(data)):
+            return self.out_file.write(data)
+
+    def flush(self):
+        if hasattr(self.out_file, 'flush'):
+            self.out_file.flush()
+
+    def finish(self):
+        with self.metrics.timed(self.stage):
+            return self.out_file.finish()
+
+    def close(self):
+        with self.metrics.timed(self.stage):
+            return self.out_file.close()
+
+    def __getattr__(self, name):
+        return getattr(self.out_file, name)
+
+
+class SourceWriter(MeteredWriter):
+    """
+    MeteredWriter for the stage producing a stream (tar reading the files, a download): its
+    time is the time between the writes into out_file, from the first write on, as the writes
+    themselves are the time of the following stages (in whatever thread they happen).
+    """
+    def __init__(self, metrics, stage, out_file):
+        super().__init__(metrics, stage, out_file)
+        self.last = None
+
+    def write(self, data):
+        now = time.perf_counter()
+        self.metrics.add(self.stage, len(data), now - self.last if self.last is not None else 0.0)
+        try:
+            return self.out_file.write(data)
+        finally:
+            self.last = time.perf_counter()
+
+    def finish(self):
+        return self.out_file.finish()
+
+    def close(self):
+        return self.out_file.close()
+
+
+class ProgressReporter(object):
+    """
+    Prints a progress line every interval seconds while in the with block: the bytes that went
+    through stage, the throughput, the ETA if the total is known, and the share of the busy time
+    of every stage. On a terminal the line is updated in place.
+    """
+    def __init__(self, metrics, stage, total=None, label='', interval=1.0, stream=None):
+        self.metrics = metrics
+        self.stage = stage
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stderr
+        self.stopped = threading.Event()
+        self.thread = None
+        self.started = None
+        self.start_bytes = 0
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start_bytes = self.metrics.bytes(self.stage)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stopped.set()
+        self.thread.join()
+        self._print(final=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._print()
+
+    def line(self):
+        done = self.metrics.bytes(self.stage) - self.start_bytes
+        elapsed = max(time.time() - self.started, 1e-6)
+        rate = done / elapsed
+        line = '{}{:.1f} MB'.format(self.label + ': ' if self.label else '', done / 1e6)
+        if self.total:
+            line += ' of {:.1f} MB ({:.0f}%)'.format(self.total / 1e6, min(done / self.total, 1.0) * 100)
+        line += ', {:.1f} MB/s'.format(rate / 1e6)
+        if self.total and rate:
+            line += ', ETA {}'.format(format_duration(max(self.total - done, 0) / rate))
+
+        snapshot = self.metrics.snapshot()
+        busy = sum(values['seconds'] for values in snapshot.values())
+        if busy:
+            line += ' | ' + ' '.join('{} {:.0f}%'.format(stage, values['seconds'] / busy * 100)
+                                     for stage, values in snapshot.items())
+        return line
+
+    def _print(self, final=False):
+        tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        if tty:
+            self.stream.write('\r\033[K' + self.line() + ('\n' if final else ''))
+        else:
+            self.stream.write(self.line() + '\n')
+        self.stream.flush()
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def tree_size(path, limit=None):
+    """
+    Total size of the regular files below path, the total of the progress line of a backup.
+    The walk stops as soon as the total exceeds limit.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    folders = [path]
+    while folders:
+        try:
+            entries = os.scandir(folders.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+                if limit is not None and total > limit:
+                    return total
+    return total
+
+
+def cprofile_hook(path):
+    """
+    Hook profiling a run with cProfile, the stats are written to path (read them with pstats).
+    cProfile only sees the thread it is enabled in, so the threads started and the tasks submitted
+    to thread pools during the run (the compression, upload and extraction workers) are profiled
+    by a profiler of their thread, started and stopped in that thread. The stats of the stopped
+    profilers are merged, a persistent pool thread stops profiling after each task.
+    """
+    @contextmanager
+    def hook():
+        lock = threading.Lock()
+        local = threading.local()
+        finished = threading.Event()
+        # [profiler, running] of every thread which profiled
+        thread_profilers = []
+        thread_run = threading.Thread.run
+        pool_submit = ThreadPoolExecutor.submit
+
+        def start():
+            if finished.is_set():
+                # a task left over from the run
+                return
+            state = getattr(local, 'state', None)
+            profiler = cProfile.Profile() if state is None else state[0]
+            try:
+                profiler.enable()
+            except ValueError:
+                # python >= 3.12 allows one cProfile at a time
+                return
+            if state is None:
+                state = local.state = [profiler, True]
+                with lock:
+                    thread_profilers.append(state)
+            state[1] = True
+
+        def stop():
+            state = getattr(local, 'state', None)
+            if state is not None:
+                state[0].disable()
+                state[1] = False
+
+        def run(thread):
+            start()
+            try:
+                thread_run(thread)
+            finally:
+                stop()
+
+        def submit(executor, fn, *args, **kwargs):
+            def profiled(*args, **kwargs):
+                start()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    stop()
+            return pool_submit(executor, profiled, *args, **kwargs)
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        threading.Thread.run = run
+        ThreadPoolExecutor.submit = submit
+        try:
+            yield
+        finally:
+            threading.Thread.run = thread_run
+            ThreadPoolExecutor.submit = pool_submit
+            finished.set()
+            profiler.disable()
+            stats = pstats.Stats(profiler)
+            with lock:
+                stopped = [state[0] for state in thread_profilers if not state[1]]
+                running = len(thread_profilers) - len(stopped)
+            for thread_profiler in stopped:
+                stats.add(thread_profiler)
+            stats.dump_stats(path)
+            print("Profile written to {} ({} threads{})".format(
+                path, len(stopped) + 1, ', {} still running left out'.format(running) if running else ''))
+    return hook
+
+
+def tracemalloc_hook(path, limit=30):
+    """
+    Hook tracing the allocations of a run, the peak and the top allocation sites are written to path
+    """
+    @contextmanager
+    def hook():
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(path, 'w') as f:
+                f.write('current {:.1f} MB, peak {:.1f} MB\n'.format(current / 1e6, peak / 1e6))
+                for stat in snapshot.statistics('lineno')[:limit]:
+                    f.write('{}\n'.format(stat))
+            print("Allocation profile written to {}".format(path))
+    return hook
+
+
+PROFILERS = {'cprofile': cprofile_hook, 'tracemalloc': tracemalloc_hook}
@@ -0,0 +1,110 @@
+# encoding: utf-8
+from collections import namedtuple
+from datetime import datetime
+from aglacier import ConfigError
+
+# Glacier charges an archive deleted earlier for the rest of these days
+MIN_STORAGE_DAYS = 90
+
+# archive ids to keep with the reason, descriptions to delete, (description, days left) deleted later
+PrunePlan = namedtuple('PrunePlan', ['keep', 'delete', 'deferred'])
+
+
+def _day(value):
+    return value.toordinal()
+
+
+def _week(value):
+    # weeks starting on monday, day 1 is a monday
+    return (value.toordinal() - 1) // 7
+
+
+def _month(value):
+    return value.year * 12 + value.month - 1
+
+
+def _year(value):
+    return value.year
+
+
+PERIODS = [('keep_daily', 'daily', _day), ('keep_weekly', 'weekly', _week), ('keep_monthly', 'monthly', _month),
+           ('keep_yearly', 'yearly', _year)]
+
+
+class RetentionPolicy(object):
+    """
+    Versions of a backup object to keep, from the config, e.g.
+
+        {"keep_last": 3, "keep_daily": 30, "keep_monthly": 12}
+
+    keep_last keeps the newest versions, keep_daily the newest version of every day of the last
+    N days (today included), keep_weekly, keep_monthly and keep_yearly the same for weeks, months
+    and years. The newest version is always kept and so are the bases of kept incrementals.
+    """
+    def __init__(self, keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0, keep_yearly=0):
+        self.keep_last = keep_last
+        self.counts = {'keep_daily': keep_daily, 'keep_weekly': keep_weekly, 'keep_monthly': keep_monthly,
+                       'keep_yearly': keep_yearly}
+
+    @classmethod
+    def from_config(cls, config, name):
+        keys = ['keep_last'] + [key for key, reason, period in PERIODS]
+        if not isinstance(config, dict):
+            raise ConfigError("retention of '{}' must be an object with {}".format(name, ', '.join(keys)))
+        for key, value in config.items():
+            if key not in keys:
+                raise ConfigError("retention of '{}' has the unknown key '{}', use {}".format(
+                    name, key, ', '.join(keys)))
+            if not isinstance(value, int) or value < 0:
+                raise ConfigError("'{}' in the retention of '{}' must be a number >= 0".format(key, name))
+        return cls(**config)
+
+    def keep(self, versions, now):
+        """
+        Returns {archive id: reason} of the versions (descriptions) to keep at the datetime now
+        """
+        ordered = sorted(versions, key=lambda descr: (descr['datetime'], str(descr['id'])), reverse=True)
+        keep = {}
+        for descr in ordered[:max(self.keep_last, 1)]:
+            keep.setdefault(descr['id'], 'last')
+
+        for key, reason, period in PERIODS:
+            count = self.counts[key]
+            if not count:
+                continue
+            current = period(now)
+            seen = set()
+            for descr in ordered:
+                bucket = period(descr['datetime'])
+                if bucket in seen or current - bucket >= count:
+                    continue
+                seen.add(bucket)
+                keep.setdefault(descr['id'], reason)
+
+        # an incremental can't be restored without its bases
+        by_id = {descr['id']: descr for descr in versions}
+        for archive_id in list(keep):
+            descr = by_id[archive_id]
+            while 'type' in descr and descr['type'] == 'incremental' and descr['base'] in by_id:
+                descr = by_id[descr['base']]
+                keep.setdefault(descr['id'], 'base of {}'.format(archive_id))
+        return keep
+
+    def plan(self, versions, now=None, min_storage_days=MIN_STORAGE_DAYS, early=False):
+        """
+        PrunePlan of the versions at now. Versions stored for less than min_storage_days are
+        deferred, deleting them would be charged as if they were stored that long, unless early.
+        """
+        now = now or datetime.now()
+        keep = self.keep(versions, now)
+        delete = []
+        deferred = []
+        for descr in sorted(versions, key=lambda descr: (descr['datetime'], str(descr['id']))):
+            if descr['id'] in keep:
+                continue
+            days_left = min_storage_days - (now - descr['datetime']).days
+            if days_left > 0 and not early:
+                deferred.append((descr, days_left))
+            else:
+                delete.append(descr)
+        return PrunePlan(keep, delete, deferred)
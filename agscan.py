@@ -0,0 +1,190 @@
+# encoding: utf-8
+import os
+import stat
+import tarfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from functools import lru_cache
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+
+# path on disk, name in the archive, lstat result and symlink target
+ScanEntry = namedtuple('ScanEntry', ['path', 'arcname', 'stat', 'linkname'])
+
+
+def _list_dir(path):
+    """
+    Lists a directory with one lstat (and readlink for symlinks) per entry, sorted by name.
+    Entries vanishing meanwhile are left out.
+    """
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                st = entry.stat(follow_symlinks=False)
+                linkname = os.readlink(entry.path) if stat.S_ISLNK(st.st_mode) else ''
+            except FileNotFoundError:
+                continue
+            entries.append((entry.name, entry.path, st, linkname))
+    entries.sort(key=lambda e: e[0])
+    return entries
+
+
+class TreeScanner(object):
+    """
+    Walks a tree with a pool of os.scandir workers. The entries come out in the order
+    tarfile.add would archive them (depth first, sorted by name) while the workers already list
+    and stat up to max_ahead directories further down, which hides the latency of network
+    filesystems.
+
+    include and exclude are glob patterns: a pattern with a '/' is matched against the path
+    relative to the source (e.g. 'logs/*.gz'), others against the name. Excluded entries, and
+    everything below excluded directories, are skipped. With include only the files matching
+    one of its patterns are archived, directories are always walked.
+    """
+    def __init__(self, workers=8, include=None, exclude=None, max_ahead=None):
+        self.workers = workers
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.max_ahead = max_ahead if max_ahead is not None else 64 * workers
+
+    @staticmethod
+    def _matches(patterns, name, relpath):
+        for pattern in patterns:
+            if fnmatchcase(relpath if '/' in pattern else name, pattern):
+                return True
+        return False
+
+    def scan(self, source):
+        """
+        Yields a ScanEntry per entry of source, starting with source itself under its basename
+        """
+        source = os.path.abspath(source)
+        st = os.lstat(source)
+        yield ScanEntry(source, os.path.basename(source), st,
+                        os.readlink(source) if stat.S_ISLNK(st.st_mode) else '')
+        if not stat.S_ISDIR(st.st_mode):
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            # path -> future of its listing, for the directories listed ahead
+            listings = {}
+            stack = [iter(self._children(executor, listings, source, os.path.basename(source), ''))]
+            while stack:
+                entry = next(stack[-1], None)
+                if entry is None:
+                    stack.pop()
+                    continue
+                yield entry
+                if stat.S_ISDIR(entry.stat.st_mode):
+                    stack.append(iter(self._children(executor, listings, entry.path, entry.arcname,
+                                                     entry.arcname.split('/', 1)[1])))
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def _children(self, executor, listings, path, arcname, relpath):
+        future = listings.pop(path, None)
+        listing = future.result() if future is not None else _list_dir(path)
+
+        children = []
+        for name, child_path, st, linkname in listing:
+            child_relpath = relpath + '/' + name if relpath else name
+            if self._matches(self.exclude, name, child_relpath):
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if self.include and not is_dir and not self._matches(self.include, name, child_relpath):
+                continue
+            children.append(ScanEntry(child_path, arcname + '/' + name, st, linkname))
+            if is_dir and len(listings) < self.max_ahead:
+                listings[child_path] = executor.submit(_list_dir, child_path)
+        return children
+
+
+@lru_cache(maxsize=1024)
+def _uname(uid):
+    try:
+        return pwd.getpwuid(uid)[0] if pwd else ''
+    except KeyError:
+        return ''
+
+
+@lru_cache(maxsize=1024)
+def _gname(gid):
+    try:
+        return grp.getgrgid(gid)[0] if grp else ''
+    except KeyError:
+        return ''
+
+
+def scanned_tarinfo(tar, entry):
+    """
+    TarInfo of a ScanEntry, like tar.gettarinfo but from the stat of the scan. None for
+    unsupported file types (sockets).
+    """
+    st = entry.stat
+    mode = st.st_mode
+    linkname = ''
+    if stat.S_ISREG(mode):
+        inode = (st.st_ino, st.st_dev)
+        if st.st_nlink > 1 and inode in tar.inodes and entry.arcname != tar.inodes[inode]:
+            # hardlink to an archived file
+            file_type = tarfile.LNKTYPE
+            linkname = tar.inodes[inode]
+        else:
+            file_type = tarfile.REGTYPE
+            if inode[0]:
+                tar.inodes[inode] = entry.arcname
+    elif stat.S_ISDIR(mode):
+        file_type = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+        file_type = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+        file_type = tarfile.SYMTYPE
+        linkname = entry.linkname
+    elif stat.S_ISCHR(mode):
+        file_type = tarfile.CHRTYPE
+    elif stat.S_ISBLK(mode):
+        file_type = tarfile.BLKTYPE
+    else:
+        return None
+
+    tarinfo = tar.tarinfo(entry.arcname)
+    tarinfo.mode = mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.size = st.st_size if file_type == tarfile.REGTYPE else 0
+    tarinfo.mtime = st.st_mtime
+    tarinfo.type = file_type
+    tarinfo.linkname = linkname
+    tarinfo.uname = _uname(st.st_uid)
+    tarinfo.gname = _gname(st.st_gid)
+    if file_type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        tarinfo.devmajor = os.major(st.st_rdev)
+        tarinfo.devminor = os.minor(st.st_rdev)
+    return tarinfo
+
+
+def add_scanned(tar, entries):
+    """
+    Adds the ScanEntries to tar without statting them again, files removed since the scan are
+    left out
+    """
+    for entry in entries:
+        tarinfo = scanned_tarinfo(tar, entry)
+        if tarinfo is None:
+            continue
+        if tarinfo.isreg():
+            try:
+                f = open(entry.path, 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                tar.addfile(tarinfo, f)
+        else:
+            tar.addfile(tarinfo)
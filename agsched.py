@@ -0,0 +1,81 @@
+# encoding: utf-8
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BackupResult(object):
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+        self.duration = 0.0
+        self.size = 0
+        self.error = None
+
+    @property
+    def throughput(self):
+        """Uploaded MB/s"""
+        if not self.duration:
+            return 0.0
+        return self.size / self.duration / 1e6
+
+
+class BackupScheduler(object):
+    """
+    Runs the backups of several backup objects at once.
+
+    At most cpu_workers objects are tarred, compressed and encrypted at the same time. Their
+    uploads share the vault's pool of upload_threads, which is the limit for the network bound
+    work. Objects with a higher 'priority' (default 0) are started first, a failing object is
+    recorded in its BackupResult and does not stop the others.
+    """
+    def __init__(self, backup_func, cpu_workers=2):
+        self.backup_func = backup_func
+        self.cpu_workers = cpu_workers
+
+    @staticmethod
+    def order(backup_objects):
+        """
+        Highest priority first, objects of the same priority in config order
+        """
+        return sorted(backup_objects, key=lambda backup_object: -backup_object.get('priority', 0))
+
+    def _run_one(self, backup_object, result):
+        result.started = time.time()
+        try:
+            result.size = self.backup_func(backup_object) or 0
+        except Exception as e:
+            result.error = e
+            traceback.print_exc()
+        result.duration = time.time() - result.started
+        return result
+
+    def run(self, backup_objects):
+        """
+        Backs up all objects, returns their BackupResults in config order
+        """
+        results = [BackupResult(backup_object['name']) for backup_object in backup_objects]
+        by_object = {id(backup_object): result for backup_object, result in zip(backup_objects, results)}
+
+        with ThreadPoolExecutor(max_workers=self.cpu_workers) as executor:
+            # the executor's queue is FIFO, so submitting in priority order starts objects in that order
+            futures = [executor.submit(self._run_one, backup_object, by_object[id(backup_object)])
+                       for backup_object in self.order(backup_objects)]
+            for future in futures:
+                future.result()
+        return results
+
+    @staticmethod
+    def format_summary(results, duration=None):
+        lines = ['Backup summary:']
+        for result in results:
+            if result.error is not None:
+                lines.append('  {:<30} FAILED  {:>8.1f} s  {}'.format(result.name, result.duration, result.error))
+            else:
+                lines.append('  {:<30} ok      {:>8.1f} s  {:>10.1f} MB  {:>7.1f} MB/s'.format(
+                    result.name, result.duration, result.size / 1e6, result.throughput))
+        if duration is not None:
+            total = sum(result.size for result in results)
+            lines.append('  {:<30}         {:>8.1f} s  {:>10.1f} MB  {:>7.1f} MB/s'.format(
+                'total', duration, total / 1e6, total / duration / 1e6 if duration else 0.0))
+        return '\n'.join(lines)
@@ -0,0 +1,150 @@
+# encoding: utf-8
+import queue
+import threading
+
+
+class PipeReader(object):
+    """
+    Readable end of a ThreadedConsumer, read() blocks until the writer delivers data
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = bytearray()
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+            else:
+                self.buffer += chunk
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class ThreadedConsumer(object):
+    """
+    File like object handing everything written to it to consumer(reader), which runs in a
+    background thread and reads the data from a PipeReader. At most max_chunks writes are
+    queued, so a slow consumer slows down the writer instead of growing the memory use.
+
+    Errors raised by the consumer are re-raised by write() and close().
+    """
+    def __init__(self, consumer, max_chunks=16):
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.reader = PipeReader(self.chunks)
+        self.error = None
+        self.result = None
+        self.thread = threading.Thread(target=self._run, args=(consumer,), daemon=True)
+        self.thread.start()
+
+    def _run(self, consumer):
+        try:
+            self.result = consumer(self.reader)
+        except BaseException as e:
+            self.error = e
+
+    def _put(self, chunk):
+        while True:
+            if self.error is not None:
+                raise self.error
+            if not self.thread.is_alive():
+                # the consumer is done, trailing data (e.g. padding after the end of a tar) is dropped
+                return
+            try:
+                self.chunks.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            self._put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Signals the end of the stream and waits for the consumer, returns its result
+        """
+        if self.thread.is_alive():
+            self._put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def abort(self):
+        """
+        Ends the stream early and waits for the consumer, errors caused by the truncated stream are ignored
+        """
+        try:
+            self._put(None)
+        except Exception:
+            pass
+        self.thread.join()
+
+
+class SliceWriter(object):
+    """
+    File like object passing the length bytes following the first skip bytes written to it
+    on to out_file, everything else is dropped. finish() checks that the slice was complete.
+    """
+    def __init__(self, out_file, skip, length):
+        self.out_file = out_file
+        self.skip = skip
+        self.remaining = length
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = len(data)
+        if self.skip >= size:
+            self.skip -= size
+            return size
+        data = memoryview(data)[self.skip:self.skip + self.remaining]
+        self.skip = 0
+        if len(data):
+            self.remaining -= len(data)
+            self.out_file.write(data)
+        return size
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if self.remaining:
+            raise EOFError("data ended {} bytes before the end of the slice".format(self.remaining))
+
+
+class TeeWriter(object):
+    """
+    Writes everything written to it into out_file and into copy_file
+    """
+    def __init__(self, out_file, copy_file):
+        self.out_file = out_file
+        self.copy_file = copy_file
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.copy_file.write(data)
+        return self.out_file.write(data)
+
+    def flush(self):
+        pass
@@ -0,0 +1,151 @@
+# encoding: utf-8
+import re
+import threading
+import time
+from datetime import datetime
+from aglacier import ConfigError
+
+MBIT = 1000 * 1000 // 8
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+def mbit(value):
+    """Mbit/s of the config as bytes/s, None stays unlimited"""
+    return None if value is None else value * MBIT
+
+
+class BandwidthSchedule(object):
+    """
+    Time of day limits from the config, e.g.
+
+        [{"days": "mon-fri", "from": "08:00", "to": "18:00", "upload_mbit": 20},
+         {"from": "22:00", "to": "06:00", "upload_mbit": null}]
+
+    The first window containing the time gives the limit of its key ('upload_mbit' or
+    'download_mbit'), null is unlimited and 0 pauses the transfers until the window ends.
+    Windows may span midnight, days default to all. Outside of all windows the default applies.
+    """
+    def __init__(self, windows, key, default=None):
+        self.key = key
+        self.default = default
+        self.windows = []
+        for window in windows:
+            if key not in window:
+                continue
+            try:
+                days = self._parse_days(window['days'] if 'days' in window else 'mon-sun')
+                start = self._parse_time(window['from'])
+                end = self._parse_time(window['to'])
+            except (KeyError, ValueError) as e:
+                raise ConfigError("invalid bandwidth_schedule entry {}: {}".format(window, e))
+            self.windows.append((days, start, end, mbit(window[key])))
+
+    @staticmethod
+    def _parse_time(value):
+        m = re.match(r'^(\d{1,2}):(\d{2})$', value)
+        if not m or int(m.group(1)) > 24 or int(m.group(2)) > 59:
+            raise ValueError("time '{}' is not HH:MM".format(value))
+        return int(m.group(1)) * 60 + int(m.group(2))
+
+    @staticmethod
+    def _parse_days(value):
+        days = set()
+        for part in value.lower().split(','):
+            first, _, last = part.strip().partition('-')
+            if first not in DAYS or (last and last not in DAYS):
+                raise ValueError("days '{}' are not like mon-fri or sat,sun".format(value))
+            i, j = DAYS.index(first), DAYS.index(last or first)
+            while True:
+                days.add(i)
+                if i == j:
+                    break
+                i = (i + 1) % 7
+        return days
+
+    def rate_at(self, now):
+        """The limit in bytes/s at the datetime now"""
+        minute = now.hour * 60 + now.minute
+        day = now.weekday()
+        for days, start, end, rate in self.windows:
+            if start <= end:
+                inside = day in days and start <= minute < end
+            else:
+                # spans midnight, the part after midnight belongs to the day the window started
+                inside = (day in days and minute >= start) or ((day - 1) % 7 in days and minute < end)
+            if inside:
+                return rate
+        return self.default
+
+
+class Throttle(object):
+    """
+    Token bucket limiting the bytes per second of all threads consuming from it.
+
+    consume(n) takes n tokens and sleeps until the bucket is back in credit, so concurrent
+    workers are served in the order they asked and together never exceed the rate, and a
+    request larger than the bucket (a whole upload part) just waits longer. The rate is the
+    fixed one or, with a schedule, the one of the current time window, None is unlimited.
+    The achieved rate is the bytes consumed over the time since the first request.
+    """
+    def __init__(self, rate=None, schedule=None, burst=None, pause_check=60, clock=time.monotonic,
+                 sleep=time.sleep, now=datetime.now):
+        self.rate = rate
+        self.schedule = schedule
+        self.burst = burst
+        self.pause_check = pause_check
+        self.clock = clock
+        self.sleep = sleep
+        self.now = now
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = None
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def limited(self):
+        return self.rate is not None or (self.schedule is not None and bool(self.schedule.windows))
+
+    def current_rate(self):
+        if self.schedule is not None:
+            return self.schedule.rate_at(self.now())
+        return self.rate
+
+    def consume(self, n):
+        while True:
+            rate = self.current_rate()
+            with self.lock:
+                now = self.clock()
+                if self.started is None:
+                    self.started = now
+                if rate is None:
+                    self.bytes += n
+                    self.updated = now
+                    wait = 0
+                elif rate <= 0:
+                    # paused by the schedule
+                    self.updated = now
+                    wait = None
+                else:
+                    burst = self.burst if self.burst is not None else rate
+                    if self.updated is not None:
+                        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+                    self.updated = now
+                    self.tokens -= n
+                    self.bytes += n
+                    wait = -self.tokens / rate if self.tokens < 0 else 0
+
+            if wait is None:
+                self.sleep(self.pause_check)
+                continue
+            if wait:
+                self.sleep(wait)
+            self.finished = self.clock()
+            return
+
+    def achieved(self):
+        """Bytes per second since the first consume"""
+        if self.started is None or self.finished is None or self.finished <= self.started:
+            return 0.0
+        return self.bytes / (self.finished - self.started)
@@ -0,0 +1,443 @@
+# encoding: utf-8
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import select
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from agsched import BackupScheduler
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class WatchLimitReached(Exception):
+    pass
+
+
+def tree_signature(entries):
+    """
+    Digest of the names, types, sizes, mtimes and inodes of the ScanEntries of a tree, it
+    changes with any of them while only the digest is kept in memory
+    """
+    digest = hashlib.sha256()
+    for entry in entries:
+        st = entry.stat
+        digest.update('{}\0{}\0{}\0{}\0{}\0{}\n'.format(entry.arcname, st.st_mode, st.st_size, st.st_mtime_ns,
+                                                        st.st_ino, entry.linkname).encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+class InotifyWatcher(object):
+    """
+    Watches trees with inotify (Linux), one watch per directory. New directories are watched as
+    they appear, an overflow of the event queue counts as a change of every tree. Adding more than
+    max_watches watches, or more than the kernel allows (fs.inotify.max_user_watches), raises
+    WatchLimitReached, the trees it happens for are listed in limited.
+    """
+    def __init__(self, max_watches=None):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.max_watches = max_watches
+        # wd -> [(tree name, directory, only this file of it or None)]
+        self.watches = {}
+        self.limited = set()
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+    def watch(self, name, path):
+        """
+        Watches the tree path (a directory or a single file) as name
+        """
+        path = os.path.abspath(path)
+        if not os.path.isdir(path) or os.path.islink(path):
+            # files are replaced by renames, the folder sees that
+            self._add(name, os.path.dirname(path), os.path.basename(path))
+            return
+        folders = [path]
+        while folders:
+            folder = folders.pop()
+            self._add(name, folder, None)
+            try:
+                with os.scandir(folder) as it:
+                    folders.extend(entry.path for entry in it if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+
+    def _add(self, name, folder, only):
+        if self.max_watches is not None and len(self.watches) >= self.max_watches:
+            raise WatchLimitReached("more than {} watched directories".format(self.max_watches))
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise WatchLimitReached("inotify watch limit reached, see fs.inotify.max_user_watches")
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # vanished meanwhile or not readable
+                return
+            raise OSError(err, os.strerror(err), folder)
+        targets = self.watches.setdefault(wd, [])
+        if (name, folder, only) not in targets:
+            targets.append((name, folder, only))
+
+    def unwatch(self, name):
+        for wd, targets in list(self.watches.items()):
+            remaining = [target for target in targets if target[0] != name]
+            if remaining:
+                self.watches[wd] = remaining
+            else:
+                del self.watches[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def changes(self, timeout):
+        """
+        Returns the names of the trees changed, waiting up to timeout seconds for the first event
+        """
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                file_name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(target[0] for targets in self.watches.values() for target in targets)
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                for name, folder, only in list(self.watches.get(wd, ())):
+                    if only is not None and file_name != only:
+                        continue
+                    changed.add(name)
+                    if only is None and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            self.watch(name, os.path.join(folder, file_name))
+                        except WatchLimitReached:
+                            self.limited.add(name)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """
+    Detects changes by comparing a signature of every tree (see tree_signature) every interval
+    seconds, one digest per tree is kept whatever its size.
+    """
+    def __init__(self, interval=60, clock=time.monotonic, sleep=time.sleep):
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        # name -> [signature function, last signature, time of the next poll]
+        self.trees = {}
+
+    def watch(self, name, signature, current):
+        """
+        Watches the tree name, signature() computes its signature, current is the one it has now
+        """
+        self.trees[name] = [signature, current, self.clock() + self.interval]
+
+    def unwatch(self, name):
+        self.trees.pop(name, None)
+
+    def changes(self, timeout):
+        changed = set()
+        if not self.trees:
+            self.sleep(timeout)
+            return changed
+        wait = min(tree[2] for tree in self.trees.values()) - self.clock()
+        if wait > timeout:
+            self.sleep(timeout)
+            return changed
+        if wait > 0:
+            self.sleep(wait)
+        now = self.clock()
+        for name, tree in self.trees.items():
+            if tree[2] > now:
+                continue
+            signature = tree[0]()
+            if signature != tree[1]:
+                changed.add(name)
+                tree[1] = signature
+            tree[2] = now + self.interval
+        return changed
+
+    def close(self):
+        pass
+
+
+class Debouncer(object):
+    """
+    Coalesces changes: a name is due once no change came for window seconds, or max_delay
+    seconds after its first change if the changes keep coming.
+    """
+    def __init__(self, window, max_delay=None):
+        self.window = window
+        self.max_delay = max_delay
+        self.first = {}
+        self.last = {}
+
+    def touch(self, name, now):
+        self.first.setdefault(name, now)
+        self.last[name] = now
+
+    def _due_at(self, name):
+        due = self.last[name] + self.window
+        if self.max_delay is not None:
+            due = min(due, self.first[name] + self.max_delay)
+        return due
+
+    def next_due(self):
+        return min((self._due_at(name) for name in self.last), default=None)
+
+    def due(self, now):
+        """
+        Returns the due names and forgets them
+        """
+        names = [name for name in self.last if self._due_at(name) <= now]
+        for name in names:
+            del self.first[name]
+            del self.last[name]
+        return names
+
+
+class _StatusHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.sendall(json.dumps(self.server.daemon.status(), indent=2).encode('utf-8') + b'\n')
+
+
+class _StatusServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def read_status(socket_path):
+    """
+    The status of the daemon listening on socket_path
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(os.path.expanduser(socket_path))
+        data = b''
+        while True:
+            chunk = s.recv(64 * 1024)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data.decode('utf-8'))
+
+
+class BackupDaemon(object):
+    """
+    Backs up the backup objects whenever they changed: their trees are watched with inotify (or
+    polled where it isn't available or runs out of watches), the changes are debounced (see
+    Debouncer) and the changed objects backed up with backup_func on a BackupScheduler. The
+    signature of every object at its last backup is kept in state_file, so changes made while
+    the daemon wasn't running are backed up when it starts. A failed backup is retried after
+    the debounce window.
+
+    With socket_path the status (see status()) is served as JSON to every client of that unix
+    socket.
+    """
+    def __init__(self, backup_func, backup_objects, scanner, state_file, debounce=60, max_delay=3600,
+                 poll_interval=60, watcher='auto', max_watches=None, socket_path=None, cpu_workers=2,
+                 clock=time.time):
+        self.backup_func = backup_func
+        self.backup_objects = {backup_object['name']: backup_object for backup_object in backup_objects}
+        self.scanner = scanner
+        self.state_file = os.path.expanduser(state_file)
+        self.debouncer = Debouncer(debounce, max_delay)
+        self.poll_interval = poll_interval
+        self.watcher = watcher
+        self.max_watches = max_watches
+        self.socket_path = os.path.expanduser(socket_path) if socket_path else None
+        self.cpu_workers = cpu_workers
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.inotify = None
+        self.polling = PollingWatcher(poll_interval)
+        self.server = None
+        self.started = None
+        self.running = []
+        self.objects = {name: {'watched_by': None, 'changed': None, 'last_backup': None, 'result': None,
+                               'error': None, 'size': 0, 'backups': 0}
+                        for name in self.backup_objects}
+
+    def signature(self, name):
+        backup_object = self.backup_objects[name]
+        if not os.path.exists(backup_object['path']):
+            return None
+        return tree_signature(self.scanner(backup_object).scan(backup_object['path']))
+
+    def status(self):
+        with self.lock:
+            return {'started': self.started, 'pid': os.getpid(), 'running': list(self.running),
+                    'objects': {name: dict(values) for name, values in self.objects.items()}}
+
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_file)
+
+    def _watch(self):
+        """
+        Watches the objects with inotify if possible, returns the names of the others
+        """
+        use_inotify = self.watcher == 'inotify' or (self.watcher == 'auto' and InotifyWatcher.available())
+        if use_inotify:
+            self.inotify = InotifyWatcher(self.max_watches)
+        polled = []
+        for name, backup_object in self.backup_objects.items():
+            self.objects[name]['watched_by'] = 'inotify'
+            if self.inotify is not None:
+                try:
+                    self.inotify.watch(name, backup_object['path'])
+                    continue
+                except WatchLimitReached as e:
+                    print("Watching '{}' by polling, {}".format(name, e))
+                    self.inotify.unwatch(name)
+            self.objects[name]['watched_by'] = 'polling'
+            polled.append(name)
+        return polled
+
+    def _to_polling(self, name, signature):
+        print("Watching '{}' by polling from now on, it has too many directories for inotify".format(name))
+        self.inotify.unwatch(name)
+        self.inotify.limited.discard(name)
+        self.polling.watch(name, lambda: self.signature(name), signature)
+        with self.lock:
+            self.objects[name]['watched_by'] = 'polling'
+
+    def _changes(self, timeout):
+        if self.inotify is None:
+            return self.polling.changes(timeout)
+        if not self.polling.trees:
+            return self.inotify.changes(timeout)
+        # both: the polling trees are checked between short waits for events
+        changed = self.inotify.changes(min(timeout, 1.0))
+        changed |= self.polling.changes(0)
+        return changed
+
+    def _touch(self, names, now):
+        for name in names:
+            self.debouncer.touch(name, now)
+            with self.lock:
+                if self.objects[name]['changed'] is None:
+                    self.objects[name]['changed'] = now
+
+    def _backup(self, names, state):
+        # the signatures before the backups, changes made during them are backed up by the next run
+        signatures = {name: self.signature(name) for name in names}
+        with self.lock:
+            self.running = list(names)
+        results = BackupScheduler(self.backup_func, self.cpu_workers).run(
+            [self.backup_objects[name] for name in names])
+        print(BackupScheduler.format_summary(results))
+
+        now = self.clock()
+        for result in results:
+            with self.lock:
+                values = self.objects[result.name]
+                values['last_backup'] = now
+                values['backups'] += 1
+                values['size'] = result.size
+                values['result'] = 'ok' if result.error is None else 'failed'
+                values['error'] = None if result.error is None else str(result.error)
+                values['changed'] = None
+            if result.error is None:
+                state[result.name] = signatures[result.name]
+            else:
+                self._touch([result.name], now)
+        with self.lock:
+            self.running = []
+        self._save_state(state)
+
+    def _serve_status(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = _StatusServer(self.socket_path, _StatusHandler)
+        self.server.daemon = self
+        os.chmod(self.socket_path, 0o600)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def run(self, stop=None):
+        """
+        Runs until the threading.Event stop is set (or forever)
+        """
+        stop = stop or threading.Event()
+        self.started = self.clock()
+        state = self._load_state()
+        # watch first, so nothing changing while the signatures are computed is missed
+        polled = self._watch()
+        signatures = {name: self.signature(name) for name in self.backup_objects}
+        for name in polled:
+            self.polling.watch(name, lambda name=name: self.signature(name), signatures[name])
+        changed = [name for name in self.backup_objects if state.get(name) is None or state[name] != signatures[name]]
+        # changed while the daemon wasn't running, due right away
+        self._touch(changed, self.started - self.debouncer.window)
+
+        if self.socket_path is not None:
+            self._serve_status()
+        try:
+            while not stop.is_set():
+                now = self.clock()
+                next_due = self.debouncer.next_due()
+                timeout = 1.0 if next_due is None else min(max(next_due - now, 0), 1.0)
+                self._touch(self._changes(timeout), self.clock())
+                if self.inotify is not None:
+                    for name in list(self.inotify.limited):
+                        self._to_polling(name, self.signature(name))
+                due = self.debouncer.due(self.clock())
+                if due:
+                    self._backup(due, state)
+        finally:
+            if self.server is not None:
+                self.server.shutdown()
+                self.server.server_close()
+                os.remove(self.socket_path)
+            if self.inotify is not None:
+                self.inotify.close()
@@ -1,9 +1,76 @@
 import unittest
 from agcrypt import AESCipher
-from agmain import Agbackup
+from agmain import Agbackup, BackupFailed, BackupObjectNotFound, VerifyFailed
+from aglacier import GlacierVault, ConfigError, ChecksumMismatch, TreeHashWriter, MEGABYTE, chunk_hashes, tree_hash, \
+    hex_digest
+from aglocal import LocalVault
+from agcatalog import Catalog
+from agcache import RestoreCache
+from agdedup import Chunker
+from agsched import BackupScheduler
+from agbench import Bench, Sampler, compare, current_rss, peak_rss
+from agthrottle import Throttle, BandwidthSchedule
+from agscan import TreeScanner, add_scanned
+from agextract import TarExtractor, UnsafeMemberError
+from agretention import RetentionPolicy
+from agwatch import BackupDaemon, Debouncer, InotifyWatcher, read_status
+from agcompress import CompressWriter, DecompressWriter
+from agmetrics import cprofile_hook
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import sys
+import threading
+import time
 import io
+import os
+import shutil
 import tempfile
-from datetime import datetime
+import json
+import tarfile
+from datetime import datetime, timedelta
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+def make_local_vault(folder, **kwargs):
+    gv = GlacierVault('testvault', shelve_file=os.path.join(folder, 'shelve'), **kwargs)
+    gv.vault = LocalVault(os.path.join(folder, 'vault'))
+    return gv
+
+
+def make_agbackup(folder, **config):
+    """Agbackup working on a LocalVault, with a source folder 'src' containing a few files"""
+    src = os.path.join(folder, 'src')
+    os.makedirs(os.path.join(src, 'sub'))
+    for i in range(5):
+        with open(os.path.join(src, 'sub' if i % 2 else '', 'file{}.txt'.format(i)), 'wb') as f:
+            f.write(os.urandom(1000 * i) + b'text' * 2000 * i)
+
+    conf = {
+        "vault": "testvault",
+        "shelve_file": os.path.join(folder, 'shelve'),
+        "encryption_key": "testkeyblubb",
+        "part_size_mb": 1,
+        "backup_objects": [{"path": src, "name": "src", "encrypt": True}],
+    }
+    conf.update(config)
+    conf_path = os.path.join(folder, 'config.json')
+    with open(conf_path, 'w') as f:
+        json.dump(conf, f)
+
+    agb = Agbackup(conf_path)
+    agb.vault.vault = LocalVault(os.path.join(folder, 'vault'))
+    return agb
+
+
+def read_tree(folder):
+    tree = {}
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                tree[os.path.relpath(path, folder)] = f.read()
+    return tree
 
 
 class TestStringMethods(unittest.TestCase):
@@ -20,6 +87,101 @@ class TestStringMethods(unittest.TestCase):
         self.assertNotEqual(in_data.getvalue(), encr_data.getvalue())
         self.assertEqual(in_data.getvalue(), decr_data.getvalue())
 
+    def test_encryption_stream(self):
+        crypt = AESCipher('testkeyblubb')
+        in_data = os.urandom(100000)
+        encr_data = io.BytesIO()
+        decr_data = io.BytesIO()
+
+        writer = crypt.encrypt_writer(encr_data)
+        for i in range(0, len(in_data), 777):
+            writer.write(in_data[i:i + 777])
+        writer.finish()
+        crypt.decrypt(encr_data, decr_data)
+
+        self.assertEqual(in_data, decr_data.getvalue())
+
+    def test_encryption_segments(self):
+        from agcrypt import DecryptionError, EncryptWriter
+        in_data = os.urandom(100000)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            crypt = AESCipher('testkeyblubb', executor=executor, workers=3, segment_size=4096)
+            for size in (0, 4096, 4097, len(in_data)):
+                encr_data = io.BytesIO()
+                crypt.encrypt(io.BytesIO(in_data[:size]), encr_data)
+                decr_data = io.BytesIO()
+                writer = crypt.decrypt_writer(decr_data)
+                value = encr_data.getvalue()
+                for i in range(0, len(value), 1000):
+                    writer.write(value[i:i + 1000])
+                writer.finish()
+                self.assertEqual(in_data[:size], decr_data.getvalue(), size)
+
+            # a flipped bit, a dropped segment and a cut at a segment boundary are detected
+            value = encr_data.getvalue()
+            segment = 4096 + 16
+            for broken in (value[:100] + bytes([value[100] ^ 1]) + value[101:],
+                           value[:20] + value[20 + segment:],
+                           value[:20 + 3 * segment]):
+                with self.assertRaises(DecryptionError):
+                    crypt.decrypt(io.BytesIO(broken), io.BytesIO())
+
+            # the previous CBC stream format is still readable
+            encr_data = io.BytesIO()
+            writer = EncryptWriter(crypt.key, encr_data)
+            writer.write(in_data)
+            writer.finish()
+            decr_data = io.BytesIO()
+            crypt.decrypt(encr_data, decr_data)
+            self.assertEqual(in_data, decr_data.getvalue())
+
+    def test_decrypt_legacy(self):
+        from Crypto.Cipher import AES
+        import struct
+        crypt = AESCipher('testkeyblubb')
+        in_data = os.urandom(1000)
+        iv = os.urandom(16)
+        legacy = struct.pack('<Q', len(in_data)) + iv + AES.new(crypt.key, AES.MODE_CBC, iv).encrypt(
+            in_data + b'\x00' * (16 - len(in_data) % 16))
+
+        decr_data = io.BytesIO()
+        crypt.decrypt(io.BytesIO(legacy), decr_data)
+        self.assertEqual(in_data, decr_data.getvalue())
+
+        decr_data = io.BytesIO()
+        writer = crypt.decrypt_writer(decr_data)
+        for i in range(0, len(legacy), 100):
+            writer.write(legacy[i:i + 100])
+        writer.finish()
+        self.assertEqual(in_data, decr_data.getvalue())
+
+    def test_compression(self):
+        data = (os.urandom(50000) + b'compressible' * 50000) * 4
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            for codec in ('gzip', 'bz2', 'xz', 'none'):
+                compressed = io.BytesIO()
+                writer = CompressWriter(compressed, codec, executor=executor, workers=3, block_size=100000)
+                for i in range(0, len(data), 7777):
+                    writer.write(data[i:i + 7777])
+                writer.finish()
+                self.assertEqual(len(writer.blocks), (len(data) + 99999) // 100000)
+
+                decompressed = io.BytesIO()
+                reader = DecompressWriter(decompressed, codec)
+                value = compressed.getvalue()
+                for i in range(0, len(value), 5000):
+                    reader.write(value[i:i + 5000])
+                reader.finish()
+                self.assertEqual(data, decompressed.getvalue(), codec)
+
+        # concatenated gzip members are one valid gzip stream
+        import gzip
+        compressed = io.BytesIO()
+        writer = CompressWriter(compressed, 'gzip', block_size=100000)
+        writer.write(data)
+        writer.finish()
+        self.assertEqual(data, gzip.decompress(compressed.getvalue()))
+
     def test_tar(self):
         output_file = tempfile.TemporaryFile()
 
@@ -47,27 +209,1208 @@ class TestStringMethods(unittest.TestCase):
         decr_data.seek(0)
         Agbackup._extract_tarfile(output_folder='important_extracted', source_file=decr_data)
 
-    def test_dict_latest(self):
-        d = {
-            "s2difjsodfjaposiejghasodf": {"date": 2, },
-            "s1difjsodfjaposiejghasodf": {"date": 1, },
-            "s4difjsodfjaposiejghasodf": {"date": 4, },
-            "s3difjsodfjaposiejghasodf": {"date": 3, },
-        }
 
-        self.assertEqual("s4difjsodfjaposiejghasodf", Agbackup.get_latest_from_dict(d, 'date')[0])
+class TestGlacierVault(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_tree_hash(self):
+        data = os.urandom(3 * MEGABYTE + 100)
+        parts = [tree_hash(chunk_hashes(data[i:i + 2 * MEGABYTE])) for i in range(0, len(data), 2 * MEGABYTE)]
+        self.assertEqual(tree_hash(chunk_hashes(data)), tree_hash(parts))
+
+    def test_tree_hash_writer(self):
+        data = os.urandom(3 * MEGABYTE + 100)
+        for size in (0, 100, MEGABYTE, 2 * MEGABYTE, len(data)):
+            out = io.BytesIO()
+            writer = TreeHashWriter(out)
+            for i in range(0, size, 300000):
+                writer.write(data[i:min(i + 300000, size)])
+            self.assertEqual(hex_digest(tree_hash(chunk_hashes(data[:size]))), writer.hexdigest())
+            self.assertEqual(data[:size], out.getvalue())
+
+    def test_multipart_upload(self):
+        gv = make_local_vault(self.folder, part_size=MEGABYTE, upload_threads=3)
+        data = os.urandom(int(3.5 * MEGABYTE))
+        gv.upload(io.BytesIO(data), {"name": "big", "datetime": datetime.now(), "id": None, "encrypted": False})
+
+        arch_id, arch_descr = list(gv.get_archive_list('big').items())[0]
+        self.assertEqual(1, len(gv.vault.multipart_uploads))
+        with open(gv.vault.data_path(arch_id), 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual(hex_digest(tree_hash(chunk_hashes(data))), gv.vault.read_meta(arch_id)['checksum'])
+
+    def test_client_pool(self):
+        gv = GlacierVault('testvault', shelve_file=os.path.join(self.folder, 'shelve'), max_connections=3,
+                          max_attempts=7)
+        self.assertEqual(0, gv.clients.created)
+
+        vault = gv.vault
+        self.assertIs(vault, gv.vault)
+        self.assertEqual('testvault', vault.name)
+        config = vault.meta.client.meta.config
+        # max_attempts are the retries, total_max_attempts includes the first request
+        self.assertEqual((3, 8, 'adaptive'), (config.max_pool_connections, config.retries['total_max_attempts'],
+                                              config.retries['mode']))
+
+        # every thread has its own, reused by it
+        vaults = []
+        threads = [threading.Thread(target=lambda: vaults.append((gv.vault, gv.vault))) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(first is second and first is not vault for first, second in vaults))
+        self.assertEqual(3, gv.clients.created)
+
+    def test_lazy_imports(self):
+        config = os.path.join(self.folder, 'config.json')
+        with open(config, 'w') as f:
+            json.dump({"vault": "testvault", "shelve_file": os.path.join(self.folder, 'shelve'),
+                       "encryption_key": "key", "backup_objects": [{"path": self.folder, "name": "a", "encrypt": True}]},
+                      f)
+        # list only reads the catalog, neither boto3 nor the crypto library are loaded
+        script = ("import sys, agmain; sys.argv = ['agmain', '-c', {!r}, 'list']; agmain.main(); "
+                  "print(sorted(m for m in ('boto3', 'botocore', 'Crypto') if m in sys.modules))").format(config)
+        output = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, check=True).stdout
+        self.assertEqual(b'[]', output.strip().splitlines()[-1])
+
+    def test_ranged_download_resume(self):
+        gv = make_local_vault(self.folder, part_size=MEGABYTE, download_threads=2)
+        data = os.urandom(int(5.5 * MEGABYTE))
+        gv.upload(io.BytesIO(data), {"name": "big", "datetime": datetime.now(), "id": None, "encrypted": False})
+        arch_id = list(gv.get_archive_list('big'))[0]
+
+        job = gv.vault.Archive(arch_id).initiate_archive_retrieval()
+        gv.vault.Archive = lambda archive_id: type('A', (), {'initiate_archive_retrieval': lambda self: job})()
+        get_output = job.get_output
+        requested = []
+
+        def failing_get_output(range=None):
+            requested.append(range)
+            if range.startswith('bytes=3145728-'):
+                raise IOError("connection dropped")
+            return get_output(range)
+
+        job.get_output = failing_get_output
+        out = tempfile.TemporaryFile()
+        with self.assertRaises(IOError):
+            gv.retrieve(arch_id, out, resume=True)
+
+        # the finished ranges are recorded, only the missing ones are requested again
+        done = len(set(requested)) - 1
+        self.assertTrue(done > 0)
+        requested.clear()
+        job.get_output = lambda range=None: requested.append(range) or get_output(range)
+        self.assertTrue(gv.retrieve(arch_id, out, resume=True))
+        self.assertEqual(6 - done, len(requested))
+
+        out.seek(0)
+        self.assertEqual(data, out.read())
+
+        # recorded ranges are checked against the partial file: a corrupted range is downloaded again,
+        # a partial file which is gone drops the record
+        with self.assertRaises(IOError):
+            job.get_output = failing_get_output
+            gv.retrieve(arch_id, out, resume=True)
+        recorded = gv.catalog.download_ranges(arch_id, MEGABYTE)
+        self.assertTrue(recorded)
+        out.seek(min(recorded) + 10)
+        out.write(b'corrupted')
+        requested.clear()
+        job.get_output = lambda range=None: requested.append(range) or get_output(range)
+        self.assertTrue(gv.retrieve(arch_id, out, resume=True))
+        self.assertEqual(6 - len(recorded) + 1, len(requested))
+        out.seek(0)
+        self.assertEqual(data, out.read())
+
+        with self.assertRaises(IOError):
+            job.get_output = failing_get_output
+            gv.retrieve(arch_id, out, resume=True)
+        out = tempfile.TemporaryFile()
+        requested.clear()
+        job.get_output = lambda range=None: requested.append(range) or get_output(range)
+        self.assertTrue(gv.retrieve(arch_id, out, resume=True))
+        self.assertEqual(6, len(requested))
+        out.seek(0)
+        self.assertEqual(data, out.read())
+
+    def test_ranged_download_stream(self):
+        gv = make_local_vault(self.folder, part_size=MEGABYTE, download_threads=3)
+        data = os.urandom(int(4.2 * MEGABYTE))
+        gv.upload(io.BytesIO(data), {"name": "big", "datetime": datetime.now(), "id": None, "encrypted": False})
+        arch_id = list(gv.get_archive_list('big'))[0]
+
+        class Sink(object):
+            def __init__(self):
+                self.data = b''
+
+            def write(self, data):
+                self.data += data
+
+        sink = Sink()
+        self.assertTrue(gv.retrieve(arch_id, sink))
+        self.assertEqual(data, sink.data)
+
+    def test_retrieve_many(self):
+        import queue
+        gv = make_local_vault(self.folder, poll_interval=0.01, max_poll_interval=0.05)
+        gv.vault.job_delay = 3
+        datas = {}
+        for i in range(5):
+            data = os.urandom(1000 + i)
+            gv.upload(io.BytesIO(data), {"name": "a{}".format(i), "datetime": datetime.now(), "id": None,
+                                         "encrypted": False})
+            datas[list(gv.get_archive_list("a{}".format(i)))[0]] = data
+
+        # without waiting nothing is ready, the jobs are recorded in the catalog
+        outs = {archive_id: io.BytesIO() for archive_id in datas}
+        self.assertFalse(gv.retrieve_many(outs))
+        self.assertTrue(all(gv.catalog.get_job(archive_id) for archive_id in datas))
+
+        # all jobs are polled together, one listing per round instead of one request per job
+        self.assertTrue(gv.retrieve_many(outs, wait_mode=True))
+        self.assertEqual(2, gv.vault.list_jobs_calls)
+        for archive_id, data in datas.items():
+            self.assertEqual(data, outs[archive_id].getvalue())
+
+        # a notification ends the wait right away
+        gv.catalog.delete_job(list(datas)[0])
+        gv.vault.job_delay = 1
+        gv.poll_interval = gv.max_poll_interval = 60
+        gv.notifications = queue.Queue()
+        job_ids = []
+        archive = gv.vault.Archive
+
+        def notify(archive_id):
+            job = archive(archive_id).initiate_archive_retrieval()
+            job_ids.append(job.id)
+            return job
+
+        gv.vault.Archive = lambda archive_id: type('A', (), {
+            'initiate_archive_retrieval': lambda self: notify(archive_id)})()
+        threading.Timer(0.1, lambda: gv.notifications.put(json.dumps(
+            {'Type': 'Notification', 'Message': json.dumps({'JobId': job_ids[0], 'Completed': True})}))).start()
+        out = io.BytesIO()
+        started = time.time()
+        self.assertTrue(gv.retrieve(list(datas)[0], out, wait_mode=True))
+        self.assertTrue(time.time() - started < 30)
+        self.assertEqual(datas[list(datas)[0]], out.getvalue())
+
+    def test_small_upload(self):
+        gv = make_local_vault(self.folder, part_size=MEGABYTE)
+        gv.upload(io.BytesIO(b'small'), {"name": "small", "datetime": datetime.now(), "id": None, "encrypted": False})
+
+        self.assertEqual(0, len(gv.vault.multipart_uploads))
+        self.assertEqual(1, len(gv.get_archive_list('small')))
+
+
+class TestRestoreCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_lru_and_integrity(self):
+        cache = RestoreCache(os.path.join(self.folder, 'cache'), 3 * MEGABYTE)
+        datas = {'a{}'.format(i): os.urandom(MEGABYTE + i) for i in range(3)}
+        cache.put('a0', io.BytesIO(datas['a0']))
+        cache.put('a1', io.BytesIO(datas['a1']))
+        out = io.BytesIO()
+        self.assertTrue(cache.get('a0', out))
+        self.assertEqual(datas['a0'], out.getvalue())
+
+        # a1 is the least recently used entry
+        cache.put('a2', io.BytesIO(datas['a2']))
+        self.assertEqual(['a0', 'a2'], [key for key in datas if key in cache])
+        self.assertTrue(cache.total_size() <= 3 * MEGABYTE)
+
+        out = io.BytesIO()
+        self.assertTrue(cache.get('a2', out, 100, 199))
+        self.assertEqual(datas['a2'][100:200], out.getvalue())
+
+        with open(os.path.join(cache.folder, 'a0'), 'r+b') as f:
+            f.write(b'corrupted')
+        self.assertFalse(cache.get('a0', io.BytesIO()))
+        self.assertFalse('a0' in cache)
+
+    def test_vault_cache(self):
+        cache = RestoreCache(os.path.join(self.folder, 'cache'), 100 * MEGABYTE)
+        gv = make_local_vault(self.folder, part_size=MEGABYTE, cache=cache)
+        data = os.urandom(int(2.5 * MEGABYTE))
+        gv.upload(io.BytesIO(data), {"name": "big", "datetime": datetime.now(), "id": None, "encrypted": False})
+        arch_id = list(gv.get_archive_list('big'))[0]
+        self.assertFalse(arch_id in cache)
+
+        out = io.BytesIO()
+        self.assertTrue(gv.retrieve(arch_id, out))
+        self.assertTrue(arch_id in cache)
+        gv.vault.jobs.clear()
+        out = io.BytesIO()
+        self.assertTrue(gv.retrieve(arch_id, out))
+        self.assertEqual(data, out.getvalue())
+        self.assertFalse(gv.vault.jobs)
+
+        # uploads write through
+        gv.cache_uploads = True
+        gv.upload(io.BytesIO(data[:1000]), {"name": "small", "datetime": datetime.now(), "id": None,
+                                            "encrypted": False})
+        self.assertTrue(list(gv.get_archive_list('small'))[0] in cache)
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_latest(self):
+        catalog = Catalog(os.path.join(self.folder, 'catalog.sqlite'))
+        for i, day in enumerate([3, 1, 4, 2]):
+            catalog.add_archive({"name": "a", "datetime": datetime(2016, 1, day), "id": "id{}".format(i),
+                                 "encrypted": False})
+        catalog.add_archive({"name": "b", "datetime": datetime(2017, 1, 1), "id": "other", "encrypted": True})
+
+        self.assertEqual("id2", catalog.latest("a")['id'])
+        self.assertEqual(datetime(2016, 1, 4), catalog.latest("a")['datetime'])
+        self.assertEqual("id1", catalog.latest("a", "id1")['id'])
+        self.assertIsNone(catalog.latest("a", "x"))
+        self.assertEqual(4, len(catalog.versions("a")))
+        self.assertEqual(["a", "b"], sorted(catalog.archive_objects()))
+
+    def test_migrate_shelve(self):
+        import shelve
+        shelve_file = os.path.join(self.folder, 'shelve')
+        d = shelve.open(shelve_file)
+        d["archive_objects"] = {"a": {"id1": {"name": "a", "datetime": datetime(2016, 1, 1), "id": "id1",
+                                              "encrypted": False}}}
+        d["jobs"] = {"id1": "job1"}
+        d.close()
+
+        gv = GlacierVault('testvault', shelve_file=shelve_file)
+        self.assertEqual("id1", gv.get_latest("a")['id'])
+        self.assertEqual("job1", gv.catalog.get_job("id1"))
+        # imported only once
+        self.assertEqual(0, gv.catalog.migrate_shelve(shelve_file))
+
+    def test_list_filters(self):
+        catalog = Catalog(os.path.join(self.folder, 'catalog.sqlite'))
+        for i in range(30):
+            catalog.add_archive({"name": "obj{}".format(i % 3), "datetime": datetime(2016, 1, 1 + i),
+                                 "id": "id{}".format(i), "encrypted": False, "type": "full" if i % 2 else None})
+
+        page = catalog.list_archives(name="obj1", limit=4, offset=2)
+        self.assertEqual(["id22", "id19", "id16", "id13"], [arch_descr['id'] for arch_descr in page])
+        self.assertEqual(5, len(catalog.list_archives(since=datetime(2016, 1, 26))))
+        self.assertEqual(["id1"], [arch_descr['id'] for arch_descr in
+                                   catalog.list_archives(until=datetime(2016, 1, 2), archive_type="full")])
+        self.assertEqual([("obj1", 10, datetime(2016, 1, 29)), ("obj2", 10, datetime(2016, 1, 30))],
+                         catalog.list_names(offset=1))
+
+    def test_sync_inventory(self):
+        from aginventory import iter_inventory
+        gv = make_local_vault(self.folder, poll_interval=0.01)
+        for i in range(5):
+            gv.upload(io.BytesIO(os.urandom(100)), {"name": "n{}".format(i % 2), "datetime": datetime.now(),
+                                                    "id": None, "encrypted": True})
+        archives = gv.catalog.archive_objects()
+        gv.catalog.close()
+
+        # a lost catalog is rebuilt, an archive deleted from the vault long ago is removed
+        gv.catalog = Catalog(os.path.join(self.folder, 'new.sqlite'))
+        gv.catalog.add_archive({"name": "n0", "datetime": datetime(2016, 1, 1), "id": "deleted", "encrypted": False})
+        gv.vault.job_delay = 1
+        self.assertIsNone(gv.sync_inventory())
+        self.assertEqual((5, 1), gv.sync_inventory())
+        self.assertEqual({name: sorted(versions) for name, versions in archives.items()},
+                         {name: sorted(versions) for name, versions in gv.catalog.archive_objects().items()})
+        self.assertTrue(gv.get_latest("n1")['encrypted'])
+        self.assertEqual((0, 0), gv.sync_inventory(wait_mode=True))
+
+        # parsed incrementally, whatever the chunks
+        inventory = json.dumps({"VaultARN": "arn", "InventoryDate": "2016-01-01T00:00:00Z", "ArchiveList": [
+            {"ArchiveId": "a{}".format(i), "ArchiveDescription": "dü"} for i in range(100)]}).encode('utf-8')
+        entries = list(iter_inventory(io.BytesIO(inventory), chunk_size=7))
+        self.assertEqual("2016-01-01T00:00:00Z", entries[0])
+        self.assertEqual(["a{}".format(i) for i in range(100)], [entry['ArchiveId'] for entry in entries[1:]])
+
+
+class TestBackupScheduler(unittest.TestCase):
+
+    def test_run(self):
+        started = []
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def backup(backup_object):
+            with lock:
+                started.append(backup_object['name'])
+                running.append(backup_object['name'])
+                max_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(backup_object['name'])
+            if backup_object['name'] == 'broken':
+                raise IOError("disk gone")
+            return 1000
+
+        objects = [{"name": "a"}, {"name": "broken"}, {"name": "b", "priority": 5}, {"name": "c"}]
+        results = BackupScheduler(backup, cpu_workers=2).run(objects)
+
+        self.assertEqual(['a', 'broken', 'b', 'c'], [r.name for r in results])
+        self.assertEqual('b', started[0])
+        self.assertEqual(2, max(max_running))
+        self.assertIsInstance(results[1].error, IOError)
+        self.assertEqual([1000, 0, 1000, 1000], [r.size for r in results])
+        self.assertIn('FAILED', BackupScheduler.format_summary(results, 1.0))
+
+
+class TestThrottle(unittest.TestCase):
+
+    def test_token_bucket(self):
+        clock = [0.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        throttle = Throttle(1000, burst=1000, clock=lambda: clock[0], sleep=sleep)
+        throttle.consume(500)
+        self.assertAlmostEqual(0.5, clock[0])
+        # a request larger than the bucket waits for all of it
+        throttle.consume(3000)
+        self.assertAlmostEqual(3.5, clock[0])
+        clock[0] += 10
+        throttle.consume(1500)
+        self.assertAlmostEqual(14.0, clock[0])
+        self.assertAlmostEqual(5000 / 14.0, throttle.achieved())
+
+    def test_shared_by_threads(self):
+        throttle = Throttle(400 * 1000, burst=1000)
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(throttle.consume, [20 * 1000] * 8))
+        self.assertGreaterEqual(time.time() - started, 0.35)
+
+    def test_schedule(self):
+        schedule = BandwidthSchedule([
+            {"days": "mon-fri", "from": "08:00", "to": "18:00", "upload_mbit": 20},
+            {"days": "sat", "from": "22:00", "to": "06:00", "upload_mbit": 0},
+            {"from": "00:00", "to": "24:00", "download_mbit": 5}], 'upload_mbit', default=None)
+
+        self.assertEqual(2500000, schedule.rate_at(datetime(2026, 10, 14, 9, 30)))
+        self.assertIsNone(schedule.rate_at(datetime(2026, 10, 14, 18, 0)))
+        self.assertIsNone(schedule.rate_at(datetime(2026, 10, 17, 9, 30)))
+        self.assertEqual(0, schedule.rate_at(datetime(2026, 10, 17, 23, 0)))
+        self.assertEqual(0, schedule.rate_at(datetime(2026, 10, 18, 5, 59)))
+        self.assertIsNone(schedule.rate_at(datetime(2026, 10, 19, 5, 59)))
+
+        clock = [0.0]
+        now = [datetime(2026, 10, 17, 23, 0)]
+
+        def sleep(seconds):
+            clock[0] += seconds
+            now[0] = datetime(2026, 10, 18, 7, 0)
+
+        # paused until the window ends
+        throttle = Throttle(schedule=schedule, clock=lambda: clock[0], sleep=sleep, now=lambda: now[0])
+        throttle.consume(100)
+        self.assertEqual(60, clock[0])
+
+    def test_vault_upload(self):
+        folder = tempfile.mkdtemp()
+        try:
+            gv = make_local_vault(folder, part_size=MEGABYTE, upload_throttle=Throttle(100 * MEGABYTE))
+            per_object = Throttle(100 * MEGABYTE)
+            upload = gv.open_upload({"name": "throttled", "datetime": datetime.now(), "id": None,
+                                     "encrypted": False}, throttle=per_object)
+            upload.write(os.urandom(3 * MEGABYTE + 10))
+            upload.close()
+            self.assertEqual(3 * MEGABYTE + 10, gv.upload_throttle.bytes)
+            self.assertEqual(3 * MEGABYTE + 10, per_object.bytes)
+            gv.catalog.close()
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestTreeScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.src = os.path.join(self.folder, 'src')
+        for i in range(30):
+            path = os.path.join(self.src, 'd{}'.format(i % 3), 'e{}'.format(i % 4),
+                                'f{}.{}'.format(i, 'log' if i % 5 else 'txt'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'x' * i)
+        os.makedirs(os.path.join(self.src, 'empty'))
+        os.symlink('d0/e0/f0.txt', os.path.join(self.src, 'link'))
+        os.link(os.path.join(self.src, 'd1', 'e1', 'f1.log'), os.path.join(self.src, 'hard'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @staticmethod
+    def _members(write):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w|') as tar:
+            write(tar)
+        data.seek(0)
+        with tarfile.open(fileobj=data, mode='r|') as tar:
+            return [(m.name, m.type, m.size, m.linkname, m.mode, int(m.mtime), m.uname) for m in tar]
+
+    def test_same_as_tarfile(self):
+        expected = self._members(lambda tar: tar.add(self.src, arcname='src'))
+        self.assertEqual(expected, self._members(lambda tar: add_scanned(tar, TreeScanner(4).scan(self.src))))
+        # fewer directories listed ahead than there are
+        self.assertEqual(expected, self._members(
+            lambda tar: add_scanned(tar, TreeScanner(2, max_ahead=1).scan(self.src))))
+
+    def test_include_exclude(self):
+        scanner = TreeScanner(4, include=['*.txt'], exclude=['d2', 'd0/e0/*'])
+        names = [entry.arcname for entry in scanner.scan(self.src)]
+
+        self.assertNotIn('src/d2', names)
+        self.assertNotIn('src/d0/e0/f0.txt', names)
+        self.assertIn('src/d0/e0', names)
+        self.assertIn('src/d1/e1/f25.txt', names)
+        self.assertEqual([], [name for name in names if name.endswith('.log')])
+
+
+class TestTarExtractor(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.out = os.path.join(self.folder, 'out')
+        os.makedirs(self.out)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @staticmethod
+    def _tar(members):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w|') as tar:
+            for name, kind, content in members:
+                info = tarfile.TarInfo(name)
+                info.mtime = 1500000000
+                if kind == 'file':
+                    info.size = len(content)
+                    info.mode = 0o640
+                    tar.addfile(info, io.BytesIO(content))
+                    continue
+                if kind == 'dir':
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                else:
+                    info.type = tarfile.SYMTYPE if kind == 'symlink' else tarfile.LNKTYPE
+                    info.linkname = content
+                tar.addfile(info)
+        data.seek(0)
+        return data
+
+    def _extract(self, members, **kwargs):
+        with tarfile.open(fileobj=self._tar(members), mode='r|') as tar:
+            TarExtractor(self.out, small_file_size=1000, threads=3, **kwargs).extract(tar)
+
+    def test_round_trip(self):
+        members = [('a', 'dir', None)]
+        members += [('a/b{}/f{}'.format(i % 4, i), 'file', os.urandom(i * 10)) for i in range(60)]
+        members += [('a/large', 'file', os.urandom(5000)), ('a/link', 'symlink', 'large'),
+                    ('a/hard', 'hardlink', 'a/b1/f1'), ('a/b1/f1', 'file', b'replaced')]
+        self._extract(members)
+
+        tree = read_tree(self.out)
+        expected = {os.path.join(*name.split('/')): content for name, kind, content in members if kind == 'file'}
+        expected[os.path.join('a', 'link')] = expected[os.path.join('a', 'large')]
+        expected[os.path.join('a', 'hard')] = b'replaced'
+        self.assertEqual(expected, tree)
+        self.assertEqual('large', os.readlink(os.path.join(self.out, 'a', 'link')))
+        st = os.stat(os.path.join(self.out, 'a', 'b2', 'f2'))
+        self.assertEqual((0o640, 1500000000), (st.st_mode & 0o777, int(st.st_mtime)))
+        self.assertEqual(1500000000, int(os.stat(os.path.join(self.out, 'a')).st_mtime))
+
+    def test_unsafe_members(self):
+        for members in ([('../escaped', 'file', b'x')],
+                        [('/tmp/escaped', 'file', b'x')],
+                        [('a/../../escaped', 'file', b'x')],
+                        [('link', 'symlink', self.folder), ('link/escaped', 'file', b'x')],
+                        [('hard', 'hardlink', '../escaped')]):
+            with self.assertRaises(UnsafeMemberError):
+                self._extract(members)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'escaped')))
+
+        # a symlink already in the output folder pointing outside of it
+        os.symlink(self.folder, os.path.join(self.out, 'outside'))
+        with self.assertRaises(UnsafeMemberError):
+            self._extract([('outside/escaped', 'file', b'x')], overwrite=True)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'escaped')))
+
+    def test_overwrite(self):
+        os.makedirs(os.path.join(self.out, 'a'))
+        with open(os.path.join(self.out, 'a', 'f'), 'wb') as f:
+            f.write(b'old')
+        with self.assertRaises(FileExistsError):
+            self._extract([('a', 'dir', None), ('a/f', 'file', b'new')])
+
+        self._extract([('a', 'dir', None), ('a/f', 'file', b'new')], overwrite=True)
+        self.assertEqual({os.path.join('a', 'f'): b'new'}, read_tree(self.out))
+
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.now = datetime(2024, 6, 15, 12)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_keep(self):
+        # one version a day for 400 days, an incremental every day of the last week based on the one before
+        versions = [{"name": "a", "datetime": self.now - timedelta(days=i), "id": "d{}".format(i)} for i in range(400)]
+        for descr in versions[:7]:
+            descr.update(type='incremental', base='d{}'.format(int(descr['id'][1:]) + 1))
+
+        keep = RetentionPolicy(keep_last=2, keep_daily=3, keep_monthly=12).keep(versions, self.now)
+
+        self.assertEqual('last', keep['d0'])
+        self.assertEqual('daily', keep['d2'])
+        # the newest version of the earlier months, 12 months including the current one
+        self.assertEqual('monthly', keep['d15'])
+        self.assertEqual('monthly', keep['d320'])
+        self.assertNotIn('d351', keep)
+        self.assertEqual('base of d0', keep['d3'])
+        self.assertEqual('base of d0', keep['d7'])
+        self.assertNotIn('d8', keep)
+        self.assertEqual(19, len(keep))
+        self.assertEqual(['d{}'.format(i) for i in range(8)], sorted(RetentionPolicy().keep(versions, self.now)))
+
+        plan = RetentionPolicy(keep_daily=3).plan(versions, self.now)
+        self.assertEqual(['d{}'.format(i) for i in range(399, 89, -1)], [descr['id'] for descr in plan.delete])
+        self.assertEqual([('d89', 1), ('d8', 82)], [(descr['id'], days_left) for descr, days_left in plan.deferred][::81])
+        self.assertEqual(392, len(RetentionPolicy(keep_daily=3).plan(versions, self.now, early=True).delete))
+
+        with self.assertRaises(ConfigError):
+            RetentionPolicy.from_config({"keep_hourly": 3}, "a")
+
+    def test_prune(self):
+        agb = make_agbackup(self.folder, retention={"keep_last": 1})
+        for days in (200, 150, 100, 10, 1):
+            agb.vault.upload(io.BytesIO(os.urandom(100)), {"name": "src", "id": None, "encrypted": False,
+                                                          "datetime": datetime.now() - timedelta(days=days)})
+        versions = agb.vault.catalog.versions("src")
+
+        self.assertEqual([], agb.prune(dry_run=True))
+        self.assertEqual(5, len(agb.vault.catalog.versions("src")))
+
+        deleted = agb.prune("src")
+        self.assertEqual(sorted(archive_id for archive_id, descr in versions.items()
+                                if descr['datetime'] < datetime.now() - timedelta(days=90)), sorted(deleted))
+        self.assertEqual(2, len(agb.vault.catalog.versions("src")))
+        self.assertFalse(os.path.exists(agb.vault.vault.data_path(deleted[0])))
+
+        # the version of 10 days ago is only deleted early
+        self.assertEqual([], agb.prune())
+        self.assertEqual(1, len(agb.prune(early=True)))
+        self.assertEqual(1, len(agb.vault.catalog.versions("src")))
+        with self.assertRaises(BackupObjectNotFound):
+            agb.prune("unknown")
+
+
+class TestBackupDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(self.folder, name, 'sub'))
+            with open(os.path.join(self.folder, name, 'sub', 'file'), 'wb') as f:
+                f.write(b'x')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @staticmethod
+    def _wait_for(condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                raise AssertionError("timed out")
+            time.sleep(0.02)
+
+    def test_debouncer(self):
+        debouncer = Debouncer(10, max_delay=25)
+        debouncer.touch('a', 0)
+        debouncer.touch('a', 8)
+        debouncer.touch('b', 5)
+        self.assertEqual(15, debouncer.next_due())
+        self.assertEqual(['b'], debouncer.due(15))
+        for now in (16, 24):
+            debouncer.touch('a', now)
+        # changing all the time, due max_delay after the first change
+        self.assertEqual([], debouncer.due(24))
+        self.assertEqual(['a'], debouncer.due(25))
+        self.assertIsNone(debouncer.next_due())
+
+    def _run(self, watcher):
+        backed_up = []
+        socket_path = os.path.join(self.folder, 'status.sock')
+        backup_objects = [{"name": name, "path": os.path.join(self.folder, name)} for name in ('a', 'b')]
+
+        def start():
+            daemon = BackupDaemon(lambda backup_object: backed_up.append(backup_object['name']) or 1, backup_objects,
+                                  lambda backup_object: TreeScanner(2), os.path.join(self.folder, 'state.json'),
+                                  debounce=0.2, poll_interval=0.1, watcher=watcher, socket_path=socket_path)
+            stop = threading.Event()
+            thread = threading.Thread(target=daemon.run, args=(stop,))
+            thread.start()
+            return stop, thread
+
+        # never backed up, both are due right away
+        stop, thread = start()
+        self._wait_for(lambda: sorted(backed_up) == ['a', 'b'])
+
+        with open(os.path.join(self.folder, 'a', 'sub', 'file'), 'wb') as f:
+            f.write(b'changed')
+        os.makedirs(os.path.join(self.folder, 'a', 'new'))
+        self._wait_for(lambda: len(backed_up) == 3)
+        with open(os.path.join(self.folder, 'a', 'new', 'file'), 'wb') as f:
+            f.write(b'in a new folder')
+        self._wait_for(lambda: len(backed_up) == 4)
+        self.assertEqual(['a', 'a'], backed_up[2:])
+
+        # the status is updated once backup_func returned
+        self._wait_for(lambda: read_status(socket_path)['objects']['a']['backups'] == 3)
+        status = read_status(socket_path)
+        self.assertEqual((3, 'ok', watcher), (status['objects']['a']['backups'], status['objects']['a']['result'],
+                                              status['objects']['a']['watched_by']))
+        self.assertEqual(1, status['objects']['b']['backups'])
+        stop.set()
+        thread.join()
+        self.assertFalse(os.path.exists(socket_path))
+
+        # only what changed while it wasn't running is backed up after a restart
+        with open(os.path.join(self.folder, 'b', 'file'), 'wb') as f:
+            f.write(b'new')
+        stop, thread = start()
+        self._wait_for(lambda: len(backed_up) == 5)
+        time.sleep(0.5)
+        stop.set()
+        thread.join()
+        self.assertEqual(['b'], backed_up[4:])
+
+    def test_polling(self):
+        self._run('polling')
+
+    @unittest.skipUnless(InotifyWatcher.available(), "inotify is only available on Linux")
+    def test_inotify(self):
+        self._run('inotify')
+
+
+class TestBench(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_run_and_compare(self):
+        results = Bench(self.folder, 'small', 64 * 1024).run()
+
+        self.assertEqual(['tar', 'compress', 'decompress', 'encrypt', 'decrypt', 'upload', 'extract', 'backup',
+                          'restore'], [r['stage'] for r in results])
+        self.assertTrue(all(r['seconds'] > 0 and r['peak_rss'] > 0 for r in results))
+        self.assertEqual([], compare(results, {'results': results}, 0.2))
+
+        slower = [dict(r, mb_per_s=r['mb_per_s'] * 0.5) for r in results]
+        self.assertEqual(len(results), len(compare(slower, {'results': results}, 0.2)))
+
+        # the archive written into the vault is no temporary file
+        upload = results[5]
+        self.assertTrue(upload['temp_disk'] < upload['bytes'])
+
+    def test_sampler(self):
+        # the peak while the block ran, not the one of the process
+        with Sampler(lambda: 0) as sampler:
+            data = b'x' * (64 * MEGABYTE)
+            time.sleep(0.1)
+            del data
+        self.assertTrue(sampler.peak_rss > current_rss() + 32 * MEGABYTE)
+        with Sampler(lambda: 0) as sampler:
+            time.sleep(0.05)
+        self.assertTrue(sampler.peak_rss < peak_rss() - 32 * MEGABYTE)
+
+
+class TestAgbackup(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_backup_stream(self):
+        agb = make_agbackup(self.folder)
+        agb.backup('src')
+
+        arch_id = list(agb.vault.get_archive_list('src'))[0]
+        decrypted = io.BytesIO()
+        with open(agb.vault.vault.data_path(arch_id), 'rb') as f:
+            agb.crypt.decrypt(f, decrypted)
+        decrypted.seek(0)
+        with tarfile.open(fileobj=decrypted, mode='r:gz') as tar:
+            tar.extractall(os.path.join(self.folder, 'out'))
+
+        self.assertEqual(read_tree(os.path.join(self.folder, 'src')),
+                         read_tree(os.path.join(self.folder, 'out', 'src')))
+
+    def test_backup_restore(self):
+        agb = make_agbackup(self.folder)
+        agb.backup('src')
+        out = os.path.join(self.folder, 'out')
+        agb.retrive('src', out, force=False, wait=False)
+
+        self.assertEqual(read_tree(os.path.join(self.folder, 'src')), read_tree(os.path.join(out, 'src')))
+        with self.assertRaises(FileExistsError):
+            agb.retrive('src', out, force=False, wait=False)
+        agb.retrive('src', out, force=True, wait=False)
+
+    def test_verify(self):
+        agb = make_agbackup(self.folder)
+        agb.config['backup_objects'].append({"path": os.path.join(self.folder, 'src'), "name": "plain"})
+        agb.backup(None)
+        self.assertEqual(['ok', 'ok'], list(agb.verify().values()))
+
+        # the vault serves another (valid) archive for it, only the tree hash of the catalog notices
+        arch_descr = agb.vault.get_latest('plain')
+        with open(os.path.join(self.folder, 'src', 'file0.txt'), 'wb') as f:
+            f.write(b'changed')
+        agb.backup('plain')
+        other_id = agb.vault.get_latest('plain')['id']
+        for suffix in ('', '.json'):
+            shutil.copy(agb.vault.vault.data_path(other_id) + suffix,
+                        agb.vault.vault.data_path(arch_descr['id']) + suffix)
+        agb.vault.catalog.delete_job(arch_descr['id'])
+        with self.assertRaises(VerifyFailed):
+            agb.verify('plain', all_versions=True)
+        with self.assertRaises(ChecksumMismatch):
+            agb.retrive('plain', os.path.join(self.folder, 'out'), force=False, wait=False, archive_id=arch_descr['id'])
+        self.assertIn('recorded at upload', agb._verify_archive(arch_descr, wait=False, cached_only=False))
+
+        # a tar stream other than the archived one
+        arch_descr = agb.vault.get_latest('src')
+        arch_descr['content_checksum'] = hex_digest(tree_hash(chunk_hashes(b'other')))
+        agb.vault.catalog.add_archive(arch_descr)
+        with self.assertRaises(ChecksumMismatch):
+            agb.retrive('src', os.path.join(self.folder, 'out_src'), force=False, wait=False)
+        self.assertEqual('not cached', agb.verify('src', all_versions=True, cached_only=True)[arch_descr['id']])
+
+    def test_bundle(self):
+        agb = make_agbackup(self.folder, bundle_max_object_kb=200, bundle_size_mb=1)
+        src = os.path.join(self.folder, 'src')
+        os.makedirs(os.path.join(self.folder, 'big'))
+        with open(os.path.join(self.folder, 'big', 'data.bin'), 'wb') as f:
+            f.write(os.urandom(300000))
+        agb.config['backup_objects'] += [{"path": os.path.join(src, 'sub'), "name": "plain",
+                                          "retention": {"keep_last": 10}},
+                                         {"path": os.path.join(self.folder, 'big'), "name": "big"}]
+        agb.backup(None)
+
+        first = agb.vault.get_latest('src')
+        plain = agb.vault.get_latest('plain')
+        self.assertNotIn('bundle', agb.vault.get_latest('big'))
+        self.assertEqual(first['bundle'], plain['bundle'])
+        self.assertEqual([first['id'], plain['id']], agb.vault.catalog.bundled(first['bundle']))
+        self.assertEqual(first['offset'] + first['size'], plain['offset'])
+        self.assertTrue(os.path.exists(agb.vault.vault.data_path(first['bundle'])))
+
+        out = os.path.join(self.folder, 'out')
+        agb.retrive('src', out, force=False, wait=False)
+        self.assertEqual(read_tree(src), read_tree(os.path.join(out, 'src')))
+        agb.retrive('plain', out, force=False, wait=False, path='sub/file3.txt')
+        # encrypted, only the segments holding the file
+        agb.retrive('src', os.path.join(self.folder, 'out_member'), force=False, wait=False, path='src/file4.txt')
+        with open(os.path.join(src, 'file4.txt'), 'rb') as f, \
+                open(os.path.join(self.folder, 'out_member', 'src', 'file4.txt'), 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        with open(os.path.join(src, 'sub', 'file3.txt'), 'rb') as f, \
+                open(os.path.join(out, 'sub', 'file3.txt'), 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertTrue(all(job.retrieval_byte_range for job in agb.vault.vault.jobs.values()
+                            if job.archive_id == first['bundle']))
+        self.assertEqual(['ok'] * 3, list(agb.verify().values()))
+
+        # the inventory lists the bundle, not the versions in it
+        added, removed = agb.vault.catalog.sync_inventory(
+            [{"id": first['bundle'], "name": "bundle", "type": "bundle", "datetime": datetime.now()},
+             agb.vault.get_latest('big')], datetime.now() + timedelta(days=1))
+        self.assertEqual((0, 0), (added, removed))
+
+        # the bundle is deleted with the last of its versions
+        agb.config['backup_objects'][0]['retention'] = {"keep_last": 1}
+        agb.backup(None)
+        self.assertEqual([first['id']], agb.prune(early=True))
+        self.assertTrue(os.path.exists(agb.vault.vault.data_path(first['bundle'])))
+        agb.config['backup_objects'][1]['retention'] = {"keep_last": 1}
+        self.assertEqual([plain['id']], agb.prune(early=True))
+        self.assertFalse(os.path.exists(agb.vault.vault.data_path(first['bundle'])))
+        self.assertEqual(1, len(agb.vault.catalog.versions('plain')))
+
+    def test_restore_conflict(self):
+        agb = make_agbackup(self.folder)
+        agb.backup('src')
+        out = os.path.join(self.folder, 'out')
+        agb.retrive('src', out, force=False, wait=False)
+
+        # only a file late in the archive exists, the conflict is found before anything is retrieved
+        removed = sorted(read_tree(os.path.join(out, 'src')))[:-1]
+        for path in removed:
+            os.remove(os.path.join(out, 'src', path))
+        jobs = len(agb.vault.vault.jobs)
+        with self.assertRaises(FileExistsError):
+            agb.retrive('src', out, force=False, wait=False)
+        self.assertEqual(jobs, len(agb.vault.vault.jobs))
+        self.assertEqual(1, len(read_tree(out)))
+
+    def test_restore_member(self):
+        agb = make_agbackup(self.folder)
+        src = os.path.join(self.folder, 'src')
+        for i in range(20):
+            with open(os.path.join(src, 'big{}.bin'.format(i)), 'wb') as f:
+                f.write(os.urandom(300000))
+        agb.config['backup_objects'].append({"path": src, "name": "plain", "compression": "bz2"})
+
+        for name in ('src', 'plain'):
+            agb.backup(name)
+            arch_descr = agb.vault.get_latest(name)
+            out = os.path.join(self.folder, 'out_' + name)
+            for path in ('src/big13.bin', 'src/sub/file3.txt', './src/file0.txt'):
+                agb.retrive(name, out, force=False, wait=False, path=path)
+                with open(os.path.join(self.folder, path), 'rb') as f, open(os.path.join(out, path), 'rb') as g:
+                    self.assertEqual(f.read(), g.read(), path)
+
+            # only the MiBs around the files were retrieved, a job for the same range is reused
+            ranges = [job.retrieval_byte_range for job in agb.vault.vault.jobs.values()
+                      if job.archive_id == arch_descr['id']]
+            self.assertTrue(ranges)
+            self.assertEqual(len(set(ranges)), len(ranges))
+            for byte_range in ranges:
+                start, end = (int(x) for x in byte_range.split('-'))
+                self.assertTrue(end - start + 1 <= 3 * MEGABYTE < arch_descr['size'])
+
+            with self.assertRaises(BackupObjectNotFound):
+                agb.retrive(name, out, force=True, wait=False, path='src/missing.txt')
+
+    def test_dedup(self):
+        agb = make_agbackup(self.folder)
+        agb.config['backup_objects'][0]['dedup'] = True
+        src = os.path.join(self.folder, 'src')
+        with open(os.path.join(src, 'big.bin'), 'wb') as f:
+            f.write(os.urandom(12 * MEGABYTE))
+
+        def vault_size():
+            vault = agb.vault.vault.folder
+            return sum(os.path.getsize(os.path.join(vault, n)) for n in os.listdir(vault))
+
+        agb.backup('src')
+        first_size = vault_size()
+        with open(os.path.join(src, 'file0.txt'), 'ab') as f:
+            f.write(b'changed')
+        agb.backup('src')
+
+        # only the chunk holding the change is uploaded again, it may be up to max_size long,
+        # plus the manifest archive
+        self.assertTrue(first_size > 12 * MEGABYTE)
+        self.assertTrue(vault_size() - first_size < Chunker().max_size + MEGABYTE)
+
+        out = os.path.join(self.folder, 'out')
+        agb.retrive('src', out, force=False, wait=False)
+        self.assertEqual(read_tree(src), read_tree(os.path.join(out, 'src')))
+
+        # without the local index the manifest is read from the version archive
+        for name in os.listdir(self.folder):
+            if name.startswith('shelve.chunks'):
+                os.remove(os.path.join(self.folder, name))
+        agb.retrive('src', out, force=True, wait=False)
+        self.assertEqual(read_tree(src), read_tree(os.path.join(out, 'src')))
+
+    def test_dedup_encrypted_and_plain(self):
+        agb = make_agbackup(self.folder)
+        src = os.path.join(self.folder, 'src')
+        agb.config['backup_objects'] = [{"path": src, "name": "encrypted", "dedup": True, "encrypt": True},
+                                        {"path": src, "name": "plain", "dedup": True}]
+        agb.backup('plain')
+        agb.backup('encrypted')
+
+        # the same content, but the encrypted version has its own encrypted packs
+        packs = {}
+        with agb.chunk_index as index:
+            for name in ('plain', 'encrypted'):
+                packs[name] = {pack_id for _, pack_id, _, _ in index.manifest(agb.vault.get_latest(name)['id'])}
+        self.assertFalse(packs['plain'] & packs['encrypted'])
+
+        for name in ('plain', 'encrypted'):
+            out = os.path.join(self.folder, 'out_' + name)
+            agb.retrive(name, out, force=False, wait=False)
+            self.assertEqual(read_tree(src), read_tree(os.path.join(out, 'src')))
+
+    def test_incremental(self):
+        agb = make_agbackup(self.folder)
+        agb.config['backup_objects'][0]['incremental'] = True
+        src = os.path.join(self.folder, 'src')
+        agb.backup('src')
+
+        with open(os.path.join(src, 'file0.txt'), 'ab') as f:
+            f.write(b'changed')
+        with open(os.path.join(src, 'sub', 'new.txt'), 'wb') as f:
+            f.write(b'new')
+        os.remove(os.path.join(src, 'sub', 'file1.txt'))
+        lstat = os.lstat
+        statted = []
+
+        def counting_lstat(path, *args, **kwargs):
+            if str(path).startswith(src + os.sep):
+                statted.append(path)
+            return lstat(path, *args, **kwargs)
+
+        os.lstat = counting_lstat
+        try:
+            agb.backup('src')
+        finally:
+            os.lstat = lstat
+        # the tar headers are built from the scan
+        self.assertEqual([], statted)
+        agb.backup('src')  # nothing changed, nothing uploaded
+
+        versions = agb.vault.get_archive_list('src')
+        self.assertEqual(['full', 'incremental'], sorted(v['type'] for v in versions.values()))
+        incremental = [v for v in versions.values() if v['type'] == 'incremental'][0]
+        decrypted = io.BytesIO()
+        with open(agb.vault.vault.data_path(incremental['id']), 'rb') as f:
+            agb.crypt.decrypt(f, decrypted)
+        decrypted.seek(0)
+        with tarfile.open(fileobj=decrypted, mode='r:gz') as tar:
+            self.assertEqual(['.agbackup_incremental.json', 'src/file0.txt', 'src/sub/new.txt'],
+                             sorted(tar.getnames()))
+
+        out = os.path.join(self.folder, 'out')
+        agb.retrive('src', out, force=False, wait=False)
+        self.assertEqual(read_tree(src), read_tree(os.path.join(out, 'src')))
+
+        # single files: unchanged ones come from the base, deleted ones are gone in the incremental
+        members = os.path.join(self.folder, 'out_members')
+        agb.retrive('src', members, force=False, wait=False, path='src/file2.txt')
+        self.assertEqual(['src/file2.txt'], list(read_tree(members)))
+        with self.assertRaises(BackupObjectNotFound):
+            agb.retrive('src', members, force=False, wait=False, path='src/sub/file1.txt')
+        full = [v for v in versions.values() if v['type'] == 'full'][0]
+        agb.retrive('src', members, force=False, wait=False, path='src/sub/file1.txt', archive_id=full['id'])
+        self.assertEqual(['src/file2.txt', 'src/sub/file1.txt'], sorted(read_tree(members)))
+
+    def test_backup_restore_codecs(self):
+        agb = make_agbackup(self.folder)
+        src = os.path.join(self.folder, 'src')
+        agb.config['backup_objects'] = [{"path": src, "name": "xz", "compression": "xz", "encrypt": True},
+                                        {"path": src, "name": "none", "compression": "none"}]
+        agb.backup(None)
+
+        for name in ('xz', 'none'):
+            self.assertEqual(name, agb.vault.get_latest(name)['compression'])
+            out = os.path.join(self.folder, 'out_' + name)
+            agb.retrive(name, out, force=False, wait=False)
+            self.assertEqual(read_tree(src), read_tree(os.path.join(out, 'src')))
+
+    def test_backup_all(self):
+        agb = make_agbackup(self.folder)
+        src = os.path.join(self.folder, 'src')
+        agb.config['backup_objects'] += [{"path": src, "name": "plain"},
+                                         {"path": os.path.join(self.folder, 'missing'), "name": "missing"},
+                                         {"path": src, "name": "dedup", "dedup": True, "priority": 1}]
+        with self.assertRaises(BackupFailed):
+            agb.backup(None)
+
+        self.assertEqual(['dedup', 'plain', 'src'], sorted(agb.vault.get_archive_list()))
+
+    def test_metrics(self):
+        prom = os.path.join(self.folder, 'metrics.prom')
+        agb = make_agbackup(self.folder, progress=True, metrics_file=prom, metrics_format='prometheus')
+        agb.backup('src')
+        agb.retrive('src', os.path.join(self.folder, 'out'), force=False, wait=False)
+
+        stages = agb.metrics.snapshot()
+        for stage in ('tar', 'compress', 'encrypt', 'upload', 'download', 'decrypt', 'decompress', 'extract'):
+            self.assertIn(stage, stages)
+        self.assertEqual(stages['compress']['bytes'], stages['tar']['bytes'])
+        self.assertEqual(stages['decrypt']['bytes'], stages['download']['bytes'])
+        self.assertEqual(agb.vault.get_latest('src')['size'], stages['download']['bytes'])
+
+        agb.report_metrics('backup')
+        with open(prom) as f:
+            self.assertIn('agbackup_stage_bytes_total{stage="upload",command="backup"}', f.read())
+
+        lines = os.path.join(self.folder, 'metrics.jsonl')
+        agb.metrics.write_json_lines(lines)
+        with open(lines) as f:
+            self.assertEqual(len(stages), len(f.readlines()))
+
+    def test_cprofile_threads(self):
+        import pstats
+        path = os.path.join(self.folder, 'agbackup.cprofile')
+        agb = make_agbackup(self.folder)
+        with open(os.path.join(self.folder, 'src', 'big'), 'wb') as f:
+            f.write(os.urandom(3 * MEGABYTE))
+        agb.metrics.hooks.append(cprofile_hook(path))
+        with agb.metrics.run():
+            agb.backup('src')
+
+        # the parts are uploaded by the upload threads
+        functions = [func for _, _, func in pstats.Stats(path).stats]
+        self.assertIn('_upload_part', functions)
+        # the persistent pool threads stopped profiling with the run
+        for executor in (agb.compress_executor, agb.vault.upload_executor):
+            self.assertIsNone(executor.submit(sys.getprofile).result())
+
+    def test_resume_backup(self):
+        from aglocal import LocalMultipartUpload
+        agb = make_agbackup(self.folder, journal_dir=os.path.join(self.folder, 'journal'))
+        with open(os.path.join(self.folder, 'src', 'big'), 'wb') as f:
+            f.write(os.urandom(5 * MEGABYTE))
+
+        upload_part = LocalMultipartUpload.upload_part
+        uploaded = []
+
+        def failing_upload_part(multipart_upload, range, body, checksum=None):
+            if range.startswith('bytes 3145728-'):
+                raise IOError("connection reset")
+            uploaded.append(range)
+            return upload_part(multipart_upload, range, body, checksum)
+
+        LocalMultipartUpload.upload_part = failing_upload_part
+        try:
+            with self.assertRaises(IOError):
+                agb.backup('src')
+        finally:
+            LocalMultipartUpload.upload_part = upload_part
+
+        jobs = agb.journal.jobs('src')
+        self.assertEqual(1, len(jobs))
+        self.assertTrue(jobs[0].resumable)
+        self.assertEqual(len(uploaded), len(jobs[0].parts))
+        self.assertNotIn(3 * MEGABYTE, jobs[0].parts)
+        self.assertIsNone(agb.vault.get_latest('src'))
+
+        def counting_upload_part(multipart_upload, range, body, checksum=None):
+            uploaded.append(range)
+            return upload_part(multipart_upload, range, body, checksum)
+
+        del uploaded[:]
+        LocalMultipartUpload.upload_part = counting_upload_part
+        try:
+            agb.backup('src', resume=True)
+        finally:
+            LocalMultipartUpload.upload_part = upload_part
+
+        self.assertEqual(['bytes 3145728-4194303/*'], uploaded)
+        self.assertEqual([], agb.journal.jobs())
+        self.assertEqual([], agb.vault.vault.multipart_uploads.all())
+        out = os.path.join(self.folder, 'out')
+        agb.retrive('src', out, force=False, wait=False)
+        self.assertEqual(read_tree(os.path.join(self.folder, 'src')), read_tree(os.path.join(out, 'src')))
+        # the member index was stored with the resumed archive
+        self.assertIsNotNone(agb.vault.catalog.member(agb.vault.get_latest('src')['id'], 'src/big'))
+
+    def test_resume_backup_early_failure(self):
+        from aglocal import LocalMultipartUpload
+        agb = make_agbackup(self.folder, journal_dir=os.path.join(self.folder, 'journal'))
+        agb.config['backup_objects'][0]['encrypt'] = False
+        with open(os.path.join(self.folder, 'src', 'big'), 'wb') as f:
+            f.write(os.urandom(20 * MEGABYTE))
+
+        upload_part = LocalMultipartUpload.upload_part
+        uploaded = []
+
+        def failing_upload_part(multipart_upload, range, body, checksum=None):
+            # long before the last parts of the stream
+            if range.startswith('bytes 2097152-'):
+                raise IOError("connection reset")
+            uploaded.append(range)
+            return upload_part(multipart_upload, range, body, checksum)
+
+        LocalMultipartUpload.upload_part = failing_upload_part
+        try:
+            with self.assertRaises(IOError):
+                agb.backup('src')
+        finally:
+            LocalMultipartUpload.upload_part = upload_part
+
+        # the whole stream is staged and the multipart upload kept
+        jobs = agb.journal.jobs('src')
+        self.assertEqual(1, len(jobs))
+        self.assertTrue(jobs[0].resumable)
+        self.assertEqual([jobs[0].upload_id], [upload.id for upload in agb.vault.vault.multipart_uploads.all()])
+        self.assertEqual(len(uploaded), len(jobs[0].parts))
+        self.assertTrue(os.path.getsize(jobs[0].stage_path) > 19 * MEGABYTE)
+
+        confirmed = set(jobs[0].parts)
+        resumed = []
+        LocalMultipartUpload.upload_part = lambda multipart_upload, range, body, checksum=None: \
+            resumed.append(range) or upload_part(multipart_upload, range, body, checksum)
+        try:
+            agb.backup('src', resume=True)
+        finally:
+            LocalMultipartUpload.upload_part = upload_part
+
+        # only the missing parts were uploaded
+        self.assertTrue(resumed)
+        self.assertFalse({int(r.split(' ')[1].split('-')[0]) for r in resumed} & confirmed)
+        self.assertEqual([], agb.journal.jobs())
+        out = os.path.join(self.folder, 'out')
+        agb.retrive('src', out, force=False, wait=False)
+        self.assertEqual(read_tree(os.path.join(self.folder, 'src')), read_tree(os.path.join(out, 'src')))
+
+    def test_resume_cleanup(self):
+        agb = make_agbackup(self.folder, journal_dir=os.path.join(self.folder, 'journal'))
+        # interrupted while the stream was written
+        job = agb.journal.create('src', {"name": "src"}, agb.vault.part_size)
+        job.upload_started(agb.vault.vault.initiate_multipart_upload(archiveDescription='{"name": "src"}',
+                                                                     partSize=str(MEGABYTE)).id)
+        # left by a crash without journal
+        orphan = agb.vault.vault.initiate_multipart_upload(archiveDescription='{"name": "other"}',
+                                                           partSize=str(MEGABYTE))
+        with open(os.path.join(agb.vault.vault.folder, orphan.id + '.upload'), 'r+') as f:
+            meta = json.load(f)
+            meta['creation_date'] = '2020-01-01T00:00:00.000Z'
+            f.seek(0)
+            json.dump(meta, f)
+            f.truncate()
+        recent = agb.vault.vault.initiate_multipart_upload(archiveDescription='{"name": "other"}',
+                                                           partSize=str(MEGABYTE))
+
+        agb.backup('src', resume=True)
 
-    def test_dict_latest2(self):
-        d = {
-            "s2difjsodfjaposiejghasodf": {"date": datetime(2012,2,1,5,8),},
-            "s1difjsodfjaposiejghasodf": {"date": datetime(2011,2,1,5,8),},
-            "s4difjsodfjaposiejghasodf": {"date": datetime(2014,2,1,5,8),},
-            "s3difjsodfjaposiejghasodf": {"date": datetime(2013,2,1,5,8),},
-        }
+        self.assertEqual([], agb.journal.jobs())
+        self.assertEqual([recent.id], [upload.id for upload in agb.vault.vault.multipart_uploads.all()])
+        self.assertIsNotNone(agb.vault.get_latest('src'))
 
-        self.assertEqual("s4difjsodfjaposiejghasodf", Agbackup.get_latest_from_dict(d, 'date')[0])
-        self.assertEqual({"date": datetime(2014,2,1,5,8),}, Agbackup.get_latest_from_dict(d, 'date')[1])
+    def test_restore_download_dir(self):
+        agb = make_agbackup(self.folder, download_dir=os.path.join(self.folder, 'downloads'))
+        agb.backup('src')
+        out = os.path.join(self.folder, 'out')
+        agb.retrive('src', out, force=False, wait=False)
 
+        self.assertEqual(read_tree(os.path.join(self.folder, 'src')), read_tree(os.path.join(out, 'src')))
+        self.assertEqual([], os.listdir(os.path.join(self.folder, 'downloads')))
 
 
 if __name__ == '__main__':